@@ -1,7 +1,7 @@
 from rest_framework import viewsets
 from rest_framework.permissions import IsAdminUser
 from rest_framework import filters
-from ecwsp.grades.models import Grade
+from ecwsp.grades.models import Grade, deferred_invalidation
 from ecwsp.schedule.models import CourseSection
 from api.grades.serializers import GradeSerializer
 from rest_framework import mixins
@@ -25,3 +25,8 @@ class GradeViewSet(viewsets.ModelViewSet):
     serializer_class = GradeSerializer
     filter_fields = ('student', 'course_section', 'course_section__marking_period__school_year')
     ordering_fields = ('marking_period__start_date',)
+
+    def dispatch(self, *args, **kwargs):
+        """ Invalidate grade caches once per request """
+        with deferred_invalidation():
+            return super(GradeViewSet, self).dispatch(*args, **kwargs)
@@ -7,7 +7,7 @@ from api.admissions.views import ApplicationTemplateViewSet
 from api.admissions.views import ApplicantAdditionalInformationViewSet
 from api.admissions.views import EmergencyContactViewSet
 from api.admissions.views import ApplicantForeignKeyRelatedFieldChoicesViewSet
-from ecwsp.gradebook.api_views import AssignmentViewSet
+from ecwsp.gradebook.api_views import AssignmentViewSet, MarkViewSet
 
 
 router = routers.DefaultRouter()
@@ -15,6 +15,7 @@ router.register(r'grades', GradeViewSet)
 router.register(r'courses', CourseViewSet)
 router.register(r'sections', SectionViewSet)
 router.register(r'assignments', AssignmentViewSet)
+router.register(r'marks', MarkViewSet)
 router.register(r'applicant', ApplicantViewSet)
 router.register(r'applicant-custom-field', ApplicantCustomFieldViewSet)
 router.register(r'application-template', ApplicationTemplateViewSet )
@@ -16,6 +16,10 @@ else:
 app.config_from_object('django.conf:settings')
 app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
 
+if getattr(settings, 'PERFORMANCE_LOGGING', False):
+    from ecwsp.sis.performance import connect_celery_signals
+    connect_celery_signals()
+
 @app.task()
 def debug_task():
     print('hey')
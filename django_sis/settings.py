@@ -86,6 +86,7 @@ ROOT_URLCONF = 'django_sis.urls'
 WSGI_APPLICATION = 'ecwsp.wsgi.application'
 
 MIDDLEWARE_CLASSES = (
+    'ecwsp.sis.performance.PerformanceMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -123,6 +124,22 @@ else:
     DEBUG = True
 
 DEBUG_TOOLBAR = False  # Set true to enable debug toolbar
+# Record time, queries and memory of every view and task, see ecwsp.sis.performance
+PERFORMANCE_LOGGING = os.getenv('PERFORMANCE_LOGGING', False)
+PERFORMANCE_LOG_DAYS = 14
+# Appy reports for more students than REPORT_CHUNK_SIZE are rendered in chunks
+# by REPORT_RENDER_WORKERS processes, see ecwsp.sis.report_render
+REPORT_CHUNK_SIZE = int(os.getenv('REPORT_CHUNK_SIZE', 100))
+REPORT_RENDER_WORKERS = int(os.getenv('REPORT_RENDER_WORKERS', 2))
+# Background report jobs, see ecwsp.sis.report_jobs. Files are kept for
+# REPORT_JOB_TTL hours and at most REPORT_JOB_CONCURRENCY jobs run at once.
+# Jobs running or waiting to run longer than REPORT_JOB_TIMEOUT minutes fail.
+REPORT_JOB_TTL = 24
+REPORT_JOB_CONCURRENCY = int(os.getenv('REPORT_JOB_CONCURRENCY', 2))
+REPORT_JOB_TIMEOUT = int(os.getenv('REPORT_JOB_TIMEOUT', 60))
+# Benchmark gradebook Aggregates are recalculated by one celery task per this
+# many students, see ecwsp.benchmark_grade.recalculation
+BENCHMARK_RECALCULATION_STUDENTS_PER_TASK = 25
 TEMPLATE_DEBUG = DEBUG
 AUTH_PROFILE_MODULE = 'sis.UserPreference'
 
@@ -251,6 +268,11 @@ LOGGING = {
             'handlers': ['console'],
             'propagate': False,
         },
+        'ecwsp.performance': {
+            'level': 'INFO',
+            'handlers': ['console'],
+            'propagate': False,
+        },
     },
 }
 
@@ -283,6 +305,8 @@ REDIS_ADDR = os.environ.get('REDIS_1_PORT_6379_TCP_ADDR', 'localhost')
 REDIS_PORT = os.environ.get('REDIS_1_PORT_6379_TCP_PORT', '6379')
 REDIS_URL = os.environ.get('REDISCLOUD_URL') or 'redis://{}:{}/0'.format(REDIS_ADDR, REDIS_PORT)
 
+# The cache must be shared between processes, ProcessCache invalidation
+# goes through it. LocMemCache is only accepted with DEBUG.
 from redisify import redisify
 if REDIS_URL:
     CACHES = redisify(default=REDIS_URL)
@@ -306,6 +330,22 @@ CELERYBEAT_SCHEDULE = {
         'task': 'ecwsp.grades.tasks.build_grade_cache_task',
         'schedule': crontab(hour=23, minute=1),
     },
+    'cache-grades-dirty': {
+        'task': 'ecwsp.grades.tasks.process_dirty_grade_cache_task',
+        'schedule': timedelta(minutes=1),
+    },
+    'snapshot-grades-nightly': {
+        'task': 'ecwsp.grades.tasks.snapshot_grades_task',
+        'schedule': crontab(hour=0, minute=16),
+    },
+    'prune-performance-records': {
+        'task': 'ecwsp.sis.tasks.prune_performance_records_task',
+        'schedule': crontab(hour=2, minute=1),
+    },
+    'delete-expired-report-jobs': {
+        'task': 'ecwsp.sis.tasks.delete_expired_report_jobs_task',
+        'schedule': crontab(minute=31),
+    },
     'sent-admissions-email': {
         'task': 'ecwsp.admissions.tasks.email_admissions_new_inquiries',
         'schedule': crontab(hour=23, minute=16),
@@ -7,6 +7,7 @@ from dajaxice.core import dajaxice_autodiscover, dajaxice_config
 from api.routers import api_urls
 from responsive_dashboard import views as dashboard_views
 from ecwsp.sis.views import AttendanceReportView
+from ecwsp.sis.report_render import ChunkedDownloadReportView
 from django.http import HttpResponse
 
 dajaxice_autodiscover()
@@ -44,6 +45,7 @@ urlpatterns = patterns('',
     url(r'^autocomplete/', include('autocomplete_light.urls')),
     url(dajaxice_config.dajaxice_url, include('ecwsp.dajaxice_urls')),
     (r'^reports/(?P<name>attendance_report)/$', AttendanceReportView.as_view()),
+    (r'^reports/(?P<name>\w+)/view/$', login_required(ChunkedDownloadReportView.as_view())),
     (r'^reports/', include('scaffold_report.urls')),
     url(r'^impersonate/', include('impersonate.urls')),
     url(r'^api/', include(api_urls)),
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def build_attendance_counts(apps, schema_editor):
+    StudentAttendance = apps.get_model('attendance', 'StudentAttendance')
+    StudentAttendanceCount = apps.get_model('attendance', 'StudentAttendanceCount')
+    counts = {}
+    for student_id, date, absent, tardy, excused, code in StudentAttendance.objects.values_list(
+            'student_id', 'date', 'status__absent', 'status__tardy', 'status__excused', 'status__code'):
+        count = counts.get((student_id, date))
+        if count is None:
+            count = counts[(student_id, date)] = StudentAttendanceCount(student_id=student_id, date=date)
+        if absent:
+            count.absent += 1
+            if not excused:
+                count.absent_unexcused += 1
+        if tardy:
+            count.tardy += 1
+            if not excused:
+                count.tardy_unexcused += 1
+        if code == "D":
+            count.dismissed += 1
+        if code == "nonmemb":
+            count.nonmemb += 1
+    StudentAttendanceCount.objects.bulk_create(counts.values(), batch_size=1000)
+
+
+def drop_attendance_counts(apps, schema_editor):
+    pass  # The table is dropped
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('attendance', '0003_auto_20141231_1848'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StudentAttendanceCount',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('date', models.DateField()),
+                ('absent', models.PositiveIntegerField(default=0)),
+                ('tardy', models.PositiveIntegerField(default=0)),
+                ('absent_unexcused', models.PositiveIntegerField(default=0)),
+                ('tardy_unexcused', models.PositiveIntegerField(default=0)),
+                ('dismissed', models.PositiveIntegerField(default=0)),
+                ('nonmemb', models.PositiveIntegerField(default=0)),
+                ('student', models.ForeignKey(to='sis.Student')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='studentattendancecount',
+            unique_together=set([('student', 'date')]),
+        ),
+        migrations.RunPython(build_attendance_counts, drop_attendance_counts),
+    ]
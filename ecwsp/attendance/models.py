@@ -1,9 +1,11 @@
 from django.contrib.auth.models import User
 from django.conf import settings
 from django.db import models
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, pre_save, post_delete
+from django.dispatch import receiver
 
 from ecwsp.sis.models import Student, SchoolYear
+from ecwsp.sis.helper_functions import chunks
 from ecwsp.administration.models import Configuration
 from django.core.exceptions import MultipleObjectsReturned, ObjectDoesNotExist
 
@@ -121,6 +123,99 @@ def post_save_attendance_handler(sender, instance, **kwargs):
 post_save.connect(post_save_attendance_handler, sender=StudentAttendance)
 
 
+ATTENDANCE_COUNT_FIELDS = ('absent', 'tardy', 'absent_unexcused', 'tardy_unexcused', 'dismissed', 'nonmemb')
+
+class StudentAttendanceCount(models.Model):
+    """ Daily attendance totals for a student, only used for cache
+    Kept up to date when StudentAttendance changes so reports can sum these
+    instead of counting and joining attendance records. Rebuild with
+    rebuild_attendance_counts after changing attendance in bulk. """
+    student = models.ForeignKey(Student)
+    date = models.DateField()
+    absent = models.PositiveIntegerField(default=0)
+    tardy = models.PositiveIntegerField(default=0)
+    absent_unexcused = models.PositiveIntegerField(default=0)
+    tardy_unexcused = models.PositiveIntegerField(default=0)
+    dismissed = models.PositiveIntegerField(default=0)
+    nonmemb = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = (('student', 'date'),)
+
+    def __unicode__(self):
+        return u"{0} {1}".format(self.student, self.date)
+
+
+def count_attendance_records(records):
+    """ StudentAttendanceCount rows from StudentAttendance values_list rows
+    of (student_id, date, absent, tardy, excused, code) """
+    counts = {}
+    for student_id, date, absent, tardy, excused, code in records:
+        count = counts.get((student_id, date))
+        if count is None:
+            count = counts[(student_id, date)] = StudentAttendanceCount(student_id=student_id, date=date)
+        if absent:
+            count.absent += 1
+            if not excused:
+                count.absent_unexcused += 1
+        if tardy:
+            count.tardy += 1
+            if not excused:
+                count.tardy_unexcused += 1
+        if code == "D":
+            count.dismissed += 1
+        if code == "nonmemb":
+            count.nonmemb += 1
+    return counts.values()
+
+
+ATTENDANCE_RECORD_FIELDS = ('student_id', 'date', 'status__absent', 'status__tardy', 'status__excused', 'status__code')
+
+def update_attendance_counts(student_id, dates):
+    """ Recount one student's attendance on dates """
+    StudentAttendanceCount.objects.filter(student=student_id, date__in=dates).delete()
+    StudentAttendanceCount.objects.bulk_create(count_attendance_records(
+        StudentAttendance.objects.filter(student=student_id, date__in=dates).values_list(*ATTENDANCE_RECORD_FIELDS)))
+
+
+def rebuild_attendance_counts(student_ids=None):
+    """ Recount all attendance, or only student_ids', in a few queries """
+    if student_ids is None:
+        StudentAttendanceCount.objects.all().delete()
+        StudentAttendanceCount.objects.bulk_create(count_attendance_records(
+            StudentAttendance.objects.values_list(*ATTENDANCE_RECORD_FIELDS)), batch_size=1000)
+        return
+    for student_chunk in chunks(student_ids):
+        StudentAttendanceCount.objects.filter(student__in=student_chunk).delete()
+        StudentAttendanceCount.objects.bulk_create(count_attendance_records(
+            StudentAttendance.objects.filter(student__in=student_chunk).values_list(*ATTENDANCE_RECORD_FIELDS)),
+            batch_size=1000)
+
+
+@receiver(pre_save, sender=StudentAttendance)
+def remember_attendance_date(sender, instance, raw=False, **kwargs):
+    """ The old student and date need recounting too when they change """
+    instance._counted_as = None
+    if instance.pk and not raw:
+        instance._counted_as = StudentAttendance.objects.filter(
+            pk=instance.pk).values_list('student_id', 'date').first()
+
+@receiver(post_save, sender=StudentAttendance)
+@receiver(post_delete, sender=StudentAttendance)
+def update_attendance_counts_handler(sender, instance, **kwargs):
+    update_attendance_counts(instance.student_id, [instance.date])
+    counted_as = getattr(instance, '_counted_as', None)
+    if counted_as and counted_as != (instance.student_id, instance.date):
+        update_attendance_counts(counted_as[0], [counted_as[1]])
+
+@receiver(post_save, sender=AttendanceStatus)
+def update_status_attendance_counts(sender, instance, created=False, raw=False, **kwargs):
+    """ Changing what a status counts as changes every count using it """
+    if not created and not raw:
+        rebuild_attendance_counts(StudentAttendance.objects.filter(
+            status=instance).values_list('student_id', flat=True).distinct())
+
+
 class AttendanceLog(models.Model):
     date = models.DateField(default=datetime.date.today, validators=settings.DATE_VALIDATORS)
     user = models.ForeignKey(User)
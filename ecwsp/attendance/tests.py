@@ -126,3 +126,42 @@ class DashletTests(TestCase):
             log = AttendanceLog.objects.filter(course_section=homeroom)
             assert log.count() > 0
 
+
+
+class AttendanceCountTests(TestCase):
+    def setUp(self):
+        self.student = Student.objects.create(first_name="Joe", last_name="Student", username="jstudent")
+        self.absent = AttendanceStatus.objects.create(name="Absent", code="A", absent=True)
+        self.tardy = AttendanceStatus.objects.create(name="Tardy", code="T", tardy=True)
+
+    def get_count(self, day):
+        return StudentAttendanceCount.objects.get(student=self.student, date=day)
+
+    def test_counts_follow_attendance(self):
+        day = date(2014, 9, 2)
+        attendance = StudentAttendance.objects.create(student=self.student, date=day, status=self.absent)
+        StudentAttendance.objects.create(student=self.student, date=day, status=self.tardy)
+        count = self.get_count(day)
+        self.assertEqual((count.absent, count.absent_unexcused, count.tardy), (1, 1, 1))
+
+        attendance.date = date(2014, 9, 3)
+        attendance.save()
+        self.assertEqual(self.get_count(day).absent, 0)
+        self.assertEqual(self.get_count(date(2014, 9, 3)).absent, 1)
+
+        self.absent.excused = True
+        self.absent.save()
+        self.assertEqual(self.get_count(date(2014, 9, 3)).absent_unexcused, 0)
+
+        attendance.delete()
+        self.assertFalse(StudentAttendanceCount.objects.filter(date=date(2014, 9, 3)).exists())
+
+    def test_rebuild_attendance_counts(self):
+        day = date(2014, 9, 2)
+        StudentAttendance.objects.create(student=self.student, date=day, status=self.tardy)
+        StudentAttendanceCount.objects.all().delete()
+        rebuild_attendance_counts()
+        self.assertEqual(self.get_count(day).tardy, 1)
+        StudentAttendanceCount.objects.all().delete()
+        rebuild_attendance_counts([self.student.id])
+        self.assertEqual(self.get_count(day).tardy, 1)
@@ -483,7 +483,7 @@ def attendance_report(request):
                                         status=status).count() < form.cleaned_data['filter_count']):
                                     add = False
                             if add: data.append(row)
-                    report = XlReport(file_name="attendance_report")
+                    report = XlReport(file_name="attendance_report", write_only=True)
                     report.add_sheet(data, header_row=titles, title="Attendance Report", heading="Attendance Report")
 
                 elif 'perfect_attendance' in request.POST:
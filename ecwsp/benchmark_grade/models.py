@@ -17,6 +17,8 @@
 #   MA 02110-1301, USA.
 
 from django.db import models
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
 from django.db.models import Avg, Count, Max, Min, StdDev, Sum, Variance
 from django.conf import settings
 from decimal import Decimal, InvalidOperation
@@ -667,3 +669,37 @@ class AggregateTask(models.Model):
     timestamp = models.DateTimeField(default=datetime.now)
     class Meta:
         unique_together = ('aggregate', 'task_id')
+
+
+@receiver(post_save, sender=CalculationRule)
+def recalculate_on_rule_change(sender, instance, created=False, raw=False, **kwargs):
+    if not created and not raw:
+        from ecwsp.benchmark_grade.recalculation import schedule_rule_recalculation
+        schedule_rule_recalculation(instance)
+
+@receiver(post_save, sender=CalculationRulePerCourseCategory)
+@receiver(post_delete, sender=CalculationRulePerCourseCategory)
+@receiver(post_save, sender=CalculationRuleCategoryAsCourse)
+@receiver(post_delete, sender=CalculationRuleCategoryAsCourse)
+@receiver(post_save, sender=CalculationRuleSubstitution)
+@receiver(post_delete, sender=CalculationRuleSubstitution)
+def recalculate_on_rule_part_change(sender, instance, raw=False, **kwargs):
+    """ Stored Aggregates are only recalculated when something they are
+    calculated from changes, so the gradebook can read them as they are """
+    if raw:
+        return
+    from ecwsp.benchmark_grade.recalculation import schedule_rule_recalculation
+    try:
+        rule = instance.calculation_rule
+    except CalculationRule.DoesNotExist:
+        # Deleted along with its rule
+        return
+    schedule_rule_recalculation(rule)
+
+@receiver(m2m_changed, sender=CalculationRulePerCourseCategory.apply_to_departments.through)
+@receiver(m2m_changed, sender=CalculationRuleCategoryAsCourse.include_departments.through)
+@receiver(m2m_changed, sender=CalculationRuleSubstitution.apply_to_departments.through)
+@receiver(m2m_changed, sender=CalculationRuleSubstitution.apply_to_categories.through)
+def recalculate_on_rule_m2m_change(sender, instance, action, reverse, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear') and not reverse:
+        recalculate_on_rule_part_change(sender, instance)
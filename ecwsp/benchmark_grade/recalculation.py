@@ -0,0 +1,461 @@
+""" Recalculate benchmark_grade Aggregates as a dependency graph
+
+An Aggregate is identified by its key, the (student, course section,
+category, marking period) ids with None for blank fields. Aggregates with
+every field set are calculated from Marks; the others are weighted averages
+of the Aggregates returned by Aggregate.depends_on. AggregateGraph finds
+every key that depends on some changed keys, orders them by level and
+calculates a whole level at a time from a few grouped queries, so an
+Aggregate shared by several others is only calculated once.
+
+Students never share Aggregates, so schedule_recalculation splits the work
+into celery tasks of BENCHMARK_RECALCULATION_STUDENTS_PER_TASK students.
+"""
+from django.conf import settings
+from ecwsp.benchmark_grade.models import Aggregate, AggregateTask, CalculationRule, Category, Mark, benchmark_find_calculation_rule
+from ecwsp.grades.models import Grade, deferred_invalidation
+from ecwsp.schedule.models import CourseEnrollment, CourseSection, MarkingPeriod
+from ecwsp.sis.models import SchoolYear
+from decimal import Decimal
+import celery.utils
+import logging
+import math
+
+# Which key fields are set for each kind of Aggregate, as in Aggregate.depends_on
+SECTION_CATEGORY_MARKING_PERIOD = (True, True, True, True)
+SECTION_CATEGORY = (True, True, True, False)
+SECTION_MARKING_PERIOD = (True, True, False, True)
+SECTION = (True, True, False, False)
+CATEGORY_AS_COURSE = (True, False, True, True)
+
+# Saving these copies them to ecwsp.grades, see Aggregate.save
+COPIED_TO_GRADES = (SECTION_MARKING_PERIOD, CATEGORY_AS_COURSE)
+
+
+def key_kind(key):
+    return tuple(x is not None for x in key)
+
+
+def aggregate_key(aggregate):
+    return (aggregate.student_id, aggregate.course_section_id,
+            aggregate.category_id, aggregate.marking_period_id)
+
+
+def in_departments(department_id, departments):
+    ''' Like filter(apply_to_departments=department_id), where a course
+    without a department matches rows without departments '''
+    if department_id is None:
+        return not departments
+    return department_id in departments
+
+
+def variance(values):
+    mean = sum(values) / len(values)
+    return sum((value - mean) ** 2 for value in values) / len(values)
+
+# Python versions of Category.aggregation_method
+AGGREGATION_METHODS = {
+    'Avg': lambda values: sum(values) / len(values),
+    'Count': len,
+    'Max': max,
+    'Min': min,
+    'StdDev': lambda values: Decimal(math.sqrt(variance(values))),
+    'Sum': sum,
+    'Variance': variance,
+}
+
+
+class AggregateGraph(object):
+    ''' The Aggregates of the students in some keys and how they depend on
+    each other. What is needed to follow the dependencies is loaded up front. '''
+    def __init__(self, keys):
+        keys = set(keys)
+        self.student_ids = set(key[0] for key in keys)
+        self.enrollments = set(CourseEnrollment.objects.filter(
+            user__in=self.student_ids).values_list('user_id', 'course_section_id'))
+        self.course_sections = {}
+        self.marking_periods = {}
+        self.rules = {}
+        self.categories = {}
+        self.aggregates = None
+        self.load_course_sections(
+            set(course_section_id for student_id, course_section_id in self.enrollments) |
+            set(key[1] for key in keys))
+        self.load_marking_periods(key[3] for key in keys)
+
+    def load_course_sections(self, course_section_ids):
+        course_section_ids = set(course_section_ids) - set(self.course_sections) - set((None,))
+        if not course_section_ids:
+            return
+        for (course_section_id, department_id, credits, graded, award_credits
+                ) in CourseSection.objects.filter(id__in=course_section_ids).values_list(
+                'id', 'course__department_id', 'course__credits', 'course__graded',
+                'course__course_type__award_credits'):
+            self.course_sections[course_section_id] = {
+                'department': department_id,
+                'credits': credits,
+                'counts_as_course': bool(graded and award_credits),
+                'marking_periods': [],
+            }
+        # MarkingPeriod's ordering, like course_section.marking_period.all()
+        for course_section_id, marking_period_id, weight, school_year_id in MarkingPeriod.objects.filter(
+                coursesection__in=course_section_ids).values_list('coursesection', 'id', 'weight', 'school_year_id'):
+            self.course_sections[course_section_id]['marking_periods'].append(marking_period_id)
+            self.marking_periods[marking_period_id] = {'weight': weight, 'school_year': school_year_id}
+
+    def load_marking_periods(self, marking_period_ids):
+        marking_period_ids = set(marking_period_ids) - set(self.marking_periods) - set((None,))
+        if marking_period_ids:
+            for marking_period_id, weight, school_year_id in MarkingPeriod.objects.filter(
+                    id__in=marking_period_ids).values_list('id', 'weight', 'school_year_id'):
+                self.marking_periods[marking_period_id] = {'weight': weight, 'school_year': school_year_id}
+
+    def get_rule(self, school_year_id):
+        ''' The calculation rule with its weights and substitutions loaded '''
+        if school_year_id not in self.rules:
+            rule = benchmark_find_calculation_rule(SchoolYear.objects.get(id=school_year_id))
+            rule.per_course_categories = [
+                (set(department.pk for department in per_course_category.apply_to_departments.all()),
+                 per_course_category.category_id, per_course_category.weight)
+                for per_course_category in rule.per_course_category_set.order_by('id').prefetch_related('apply_to_departments')]
+            rule.categories_as_courses = dict(
+                (category_as_course.category_id,
+                 set(department.pk for department in category_as_course.include_departments.all()))
+                for category_as_course in rule.category_as_course_set.prefetch_related('include_departments'))
+            rule.substitutions = [
+                (set(department.pk for department in substitution.apply_to_departments.all()),
+                 set(category.pk for category in substitution.apply_to_categories.all()),
+                 substitution)
+                for substitution in rule.substitution_set.order_by('id').prefetch_related(
+                    'apply_to_departments', 'apply_to_categories')]
+            self.rules[school_year_id] = rule
+        return self.rules[school_year_id]
+
+    def key_rule(self, key):
+        ''' Like Aggregate.calculation_rule '''
+        student_id, course_section_id, category_id, marking_period_id = key
+        if marking_period_id is not None:
+            return self.get_rule(self.marking_periods[marking_period_id]['school_year'])
+        return self.get_rule(self.marking_periods[
+            self.course_sections[course_section_id]['marking_periods'][0]]['school_year'])
+
+    def get_category(self, category_id):
+        if not self.categories:
+            self.categories = dict((category.pk, category) for category in Category.objects.all())
+        return self.categories[category_id]
+
+    def substitute(self, key, value):
+        ''' Like CalculationRule.substitute for the Aggregate with key '''
+        department_id = self.course_sections[key[1]]['department']
+        for departments, categories, substitution in self.key_rule(key).substitutions:
+            if in_departments(department_id, departments) and key[2] in categories and substitution.applies_to(value):
+                calculate_as = value
+                display_as = None
+                if substitution.calculate_as is not None:
+                    calculate_as = substitution.calculate_as
+                if substitution.display_as is not None and len(substitution.display_as):
+                    display_as = substitution.display_as
+                return calculate_as, display_as
+        return value, None
+
+    def per_course_categories(self, course_section_id, marking_period_id):
+        department_id = self.course_sections[course_section_id]['department']
+        rule = self.key_rule((None, course_section_id, None, marking_period_id))
+        return [(category_id, weight) for departments, category_id, weight in rule.per_course_categories
+                if in_departments(department_id, departments)]
+
+    def counts_as_course(self, student_id, course_section_id, category_id, marking_period_id):
+        ''' Whether the course section is part of the student's category as
+        course average for the marking period '''
+        course_section = self.course_sections[course_section_id]
+        departments = self.key_rule((None, None, None, marking_period_id)).categories_as_courses.get(category_id)
+        return (departments is not None and
+            (student_id, course_section_id) in self.enrollments and
+            course_section['counts_as_course'] and
+            course_section['department'] in departments and
+            marking_period_id in course_section['marking_periods'])
+
+    def children(self, key):
+        ''' [(key, weight)] of the Aggregates key is calculated from, in the
+        order of Aggregate.depends_on '''
+        student_id, course_section_id, category_id, marking_period_id = key
+        kind = key_kind(key)
+        if kind == SECTION_CATEGORY_MARKING_PERIOD:
+            return []
+        if kind in (SECTION_CATEGORY, SECTION):
+            return [((student_id, course_section_id, category_id, child_marking_period_id),
+                     self.marking_periods[child_marking_period_id]['weight'])
+                    for child_marking_period_id in self.course_sections[course_section_id]['marking_periods']]
+        if kind == SECTION_MARKING_PERIOD:
+            return [((student_id, course_section_id, child_category_id, marking_period_id), weight)
+                    for child_category_id, weight in self.per_course_categories(course_section_id, marking_period_id)]
+        if kind == CATEGORY_AS_COURSE:
+            children = []
+            for child_student_id, child_course_section_id in sorted(self.enrollments):
+                if child_student_id == student_id and self.counts_as_course(
+                        student_id, child_course_section_id, category_id, marking_period_id):
+                    course_section = self.course_sections[child_course_section_id]
+                    weight = Decimal(course_section['credits']) / len(course_section['marking_periods'])
+                    children.append(((student_id, child_course_section_id, category_id, marking_period_id), weight))
+            return children
+        raise Exception("Aggregate type unrecognized.")
+
+    def parents(self, key):
+        ''' Keys of the Aggregates calculated from key '''
+        student_id, course_section_id, category_id, marking_period_id = key
+        kind = key_kind(key)
+        parents = []
+        if kind == SECTION_CATEGORY_MARKING_PERIOD:
+            parents.append((student_id, course_section_id, category_id, None))
+            if category_id in dict(self.per_course_categories(course_section_id, marking_period_id)):
+                parents.append((student_id, course_section_id, None, marking_period_id))
+            if self.counts_as_course(student_id, course_section_id, category_id, marking_period_id):
+                parents.append((student_id, None, category_id, marking_period_id))
+        elif kind == SECTION_MARKING_PERIOD:
+            parents.append((student_id, course_section_id, None, None))
+        return parents
+
+    def dirty(self, keys):
+        ''' keys and every key that depends on them '''
+        dirty = set()
+        stack = list(keys)
+        while stack:
+            key = stack.pop()
+            if key not in dirty:
+                dirty.add(key)
+                stack.extend(self.parents(key))
+        return dirty
+
+    def load_aggregates(self):
+        ''' Every Aggregate of the students by key. Duplicates are deleted like
+        benchmark_get_or_flush does. '''
+        aggregates = {}
+        for aggregate in Aggregate.objects.filter(student__in=self.student_ids):
+            aggregates.setdefault(aggregate_key(aggregate), []).append(aggregate)
+        self.aggregates = {}
+        for key, found in aggregates.items():
+            if len(found) > 1:
+                logging.error('Expected 1 Aggregate for {} but found {}; flushing them all!'.format(key, len(found)))
+                Aggregate.objects.filter(pk__in=[aggregate.pk for aggregate in found]).delete()
+            else:
+                self.aggregates[key] = found[0]
+        # Aggregates can outlive the student's enrollment
+        self.load_course_sections(key[1] for key in self.aggregates)
+        self.load_marking_periods(key[3] for key in self.aggregates)
+
+    def plan(self, keys, recalculate_all=False):
+        ''' Levels of keys to calculate, in topological order. These are keys,
+        everything that depends on them and the Aggregates they depend on
+        that are missing, or all of those if recalculate_all is set. '''
+        if self.aggregates is None:
+            self.load_aggregates()
+        todo = self.dirty(keys)
+        stack = list(todo)
+        while stack:
+            for child, weight in self.children(stack.pop()):
+                if child not in todo and (recalculate_all or child not in self.aggregates):
+                    todo.add(child)
+                    stack.append(child)
+        # Kahn's algorithm, a key is ready once every child it waits for is done
+        waiting = {}
+        parents = dict((key, []) for key in todo)
+        for key in todo:
+            children = [child for child, weight in self.children(key) if child in todo]
+            waiting[key] = len(children)
+            for child in children:
+                parents[child].append(key)
+        levels = []
+        level = [key for key, count in waiting.items() if not count]
+        while level:
+            levels.append(sorted(level))
+            next_level = []
+            for key in level:
+                for parent in parents[key]:
+                    waiting[parent] -= 1
+                    if not waiting[parent]:
+                        next_level.append(parent)
+            level = next_level
+        return levels
+
+    def create_missing(self, keys):
+        missing = [key for key in keys if key not in self.aggregates]
+        if missing:
+            Aggregate.objects.bulk_create([
+                Aggregate(student_id=key[0], course_section_id=key[1], category_id=key[2], marking_period_id=key[3])
+                for key in missing])
+            self.load_aggregates()
+
+    def fallback_points_possible(self, key):
+        ''' Like Aggregate._fallback_points_possible '''
+        aggregate = self.aggregates[key]
+        if aggregate.points_possible is not None:
+            return aggregate.points_possible
+        if key[2] is not None and self.get_category(key[2]).fixed_points_possible is not None:
+            return self.get_category(key[2]).fixed_points_possible
+        return self.key_rule(key).points_possible
+
+    def calculate_from_marks(self, keys):
+        ''' (value, substitution) for every key, like Aggregate.mean '''
+        keys = set(keys)
+        if not keys:
+            return {}
+        marks = dict((key, {}) for key in keys)
+        for student_id, course_section_id, category_id, marking_period_id, item_id, mark, points_possible in Mark.objects.filter(
+                student__in=set(key[0] for key in keys),
+                item__course_section__in=set(key[1] for key in keys),
+                item__category__in=set(key[2] for key in keys),
+                item__marking_period__in=set(key[3] for key in keys),
+                ).exclude(mark=None).exclude(item__points_possible=None).values_list(
+                'student', 'item__course_section', 'item__category', 'item__marking_period',
+                'item', 'mark', 'item__points_possible'):
+            key = (student_id, course_section_id, category_id, marking_period_id)
+            if key in marks:
+                marks[key].setdefault(item_id, (points_possible, []))[1].append(mark)
+        results = {}
+        for key, item_marks in marks.items():
+            category = self.get_category(key[2])
+            values = []
+            for points_possible, item_mark_list in item_marks.values():
+                if category.allow_multiple_demonstrations:
+                    item_mark_list = [AGGREGATION_METHODS[category.demonstration_aggregation_method](item_mark_list)]
+                for mark in item_mark_list:
+                    calculate_as, display_as = self.substitute(key, mark)
+                    values.append((calculate_as, display_as, points_possible))
+            if not values:
+                results[key] = (None, None)
+                continue
+            marks_list, display_as, points_possible = zip(*values)
+            display_as = self.aggregates[key]._e_pluribus_unum(display_as)
+            total_points_possible = sum(points_possible)
+            if total_points_possible:
+                results[key] = (Decimal(sum(marks_list) / total_points_possible) * self.fallback_points_possible(key), display_as)
+            else:
+                results[key] = (None, display_as)
+        return results
+
+    def calculate_from_children(self, keys, calculated):
+        ''' (value, substitution) for every key, like Aggregate.calculate '''
+        children = dict((key, self.children(key)) for key in keys)
+        values = {}
+        fallback = []
+        for key_children in children.values():
+            for child, weight in key_children:
+                if child in calculated:
+                    values[child] = calculated[child]
+                elif child in self.aggregates:
+                    aggregate = self.aggregates[child]
+                    values[child] = (aggregate._really_get('cached_value'), aggregate.cached_substitution)
+                else:
+                    values[child] = (None, None)
+                if values[child][0] is None and key_kind(child) == SECTION_MARKING_PERIOD:
+                    fallback.append(child)
+        if fallback:
+            # Same fallback as Aggregate.__getattribute__, for every key at once
+            grades = {}
+            for student_id, course_section_id, marking_period_id, grade in Grade.objects.filter(
+                    student__in=set(key[0] for key in fallback),
+                    course_section__in=set(key[1] for key in fallback),
+                    marking_period__in=set(key[3] for key in fallback)).values_list(
+                    'student', 'course_section', 'marking_period', 'grade'):
+                grades.setdefault((student_id, course_section_id, None, marking_period_id), grade)
+            for child in fallback:
+                values[child] = (grades.get(child), values[child][1])
+        results = {}
+        for key, key_children in children.items():
+            numerator = denominator = Decimal(0)
+            substitution = None
+            for child, weight in key_children:
+                value, child_substitution = values[child]
+                if value is not None:
+                    numerator += weight * value
+                    denominator += weight
+                    if child_substitution is not None:
+                        # Allow substitutions to bubble up,
+                        # e.g. INC on one Item yields INC on the whole Category and CourseSection
+                        substitution = child_substitution
+            results[key] = (numerator / denominator if denominator else None, substitution)
+        return results
+
+    def save(self, results):
+        ''' Save the calculated values that changed, with one update per
+        distinct value where saving has no side effects '''
+        updates = {}
+        for key, (value, substitution) in results.items():
+            aggregate = self.aggregates[key]
+            stored = value.quantize(Decimal('0.01')) if value is not None else None
+            changed = (aggregate._really_get('cached_value'), aggregate.cached_substitution) != (stored, substitution)
+            if key_kind(key) in COPIED_TO_GRADES:
+                if changed:
+                    aggregate.cached_value = value
+                    aggregate.cached_substitution = substitution
+                    aggregate.save()
+                continue
+            if changed:
+                updates.setdefault((stored, substitution), []).append(aggregate.pk)
+            aggregate.cached_value = value
+            aggregate.cached_substitution = substitution
+        for (value, substitution), pks in updates.items():
+            Aggregate.objects.filter(pk__in=pks).update(cached_value=value, cached_substitution=substitution)
+
+    def recalculate(self, keys, recalculate_all=False):
+        ''' Calculate keys and everything that depends on them, level by level.
+        Returns the Aggregates by key. '''
+        calculated = {}
+        levels = self.plan(keys, recalculate_all)
+        self.create_missing(key for level in levels for key in level)
+        for level in levels:
+            from_marks = [key for key in level if key_kind(key) == SECTION_CATEGORY_MARKING_PERIOD]
+            results = self.calculate_from_marks(from_marks)
+            results.update(self.calculate_from_children(
+                [key for key in level if key_kind(key) != SECTION_CATEGORY_MARKING_PERIOD], calculated))
+            self.save(results)
+            calculated.update(results)
+        return dict((key, self.aggregates[key]) for key in calculated)
+
+
+def recalculate_aggregates(keys, recalculate_all=False):
+    ''' Recalculate the Aggregates for keys and everything that depends on
+    them now. Returns the Aggregates by key. '''
+    keys = [tuple(key) for key in keys]
+    with deferred_invalidation():
+        return AggregateGraph(keys).recalculate(keys, recalculate_all)
+
+
+def schedule_rule_recalculation(rule):
+    ''' Recalculate every Aggregate of the school years a calculation rule
+    applies to in celery tasks, after the rule changed '''
+    start_date = rule.first_year_effective.start_date
+    years = SchoolYear.objects.filter(start_date__gte=start_date)
+    later_rule = CalculationRule.objects.filter(
+        first_year_effective__start_date__gt=start_date).order_by('first_year_effective__start_date').first()
+    if later_rule is not None:
+        years = years.filter(start_date__lt=later_rule.first_year_effective.start_date)
+    # Recalculating the Aggregates calculated from marks recalculates the rest
+    return schedule_recalculation(Aggregate.objects.filter(
+        marking_period__school_year__in=years, course_section__isnull=False, category__isnull=False,
+        ).values_list('student', 'course_section', 'category', 'marking_period'))
+
+
+def schedule_recalculation(keys):
+    ''' Flag the Aggregates that depend on keys and recalculate them in
+    celery tasks. Returns the flagged Aggregates. '''
+    from ecwsp.benchmark_grade.tasks import benchmark_recalculate_task
+    keys = set(tuple(key) for key in keys)
+    if not keys:
+        return []
+    graph = AggregateGraph(keys)
+    graph.load_aggregates()
+    students_per_task = max(getattr(settings, 'BENCHMARK_RECALCULATION_STUDENTS_PER_TASK', 25), 1)
+    student_ids = sorted(set(key[0] for key in keys))
+    aggregates = []
+    for i in range(0, len(student_ids), students_per_task):
+        chunk_student_ids = set(student_ids[i:i + students_per_task])
+        chunk_keys = [key for key in keys if key[0] in chunk_student_ids]
+        chunk_aggregates = [graph.aggregates[key] for key in graph.dirty(chunk_keys) if key in graph.aggregates]
+        # flag aggregates that are being recalculated
+        task_id = celery.utils.uuid()
+        AggregateTask.objects.bulk_create([
+            AggregateTask(aggregate=aggregate, task_id=task_id) for aggregate in chunk_aggregates])
+        benchmark_recalculate_task.apply_async((chunk_keys,), task_id=task_id)
+        aggregates += chunk_aggregates
+    return aggregates
@@ -10,6 +10,7 @@ from ecwsp.work_study.models import StudentWorker
 from ecwsp.sis.uno_report import uno_save
 from ecwsp.schedule.models import MarkingPeriod, CourseSection
 from ecwsp.grades.models import StudentMarkingPeriodGrade
+from ecwsp.sis.report_data import ReportLookups
 from ecwsp.benchmark_grade.models import (
     Category, Item, Aggregate, Demonstration, CalculationRulePerCourseCategory)
 from ecwsp.benchmark_grade.utility import benchmark_find_calculation_rule, gradebook_get_average
@@ -44,7 +45,9 @@ def draw_gauge(percentage, width=10, filled_char=u'█', empty_char=u'░'):
     return output
 
 
-def get_benchmark_report_card_data(report_context, appy_context, students):
+def get_benchmark_report_card_data(report_context, appy_context, students, lookups=None):
+    """ lookups: the report's ReportLookups, so chunks of the same report
+    share marking periods and calculation rule settings """
     PASSING_GRADE = 3 # TODO: pull config value. Roche has it set to something crazy now and I don't want to deal with it
     data = appy_context
     for_date = report_context['date_end']
@@ -56,6 +59,22 @@ def get_benchmark_report_card_data(report_context, appy_context, students):
                                                   start_date__lt=for_date,
                                                   show_reports=True)
     marking_period = attendance_marking_periods.order_by('-start_date')[0]
+    attendance_marking_periods = list(attendance_marking_periods.order_by('start_date'))
+    if lookups is None:
+        lookups = ReportLookups()
+
+    def category_weight(category_id, department_id):
+        try:
+            weight = calculation_rule.per_course_category_set.get(
+                category=category_id, apply_to_departments=department_id).weight * Decimal(100)
+        except CalculationRulePerCourseCategory.DoesNotExist:
+            weight = Decimal(0)
+        return weight.quantize(Decimal('0'), ROUND_HALF_UP)
+
+    def flags_missing(department_id):
+        return calculation_rule.substitution_set.filter(
+            apply_to_departments=department_id, flag_visually=True).exists()
+
     for student in students:
         # Backwards compatibility for existing templates
         student.fname = student.first_name
@@ -65,22 +84,26 @@ def get_benchmark_report_card_data(report_context, appy_context, students):
             courseenrollment__user=student,
             course__graded=True,
             marking_period__school_year=school_year,
-        ).distinct().order_by('course__department')
+        ).distinct().order_by('course__department').select_related('course')
         student.course_sections = []
         student.count_total_by_category_name = {}
         student.count_missing_by_category_name = {}
         student.count_passing_by_category_name = {}
         for course_section in student.year_course_sections:
             course_section.average = gradebook_get_average(student, course_section, None, marking_period, None, omit_substitutions = omit_substitutions)
-            course_section.current_marking_periods = course_section.marking_period.filter(start_date__lt=for_date).order_by('start_date')
+            department_id = course_section.course.department_id
+            section_marking_periods = lookups.section_marking_periods(course_section)
+            # copies, since attributes are set on them for this student
+            course_section.current_marking_periods = [
+                copy.copy(course_section_marking_period)
+                for course_section_marking_period in section_marking_periods
+                if course_section_marking_period.start_date < for_date]
             course_section.categories = Category.objects.filter(item__course_section=course_section, item__mark__student=student).distinct()
             course_section.category_by_name = {}
             for category in course_section.categories:
-                try:
-                    category.weight_percentage = calculation_rule.per_course_category_set.get(category=category, apply_to_departments=course_section.department).weight * Decimal(100)
-                except CalculationRulePerCourseCategory.DoesNotExist:
-                    category.weight_percentage = Decimal(0)
-                category.weight_percentage = category.weight_percentage.quantize(Decimal('0'), ROUND_HALF_UP)
+                category.weight_percentage = lookups.get(
+                    ('category_weight', calculation_rule.id, category.id, department_id),
+                    category_weight, category.id, department_id)
                 category.overall_count_total = 0
                 category.overall_count_missing = 0
                 category.overall_count_passing = 0
@@ -95,7 +118,7 @@ def get_benchmark_report_card_data(report_context, appy_context, students):
                         course_section_marking_period.category.count_percentage = (Decimal(course_section_marking_period.category.count_passing) / course_section_marking_period.category.count_total * 100).quantize(Decimal('0', ROUND_HALF_UP))
 
                     # TODO: We assume here that flagging something visually means it's "missing." This should be done in a better way that's not opaque to users.
-                    if not calculation_rule.substitution_set.filter(apply_to_departments=course_section.department, flag_visually=True).exists():
+                    if not lookups.get(('flags_missing', calculation_rule.id, department_id), flags_missing, department_id):
                         course_section_marking_period.category.count_passing = course_section_marking_period.category.count_total
                         course_section_marking_period.category.count_missing = 0
                         course_section_marking_period.category.count_percentage = 100
@@ -129,7 +152,7 @@ def get_benchmark_report_card_data(report_context, appy_context, students):
 
             # some components of report need access to course sections for entire year (student.year_course_sections)
             # but we must keep student.course_sections restricted to the current marking period for compatibility
-            if marking_period in course_section.marking_period.all():
+            if marking_period in section_marking_periods:
                 student.course_sections.append(course_section)
 
         student.count_percentage_by_category_name = {}
@@ -154,7 +177,7 @@ def get_benchmark_report_card_data(report_context, appy_context, students):
         student.tardy_total = 0
         student.dismissed_total = 0
         student.attendance_marking_periods = []
-        for mp in attendance_marking_periods.order_by('start_date'):
+        for mp in attendance_marking_periods:
             absent = student.student_attn.filter(status__absent=True, date__range=(mp.start_date, mp.end_date)).count()
             tardy = student.student_attn.filter(status__tardy=True, date__range=(mp.start_date, mp.end_date)).count()
             dismissed = student.student_attn.filter(status__code="D", date__range=(mp.start_date, mp.end_date)).count()
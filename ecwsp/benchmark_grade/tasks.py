@@ -1,5 +1,6 @@
 from django_sis.celery import app
 from models import AggregateTask
+from ecwsp.grades.models import deferred_invalidation
 from django.db import IntegrityError
 from django_sis.celery import app
 import logging
@@ -14,18 +15,30 @@ def benchmark_aggregate_task(functions_and_arguments): #, affected_aggregates=()
     #    except IntegrityError as e:
     #        logging.warning('We are calculating {} ({}) multiple times!'.format(aggregate, aggregate.pk), exc_info=True)
 
-    # do the work
-    for triplet in functions_and_arguments:
-        function = triplet[0] # can't do much without this!
-        try: args = triplet[1]
-        except IndexError: args = () # okay, use empty tuple
-        try: kwargs = triplet[2]
-        except IndexError: kwargs = {} # okay, use empty dict
-        #print 'celery calling {}({}, {})'.format(function, args, kwargs)
-        function(*args, **kwargs)
+    # do the work, invalidating grade caches once at the end
+    with deferred_invalidation():
+        for triplet in functions_and_arguments:
+            function = triplet[0] # can't do much without this!
+            try: args = triplet[1]
+            except IndexError: args = () # okay, use empty tuple
+            try: kwargs = triplet[2]
+            except IndexError: kwargs = {} # okay, use empty dict
+            #print 'celery calling {}({}, {})'.format(function, args, kwargs)
+            function(*args, **kwargs)
     # remove flags
     goodbye = AggregateTask.objects.filter(task_id=benchmark_aggregate_task.request.id)
     aggregate_count = goodbye.count()
     goodbye.delete()
     # the return value appears in the log, so write something legible
     return "{} functions; {} Aggregates".format(len(functions_and_arguments), aggregate_count)
+
+@app.task
+def benchmark_recalculate_task(keys):
+    """ Recalculate the Aggregates for keys and everything that depends on
+    them, see ecwsp.benchmark_grade.recalculation """
+    from ecwsp.benchmark_grade.recalculation import recalculate_aggregates
+    aggregates = recalculate_aggregates(keys)
+    # remove flags
+    goodbye = AggregateTask.objects.filter(task_id=benchmark_recalculate_task.request.id)
+    goodbye.delete()
+    return "{} keys; {} Aggregates".format(len(keys), len(aggregates))
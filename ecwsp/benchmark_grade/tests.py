@@ -4,10 +4,15 @@ from ecwsp.schedule.models import (
     Department, DepartmentGraduationCredits, CourseSection, MarkingPeriod)
 from .models import *
 from .sample_data import BenchmarkSisData
+from ecwsp.sis.models import Student
 
 from ecwsp.sis.sample_tc_data import SampleTCData
 from ecwsp.grades.tasks import build_grade_cache
-from ecwsp.benchmark_grade.utility import gradebook_get_average_and_pk, benchmark_calculate_course_aggregate
+from ecwsp.benchmark_grade.utility import gradebook_get_average_and_pk, benchmark_calculate_course_aggregate, GradebookLoader, benchmark_find_calculation_rule
+from ecwsp.benchmark_grade.recalculation import AggregateGraph, recalculate_aggregates
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django_sis.celery import app
 from decimal import Decimal
 
 import unittest
@@ -116,7 +121,98 @@ class TwinCitiesGradeCalculationTests(SisTestMixin, TestCase):
 
         
 
-
-
-
-
+    def test_gradebook_loader(self):
+        """ the loader finds the same marks and averages as the per student
+        helpers and creates missing marks for the other students """
+        grade = self.get_benchmark_grade()
+        students = Student.objects.filter(courseenrollment__course_section=self.course_section)
+        loader = GradebookLoader(
+            self.course_section,
+            benchmark_find_calculation_rule(self.marking_period.school_year),
+            students,
+            Item.objects.filter(course_section=self.course_section))
+        loader.load_marks()
+        loader.load_averages('average', marking_period=self.marking_period)
+        self.assertEqual(Mark.objects.filter(item__course_section=self.course_section).count(),
+            len(loader.students) * len(loader.items))
+        for student in loader.students:
+            self.assertEqual([mark.item for mark in student.marks], loader.items)
+            if student == self.student:
+                self.assertEqual([mark.mark for mark in student.marks],
+                    [Decimal('4.0'), Decimal('3.0'), Decimal('2.5'), Decimal('3.5')])
+                self.assertEqual(student.average, grade)
+            else:
+                self.assertEqual([mark.mark for mark in student.marks], [None] * 4)
+
+    def load_gradebook(self, students):
+        """ Everything the gradebook view loads for students """
+        loader = GradebookLoader(
+            self.course_section,
+            benchmark_find_calculation_rule(self.marking_period.school_year),
+            students,
+            Item.objects.filter(course_section=self.course_section))
+        loader.load_marks()
+        loader.load_averages('average')
+        loader.load_averages('filtered_average', marking_period=self.marking_period)
+        loader.load_standards_counts(Category.objects.get(name='Standards'), 3, filtered=True)
+        loader.load_class_averages()
+        loader.category_flag_criteria()
+        return loader
+
+    def test_gradebook_loader_query_count(self):
+        """ loading the gradebook takes the same queries for any number of
+        students and doesn't write once the averages are stored """
+        students = Student.objects.filter(courseenrollment__course_section=self.course_section)
+        self.assertTrue(students.count() > 2)
+        self.load_gradebook(students)
+        # A student with marks and one without
+        two_students = students.filter(id__in=[
+            self.student.id, students.exclude(id=self.student.id)[0].id])
+        with CaptureQueriesContext(connection) as two_students_queries:
+            self.load_gradebook(two_students)
+        with self.assertNumQueries(len(two_students_queries)):
+            self.load_gradebook(students)
+        self.assertFalse([query for query in two_students_queries.captured_queries
+                          if not query['sql'].lstrip().upper().startswith('SELECT')])
+
+    def test_gradebook_loader_rule_change(self):
+        """ stored averages are recalculated when the calculation rule changes """
+        def load_average():
+            loader = self.load_gradebook(Student.objects.filter(id=self.student.id))
+            return loader.students[0].filtered_average
+        self.assertEqual(load_average(), Decimal('3.70'))
+        eager = app.conf.CELERY_ALWAYS_EAGER
+        app.conf.CELERY_ALWAYS_EAGER = True
+        try:
+            self.data.create_new_category_and_adjust_all_category_weights()
+            # The weights are changed with update(), which sends no signal
+            CalculationRulePerCourseCategory.objects.get(category__name="Standards").save()
+        finally:
+            app.conf.CELERY_ALWAYS_EAGER = eager
+        self.assertEqual(load_average(), Decimal('3.74'))
+        self.assertEqual(self.get_benchmark_grade(), Decimal('3.74'))
+
+    def test_recalculate_aggregates(self):
+        """ the dependency graph recalculates what depends on a changed mark
+        and agrees with Aggregate.calculate """
+        self.assertEqual(self.get_benchmark_grade(), Decimal('3.70'))
+        item = Item.objects.get(name="Assignment1")
+        mark = Mark.objects.get(item=item, student=self.student)
+        mark.mark = 2.0
+        mark.save()
+        key = (self.student.pk, self.course_section.pk, item.category_id, self.marking_period.pk)
+        course_key = (self.student.pk, self.course_section.pk, None, self.marking_period.pk)
+        section_key = (self.student.pk, self.course_section.pk, None, None)
+        levels = AggregateGraph([key]).plan([key])
+        self.assertIn(key, levels[0])
+        self.assertIn(course_key, levels[1])
+        self.assertEqual(levels[-1], [section_key])
+
+        aggregates = recalculate_aggregates([key])
+        self.assertIn(course_key, aggregates)
+        self.assertIn(section_key, aggregates)
+        self.assertEqual(self.get_benchmark_grade(), Decimal('2.30'))
+        Aggregate.objects.get(
+            student=self.student, course_section=self.course_section,
+            category=None, marking_period=self.marking_period).calculate(recalculate_all=True)
+        self.assertEqual(self.get_benchmark_grade(), Decimal('2.30'))
@@ -16,16 +16,14 @@
 #   Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
 #   MA 02110-1301, USA.
 
-from ecwsp.benchmark_grade.models import CalculationRule, Aggregate, Item, Mark, Category, AggregateTask, CalculationRulePerCourseCategory
+from ecwsp.benchmark_grade.models import CalculationRule, Aggregate, Item, Mark, Category, CalculationRulePerCourseCategory, Demonstration
 from ecwsp.benchmark_grade.models import benchmark_get_or_flush, benchmark_get_create_or_flush
 from ecwsp.schedule.models import MarkingPeriod, Department, CourseSection
 from ecwsp.sis.models import Student
-from ecwsp.benchmark_grade.tasks import benchmark_aggregate_task
+from ecwsp.benchmark_grade.recalculation import recalculate_aggregates, schedule_recalculation
 from ecwsp.grades.models import Grade
-from django.db.models import Avg, Sum, Min, Max
-import logging
+from django.db.models import Avg, Sum, Min, Max, Count, Prefetch
 from decimal import Decimal, ROUND_HALF_UP
-import celery.utils
 
 def benchmark_find_calculation_rule(school_year):
     rules = CalculationRule.objects.filter(first_year_effective=school_year)
@@ -211,26 +209,17 @@ def gradebook_recalculate_on_item_change(item, students=None, old_item=None):
         assignment_type - does not affect calculations
         benchmark - does not affect calculations
     '''
-    categories = set((item.category,)) 
-    marking_periods = set((item.marking_period,))
+    changes = set(((item.category_id, item.marking_period_id),))
     renormalization_required = False
-    parting_calculation_required = False
     if old_item:
         if old_item.course_section != item.course_section:
             raise Exception('Items must not move between course sections.')
         # proceed only if the change affects calculations
         if old_item.points_possible != item.points_possible:
             renormalization_required = True
-        if old_item.category != item.category:
-            # necessary to recalculate the old category as well as the new
-            parting_calculation_required = True
-            categories.add(old_item.category)
-        if old_item.marking_period != item.marking_period:
-            # necessary to recalculate the old marking period as well as the new
-            parting_calculation_required = True
-            marking_periods.add(old_item.marking_period)
-
-    calculation_rule = benchmark_find_calculation_rule(item.course_section.marking_period.all()[0].school_year)
+        # necessary to recalculate the old category and marking period as well as the new
+        changes.add((old_item.category_id, old_item.marking_period_id))
+
     course_section = item.course_section
     if students is None:
         students = Student.objects.filter(courseenrollment__course_section=item.course_section)
@@ -241,58 +230,23 @@ def gradebook_recalculate_on_item_change(item, students=None, old_item=None):
             mark.save()
 
     # do other calculations in the background
-    funcs_and_args = []
-    aggregates = [] # list of aggregates to be affected by background calculations
-
-    for student in students:
-        # recalculate the aggregate for the item's course_section, category, and marking period
-        funcs_and_args.append((benchmark_calculate_course_category_aggregate, (student, course_section, item.category, item.marking_period)))
-        aggregates += Aggregate.objects.filter(student=student, course_section=course_section, category=item.category, marking_period=item.marking_period)
-        if parting_calculation_required:
-            # the item was previously in another category or marking period, which now also must be recalculated
-            funcs_and_args.append((benchmark_calculate_course_category_aggregate, (student, course_section, old_item.category, old_item.marking_period)))
-            aggregates += Aggregate.objects.filter(student=student, course_section=course_section, category=old_item.category, marking_period=old_item.marking_period)
-        # recalculate the course-section-long (i.e. marking_period=None) aggregate for each affected category
-        for category in categories:
-            funcs_and_args.append((benchmark_calculate_course_category_aggregate, (student, course_section, category, None)))
-            aggregates += Aggregate.objects.filter(student=student, course_section=course_section, category=category, marking_period=None)
-
-    affects_overall_course_section = 0 < calculation_rule.per_course_category_set.filter(category__in=categories, apply_to_departments=course_section.department).count()
-    affected_categories_as_courses = calculation_rule.category_as_course_set.filter(category__in=categories, include_departments=course_section.department)
-    for student in students:
-        # recalculate aggregates for affected marking periods
-        for marking_period in marking_periods:
-            if affects_overall_course_section:
-                funcs_and_args.append((benchmark_calculate_course_aggregate, (student, course_section, marking_period)))
-                aggregates += Aggregate.objects.filter(student=student, course_section=course_section, marking_period=marking_period, category=None)
-            for category_as_course in affected_categories_as_courses:
-                funcs_and_args.append((benchmark_calculate_category_as_course_aggregate, (student, category_as_course.category, marking_period)))
-                aggregates += Aggregate.objects.filter(student=student, category=category_as_course.category, marking_period=marking_period, course_section=None)
-        # recalculate aggregates for the whole duration of the course section(i.e. marking_period=None)
-        if affects_overall_course_section:
-            funcs_and_args.append((benchmark_calculate_course_aggregate, (student, course_section, None)))
-            aggregates += Aggregate.objects.filter(student=student, course_section=course_section, marking_period=None, category=None)
-
-    if len(funcs_and_args):
-        # flag aggregates that are being recalculated
-        task_id = celery.utils.uuid()
-        for aggregate in aggregates:
-            aggregate_task = AggregateTask(aggregate=aggregate, task_id=task_id)
-            try:
-                aggregate_task.save()
-            except IntegrityError as e:
-                logging.warning('We are calculating {} ({}) multiple times!'.format(aggregate, aggregate.pk), exc_info=True)
-        # queue a task with our predetermined uuid
-        task = benchmark_aggregate_task.apply_async((funcs_and_args,), task_id=task_id)
-        return aggregates
+    return schedule_recalculation(
+        (student.pk, course_section.pk, category_id, marking_period_id)
+        for student in students for category_id, marking_period_id in changes)
+
+def gradebook_recalculate_on_marks_change(marks):
+    ''' Recalculate everything affected by marks in as few tasks as possible '''
+    return schedule_recalculation(
+        (mark.student_id, mark.item.course_section_id, mark.item.category_id, mark.item.marking_period_id)
+        for mark in marks)
 
 def gradebook_recalculate_on_mark_change(mark):
-    return gradebook_recalculate_on_item_change(mark.item, (mark.student, ))
+    return gradebook_recalculate_on_marks_change((mark,))
 
 def gradebook_get_average(*args, **kwargs):
     return gradebook_get_average_and_pk(*args, **kwargs)[0]
 
-def gradebook_get_average_and_pk(student, course_section, category=None, marking_period=None, items=None, omit_substitutions=False):
+def gradebook_get_aggregate(student, course_section, category=None, marking_period=None, items=None):
     try:
         if items is not None: # averages of one-off sets of items aren't saved and must be calculated every time
             # this is rather silly, but it avoids code duplication or a teensy four-line function.
@@ -303,18 +257,29 @@ def gradebook_get_average_and_pk(student, course_section, category=None, marking
             agg, created = benchmark_calculate_course_aggregate(student, course_section, marking_period, items)
         else:
             agg, created = benchmark_calculate_course_category_aggregate(student, course_section, category, marking_period, items)
+    return agg
+
+def gradebook_format_average(agg, value, category, calculation_rule, omit_substitutions=False):
+    ''' How the gradebook shows agg, whose cached value is value '''
     if not omit_substitutions and agg.cached_substitution is not None:
-        return agg.cached_substitution, agg.pk
-    elif agg.cached_value is not None:
-        calculation_rule = benchmark_find_calculation_rule(course_section.marking_period.all()[0].school_year)
+        return agg.cached_substitution
+    elif value is not None:
         if category is not None and category.display_scale is not None:
-            pretty = agg.cached_value / agg._fallback_points_possible() * category.display_scale
+            pretty = value / agg._fallback_points_possible() * category.display_scale
             pretty = '{}{}'.format(pretty.quantize(Decimal(10) ** (-1 * calculation_rule.decimal_places), ROUND_HALF_UP), category.display_symbol)
         else:
-            pretty = agg.cached_value.quantize(Decimal(10) ** (-1 * calculation_rule.decimal_places), ROUND_HALF_UP)
-        return pretty, agg.pk
+            pretty = value.quantize(Decimal(10) ** (-1 * calculation_rule.decimal_places), ROUND_HALF_UP)
+        return pretty
     else:
-        return None, agg.pk
+        return None
+
+def gradebook_get_average_and_pk(student, course_section, category=None, marking_period=None, items=None, omit_substitutions=False):
+    agg = gradebook_get_aggregate(student, course_section, category, marking_period, items)
+    value = agg.cached_value
+    calculation_rule = None
+    if value is not None:
+        calculation_rule = benchmark_find_calculation_rule(course_section.marking_period.all()[0].school_year)
+    return gradebook_format_average(agg, value, category, calculation_rule, omit_substitutions), agg.pk
 
 def gradebook_get_category_average(student, category, marking_period):
     try:
@@ -333,3 +298,206 @@ def gradebook_get_category_average(student, category, marking_period):
         return pretty
     else:
         return None
+
+def gradebook_count_text(passing, total):
+    if total:
+        return '{} / {} ({:.0f}%)'.format(passing, total, 100.0 * passing / total)
+    return None
+
+class GradebookLoader(object):
+    ''' Loads everything the gradebook shows for a course section with a few
+    grouped queries, instead of several for every student and item. The
+    results are set as attributes on the students and items, which are lists
+    so the template sees the same objects. '''
+    def __init__(self, course_section, calculation_rule, students, items):
+        self.course_section = course_section
+        self.calculation_rule = calculation_rule
+        self.students = list(students)
+        self.items = list(items.order_by('id').select_related(
+            'category', 'marking_period', 'assignment_type', 'benchmark',
+        ).prefetch_related(
+            Prefetch('demonstration_set', queryset=Demonstration.objects.order_by('id')),
+        ))
+        self.student_ids = [student.pk for student in self.students]
+        self.item_ids = [item.pk for item in self.items]
+
+    def columns(self):
+        ''' (item, demonstration) for every gradebook column, in order '''
+        for item in self.items:
+            demonstrations = item.demonstration_set.all()
+            if demonstrations:
+                for demonstration in demonstrations:
+                    yield item, demonstration
+            else:
+                yield item, None
+
+    def get_marks(self, allow_duplicates=False):
+        marks = {}
+        for mark in Mark.objects.filter(item__in=self.item_ids, student__in=self.student_ids).order_by('id'):
+            key = (mark.student_id, mark.item_id, mark.demonstration_id)
+            if key in marks:
+                if not allow_duplicates:
+                    raise Exception('Multiple marks per student per item.')
+                continue
+            marks[key] = mark
+        return marks
+
+    def load_marks(self, allow_duplicates=False):
+        ''' Set student.marks to the student's mark for every column. Missing
+        marks are created, e.g. when the student enrolled after the items were
+        created. '''
+        marks = self.get_marks(allow_duplicates)
+        missing = []
+        for student in self.students:
+            for item in self.items:
+                keys = [(item.pk, demonstration.pk) for demonstration in item.demonstration_set.all()]
+                # Items with demonstrations need one extra mark to store their aggregate
+                keys.append((item.pk, None))
+                for item_id, demonstration_id in keys:
+                    if (student.pk, item_id, demonstration_id) not in marks:
+                        missing.append(Mark(student_id=student.pk, item_id=item_id, demonstration_id=demonstration_id))
+        if missing:
+            Mark.objects.bulk_create(missing)
+            marks = self.get_marks(allow_duplicates)
+        for student in self.students:
+            student.marks = []
+            for item, demonstration in self.columns():
+                mark = marks[(student.pk, item.pk, demonstration.pk if demonstration else None)]
+                mark.item = item
+                mark.category_id = item.category_id
+                student.marks.append(mark)
+
+    def load_averages(self, attribute, category=None, marking_period=None, items=None):
+        ''' Set student.<attribute> and student.<attribute>_pk like
+        gradebook_get_average_and_pk does for every student. Stored averages
+        are kept current by recalculating them when marks, items or the
+        calculation rule change; missing ones are calculated together here.
+        Returns the sum and count of the averages' values. '''
+        category_id = category.pk if category is not None else None
+        marking_period_id = marking_period.pk if marking_period is not None else None
+        aggregates = {}
+        if items is None and self.students:
+            found = {}
+            for agg in Aggregate.objects.filter(
+                    student__in=self.student_ids, course_section=self.course_section,
+                    category=category, marking_period=marking_period):
+                found.setdefault(agg.student_id, []).append(agg)
+            aggregates = dict(
+                ((student_id, self.course_section.pk, category_id, marking_period_id), student_aggregates[0])
+                for student_id, student_aggregates in found.items() if len(student_aggregates) == 1)
+            # Missing or duplicated
+            missing = [(student.pk, self.course_section.pk, category_id, marking_period_id)
+                       for student in self.students if len(found.get(student.pk, ())) != 1]
+            if missing:
+                aggregates.update(recalculate_aggregates(missing))
+        grades = None
+        total = Decimal(0)
+        count = 0
+        for student in self.students:
+            agg = aggregates.get((student.pk, self.course_section.pk, category_id, marking_period_id))
+            if agg is not None:
+                if category is not None:
+                    agg.category = category
+                value = agg._really_get('cached_value')
+                if value is None and category is None and marking_period is not None:
+                    # Same fallback as Aggregate.__getattribute__, for every student at once
+                    if grades is None:
+                        grades = dict(Grade.objects.filter(
+                            student__in=self.student_ids, course_section=self.course_section,
+                            marking_period=marking_period).values_list('student_id', 'grade'))
+                    value = grades.get(student.pk)
+            else:
+                # For a one-off set of items
+                agg = gradebook_get_aggregate(student, self.course_section, category, marking_period, items)
+                value = agg.cached_value
+            average = gradebook_format_average(agg, value, category, self.calculation_rule)
+            setattr(student, attribute, average)
+            setattr(student, attribute + '_pk', agg.pk)
+            if average is not None and value is not None:
+                total += value
+                count += 1
+        return total, count
+
+    def load_standards_counts(self, standards_category, passing_grade, filtered=False):
+        ''' Set the passing / total standards counts on every student and on
+        the standards items. Returns the passing and total counts for all
+        standards and for the filtered ones. '''
+        filtered_item_ids = set(self.item_ids)
+        best_marks = {}
+        for row in Mark.objects.filter(
+                student__in=self.student_ids, item__course_section=self.course_section,
+                item__category=standards_category).values('student', 'item').annotate(best_mark=Max('mark')):
+            if row['best_mark'] is not None:
+                best_marks.setdefault(row['student'], []).append((row['item'], row['best_mark']))
+        counts = [0, 0, 0, 0]
+        for student in self.students:
+            student_marks = best_marks.get(student.pk, ())
+            passing = len([1 for item_id, mark in student_marks if mark >= passing_grade])
+            student.standards_counts = gradebook_count_text(passing, len(student_marks))
+            counts[0] += passing
+            counts[1] += len(student_marks)
+            if filtered:
+                student_marks = [(item_id, mark) for item_id, mark in student_marks if item_id in filtered_item_ids]
+                passing = len([1 for item_id, mark in student_marks if mark >= passing_grade])
+                student.filtered_standards_counts = gradebook_count_text(passing, len(student_marks))
+                counts[2] += passing
+                counts[3] += len(student_marks)
+
+        standards_items = dict((item.pk, item) for item in self.items if item.category_id == standards_category.pk)
+        item_marks = dict((item_id, []) for item_id in standards_items)
+        for item_id, demonstration_id, mark in Mark.objects.filter(
+                item__in=standards_items.keys()).exclude(mark=None).values_list('item', 'demonstration', 'mark'):
+            if (demonstration_id is None) != standards_items[item_id].category.allow_multiple_demonstrations:
+                item_marks[item_id].append(mark)
+        for item in self.items:
+            if item.pk in standards_items:
+                marks = item_marks[item.pk]
+                item.marks_counts = gradebook_count_text(
+                    len([1 for mark in marks if mark >= passing_grade]), len(marks))
+            else:
+                item.marks_counts = 'N/A'
+        return counts
+
+    def load_class_averages(self):
+        ''' Set class_average on every item and demonstration, and
+        demonstration_list on every item '''
+        quantizer = Decimal(10) ** (-1 * self.calculation_rule.decimal_places)
+        sums = {}
+        for row in Mark.objects.filter(item__in=self.item_ids).values(
+                'item', 'demonstration').annotate(mark_sum=Sum('mark'), mark_count=Count('mark')):
+            sums[(row['item'], row['demonstration'])] = (row['mark_sum'], row['mark_count'])
+        def average(mark_sums):
+            # TODO: make sure we only count enrolled students
+            mark_sums = [(mark_sum, mark_count) for mark_sum, mark_count in mark_sums if mark_count]
+            if not mark_sums:
+                return None
+            return (sum(Decimal(mark_sum) for mark_sum, mark_count in mark_sums) /
+                sum(mark_count for mark_sum, mark_count in mark_sums)).quantize(quantizer)
+        for item in self.items:
+            item.demonstration_list = list(item.demonstration_set.all())
+            for demonstration in item.demonstration_list:
+                demonstration.class_average = average([sums.get((item.pk, demonstration.pk), (None, 0))])
+            item.class_average = average(value for key, value in sums.items() if key[0] == item.pk)
+
+    def category_flag_criteria(self):
+        ''' Visual flagging criteria by category pk, as
+        (absolute criteria, criteria for marks divided by points possible) '''
+        categories = dict((item.category_id, item.category) for item in self.items)
+        absolute = {}
+        normalized = {}
+        for category in categories.values():
+            if category.fixed_points_possible:
+                # assume the criterion is absolute if the category has fixed # of points possible
+                absolute[category.pk] = []
+            else:
+                # assume we need to divide the mark by points possible before comparing to criterion
+                normalized[category.pk] = []
+        substitutions = self.calculation_rule.substitution_set.filter(
+            apply_to_departments=self.course_section.department, apply_to_categories__in=categories.keys(),
+            flag_visually=True).distinct().order_by('id').prefetch_related('apply_to_categories')
+        for substitution in substitutions:
+            for category in substitution.apply_to_categories.all():
+                criteria = absolute.get(category.pk, normalized.get(category.pk))
+                if criteria is not None:
+                    criteria.append(substitution.operator + ' ' + str(substitution.match_value))
+        return absolute, normalized
@@ -3,7 +3,7 @@ from django.contrib.auth.decorators import user_passes_test, login_required
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib import messages
 from django.http import HttpResponse, HttpResponseRedirect
-from django.db.models import Q, Max, Count, Avg
+from django.db.models import Q, Max, Count
 from django.db import transaction
 from django.template import RequestContext
 from django.core.urlresolvers import reverse
@@ -16,8 +16,8 @@ from ecwsp.administration.models import Configuration
 from ecwsp.benchmark_grade.models import Category, Mark, Aggregate, Item, Demonstration, CalculationRule, AggregateTask, CalculationRulePerCourseCategory
 from ecwsp.benchmark_grade.forms import GradebookFilterForm, ItemForm, DemonstrationForm, FillAllForm
 from ecwsp.benchmarks.models import Benchmark
-from ecwsp.benchmark_grade.utility import gradebook_get_average, gradebook_get_average_and_pk, gradebook_recalculate_on_item_change, gradebook_recalculate_on_mark_change
-from ecwsp.benchmark_grade.utility import benchmark_find_calculation_rule
+from ecwsp.benchmark_grade.utility import gradebook_get_average, gradebook_recalculate_on_item_change, gradebook_recalculate_on_mark_change, gradebook_recalculate_on_marks_change
+from ecwsp.benchmark_grade.utility import benchmark_find_calculation_rule, gradebook_count_text, GradebookLoader
 
 from decimal import Decimal
 import logging
@@ -152,127 +152,38 @@ def gradebook(request, course_section_id, for_export=False):
     pending_aggregate_pks = Aggregate.objects.filter(course_section=course_section, aggregatetask__in=AggregateTask.objects.all()).values_list('pk', flat=True).distinct()
     
     # Freeze these now in case someone else gets in here!
-    # TODO: something that actually works. all() does not evaluate a QuerySet.
-    # https://docs.djangoproject.com/en/dev/ref/models/querysets/#when-querysets-are-evaluated
-    items = items.order_by('id').all()
-    # whoa, super roll of the dice. is Item.demonstration_set really guaranteed to be ordered by id?
-    # precarious; sorting must match items (and demonstrations!) exactly
-    marks = Mark.objects.filter(item__in=items).order_by('item__id', 'demonstration__id').all() 
-    items_count = items.filter(demonstration=None).count() + Demonstration.objects.filter(item__in=items).count()
-    for student in students:
-        student_marks = marks.filter(student=student).exclude(item__category__allow_multiple_demonstrations=True, demonstration=None).select_related('item__category_id')
-        student_marks_count = student_marks.count()
-        if student_marks_count < items_count:
-            # maybe student enrolled after assignments were created
-            for item in items:
-                if len(item.demonstration_set.all()):
-                    # must create mark for each demonstration
-                    for demonstration in item.demonstration_set.all():
-                        mark, created = Mark.objects.get_or_create(item=item, demonstration=demonstration, student=student)
-                    # Create one extra with demonstration=None to store the aggregate of Demonstrations
-                    mark, created = Mark.objects.get_or_create(item=item, demonstration=None, student=student)
-                else:
-                    # a regular item without demonstrations; make only one mark
-                    mark, created = Mark.objects.get_or_create(item=item, student=student)
-        if student_marks_count > items_count:
-            # Yikes, there are multiple marks per student per item. Stop loading the gradebook now.
-            if 'dangerous' in request.GET:
-                pass
-            else:
-                raise Exception('Multiple marks per student per item.')
-        
-        for mark in student_marks:
-            mark.category_id = mark.item.category_id
-        
-        student.marks = student_marks
-        student.average, student.average_pk = gradebook_get_average_and_pk(student, course_section, None, None, None)
-        if student.average is not None:
-            totals['course_section_average'] += Aggregate.objects.get(pk=student.average_pk).cached_value # can't use a substitution
-            totals['course_section_average_count'] += 1
-        if filtered:
-            cleaned_or_initial = getattr(filter_form, 'cleaned_data', filter_form.initial)
-            filter_category = cleaned_or_initial.get('category', None)
-            filter_marking_period = cleaned_or_initial.get('marking_period', None)
-            filter_items = items if temporary_aggregate else None
-            student.filtered_average, student.filtered_average_pk = gradebook_get_average_and_pk(
-                student, course_section, filter_category, filter_marking_period, filter_items)
-            if student.filtered_average is not None:
-                totals['filtered_average'] += Aggregate.objects.get(pk=student.filtered_average_pk).cached_value # can't use a substitution
-                totals['filtered_average_count'] += 1
-        if school_year.benchmark_grade and extra_info == 'demonstrations':
-            # TC's column of counts
-            # TODO: don't hardcode
-            standards_category = Category.objects.get(name='Standards')
-            PASSING_GRADE = 3
-            standards_objects = Item.objects.filter(course_section=course_section, category=standards_category, mark__student=student).annotate(best_mark=Max('mark__mark')).exclude(best_mark=None)
-            standards_count_passing = standards_objects.filter(best_mark__gte=PASSING_GRADE).count()
-            standards_count_total = standards_objects.count()
-            totals['standards_passing'] += standards_count_passing
-            totals['standards_all'] += standards_count_total
-            if standards_count_total:
-                student.standards_counts = '{} / {} ({:.0f}%)'.format(standards_count_passing, standards_count_total, 100.0 * standards_count_passing / standards_count_total)
-            else:
-                student.standards_counts = None
-            if filtered:
-                standards_objects = items.filter(course_section=course_section, category=standards_category, mark__student=student).annotate(best_mark=Max('mark__mark')).exclude(best_mark=None)
-                standards_count_passing = standards_objects.filter(best_mark__gte=PASSING_GRADE).count()
-                standards_count_total = standards_objects.count()
-                totals['filtered_standards_passing'] += standards_count_passing
-                totals['filtered_standards_all'] += standards_count_total
-                if standards_count_total:
-                    student.filtered_standards_counts = '{} / {} ({:.0f}%)'.format(standards_count_passing, standards_count_total, 100.0 * standards_count_passing / standards_count_total)
-                else:
-                    student.filtered_standards_counts = None
-
-            # TC's row of counts
-            # TODO: don't hardcode
-            for item in items:
-                if item.category != standards_category:
-                    item.marks_counts = 'N/A'
-                    continue
-                if item.category.allow_multiple_demonstrations:
-                    mark_set = item.mark_set.exclude(demonstration=None)
-                else:
-                    mark_set = item.mark_set.filter(demonstration=None)
-                marks_count_passing = mark_set.filter(mark__gte=PASSING_GRADE).count()
-                marks_count_total = mark_set.exclude(mark=None).count()
-                if marks_count_total:
-                    item.marks_counts = '{} / {} ({:.0f}%)'.format(marks_count_passing, marks_count_total, 100.0 * marks_count_passing / marks_count_total)
-                else:
-                    item.marks_counts = None
+    # GradebookLoader lists students and items, so the template sees the values it sets on them
+    loader = GradebookLoader(course_section, calculation_rule, students, items)
+    loader.load_marks(allow_duplicates='dangerous' in request.GET)
+
+    total, count = loader.load_averages('average')
+    totals['course_section_average'] += total # can't use a substitution
+    totals['course_section_average_count'] += count
+    if filtered:
+        cleaned_or_initial = getattr(filter_form, 'cleaned_data', filter_form.initial)
+        filter_category = cleaned_or_initial.get('category', None)
+        filter_marking_period = cleaned_or_initial.get('marking_period', None)
+        filter_items = items if temporary_aggregate else None
+        total, count = loader.load_averages(
+            'filtered_average', filter_category, filter_marking_period, filter_items)
+        totals['filtered_average'] += total # can't use a substitution
+        totals['filtered_average_count'] += count
+    if school_year.benchmark_grade and extra_info == 'demonstrations' and loader.students:
+        # TC's column and row of counts
+        # TODO: don't hardcode
+        standards_category = Category.objects.get(name='Standards')
+        PASSING_GRADE = 3
+        counts = loader.load_standards_counts(standards_category, PASSING_GRADE, filtered)
+        totals['standards_passing'] += counts[0]
+        totals['standards_all'] += counts[1]
+        totals['filtered_standards_passing'] += counts[2]
+        totals['filtered_standards_all'] += counts[3]
 
     if extra_info == 'averages':
-        for item in items:
-            # listify the QuerySet now so we can modify it and use it in the template
-            # if the template just reads the DB and instantiates new objects, they will not have our class_average attribute
-            item.demonstration_list = list(item.demonstration_set.all())
-            for demonstration in item.demonstration_list:
-                # TODO: make sure we only count enrolled students
-                demonstration.class_average = demonstration.mark_set.aggregate(Avg('mark'))['mark__avg']
-                try:
-                    demonstration.class_average = Decimal(demonstration.class_average).quantize(quantizer)
-                except TypeError: # e.g. Decimal(None)
-                    pass
-            item.class_average = item.mark_set.aggregate(Avg('mark'))['mark__avg']
-            try:
-                item.class_average = Decimal(item.class_average).quantize(quantizer)
-            except TypeError: # e.g. Decimal(None)
-                pass
+        loader.load_class_averages()
 
     # Gather visual flagging criteria
-    absolute_category_flag_criteria = {}
-    normalized_category_flag_criteria = {}
-    for category in Category.objects.filter(item__in=items).distinct():
-        if category.fixed_points_possible:
-            # assume the criterion is absolute if the category has fixed # of points possible
-            use_dict = absolute_category_flag_criteria
-        else:
-            # assume we need to divide the mark by points possible before comparing to criterion
-            use_dict = normalized_category_flag_criteria
-        use_dict[category.pk] = []
-        substitutions = calculation_rule.substitution_set.filter(apply_to_departments=course_section.department, apply_to_categories=category, flag_visually=True)
-        for substitution in substitutions:
-            use_dict[category.pk].append(substitution.operator + ' ' + str(substitution.match_value))
+    absolute_category_flag_criteria, normalized_category_flag_criteria = loader.category_flag_criteria()
 
     # calculate course-section-wide averages and counts
     if totals['course_section_average_count']:
@@ -283,22 +194,15 @@ def gradebook(request, course_section_id, for_export=False):
         totals['filtered_average'] = Decimal(totals['filtered_average'] / totals['filtered_average_count']).quantize(quantizer)
     else:
         totals['filtered_average'] = None
-    if totals['standards_all']:
-        totals['standards_text'] = '{} / {} ({:.0f}%)'.format(totals['standards_passing'], totals['standards_all'],
-            100.0 * totals['standards_passing'] / totals['standards_all'])
-    else:
-        totals['standards_text'] = None
-    if totals['filtered_standards_all']:
-        totals['filtered_standards_text'] = '{} / {} ({:.0f}%)'.format(totals['filtered_standards_passing'], totals['filtered_standards_all'],
-            100.0 * totals['filtered_standards_passing'] / totals['filtered_standards_all'])
-    else:
-        totals['filtered_standards_text'] = None
+    totals['standards_text'] = gradebook_count_text(totals['standards_passing'], totals['standards_all'])
+    totals['filtered_standards_text'] = gradebook_count_text(
+        totals['filtered_standards_passing'], totals['filtered_standards_all'])
 
     data_dictionary = {
-        'items': items,
-        'item_pks': ','.join(map(str,items.values_list('pk', flat=True))),
+        'items': loader.items,
+        'item_pks': ','.join(map(str, loader.item_ids)),
         'pending_aggregate_pks': json.dumps(map(str, pending_aggregate_pks)),
-        'students': students,
+        'students': loader.students,
         'course_section': course_section,
         'teacher_course_sections': teacher_course_sections,
         'filtered' : filtered,
@@ -676,14 +580,14 @@ def ajax_get_fill_all_form(request, course_section_id, object_type, object_id):
                     make_validationerror_raiser('This {} belongs to the inactive marking period {}.'.format(object_type, marking_period))
                 )
         if form.is_valid():
-            for m in item_or_demonstration.mark_set.all():
+            marks = item_or_demonstration.mark_set.select_related('item')
+            for m in marks:
                 m.set_grade(form.cleaned_data['mark'])
                 with reversion.create_revision():
                     m.save()
                     reversion.set_user(request.user)
                     reversion.set_comment("gradebook fill all")
-                # really expensive!
-                gradebook_recalculate_on_mark_change(m)
+            gradebook_recalculate_on_marks_change(marks)
             messages.success(request, 'Marked all students {} for {}'.format(form.cleaned_data['mark'], item_or_demonstration))
             # the client will reload the whole page, so there's no need to pass a list of affected aggregate pks
             return HttpResponse('SUCCESS')
@@ -1,7 +1,7 @@
 from .python_engrade import *
 from .models import *
 from ecwsp.schedule.models import *
-from ecwsp.grades.models import Grade
+from ecwsp.grades.models import Grade, deferred_invalidation
 
 import sys
 import datetime
@@ -88,6 +88,7 @@ class EngradeSync:
             course_section_sync = course_section_sync[0]
         return course_section_sync.engrade_course_id
     
+    @deferred_invalidation()
     def sync_course_grades(self, course_section, marking_period, include_comments):
         """ Loads grades from engrade into CourseSection grades for particular marking period.
         Returns: list of errors """
@@ -1,8 +1,31 @@
 from rest_framework import viewsets
-from .serializers import AssignmentSerializer
-from .models import Assignment
+from rest_framework.permissions import IsAdminUser
+from ecwsp.grades.models import deferred_invalidation
+from .serializers import AssignmentSerializer, MarkSerializer
+from .models import Assignment, Mark, deferred_grade_calculation
 
 
 class AssignmentViewSet(viewsets.ModelViewSet):
     serializer_class = AssignmentSerializer
     queryset = Assignment.objects.all()
+
+
+class MarkViewSet(viewsets.ModelViewSet):
+    """ Marks of the gradebook
+    Post a list of marks for one course section to create or update them
+    all at once, see MarkListSerializer """
+    permission_classes = (IsAdminUser,)
+    serializer_class = MarkSerializer
+    queryset = Mark.objects.all()
+    filter_fields = ('assignment', 'student', 'assignment__course_section')
+
+    def get_serializer(self, *args, **kwargs):
+        if isinstance(kwargs.get('data'), list):
+            kwargs['many'] = True
+        return super(MarkViewSet, self).get_serializer(*args, **kwargs)
+
+    def dispatch(self, *args, **kwargs):
+        """ Calculate grades and invalidate grade caches once per request """
+        with deferred_invalidation():
+            with deferred_grade_calculation():
+                return super(MarkViewSet, self).dispatch(*args, **kwargs)
@@ -0,0 +1,123 @@
+from django.core.management.base import BaseCommand
+from ecwsp.gradebook.exceptions import WeightContainsNone
+from ecwsp.gradebook.models import grade_weighted_average, array_contains_anything
+from optparse import make_option
+import json
+import numpy as np
+import time
+
+
+def loop_grade_weighted_average(
+    marks_category,
+    marks_category_weight,
+    marks_percent,
+    marks_possible,
+    marks_assignment=None,
+    marks_assignment_weight=None,
+):
+    """ grade_weighted_average as it was before it was vectorized, one
+    student at a time with a loop per category. Kept to compare with. """
+    if array_contains_anything(marks_category_weight):
+        if np.isnan(np.sum(marks_category_weight)):
+            raise WeightContainsNone()
+        all_categories, first_indexes = np.unique(
+            marks_category, return_index=True)
+        all_categories_weights = marks_category_weight[first_indexes]
+        cat_totals = []
+        for category in all_categories:
+            cat_indexes = np.where(marks_category == category)
+            if marks_assignment is not None and any(marks_assignment):
+                assign_total = loop_grade_weighted_average(
+                    marks_assignment[cat_indexes],
+                    marks_assignment_weight[cat_indexes],
+                    marks_percent[cat_indexes],
+                    marks_possible[cat_indexes],
+                )
+                cat_totals += [assign_total]
+            else:
+                cat_percent = marks_percent[cat_indexes]
+                cat_weights = marks_possible[cat_indexes]
+                cat_totals += [np.average(cat_percent, weights=cat_weights)]
+    else:  # Easy then
+        if marks_assignment is not None and any(marks_assignment):
+            assign_total = loop_grade_weighted_average(
+                marks_assignment,
+                marks_assignment_weight,
+                marks_percent,
+                marks_possible,
+            )
+            return assign_total
+        cat_totals = marks_percent
+        all_categories_weights = marks_possible
+    return np.average(cat_totals, weights=all_categories_weights)
+
+
+def random_section(students, marks, categories, types, seed=0):
+    """ Random marks for a course section, as SectionMarks holds them
+    About one in ten marks is missing """
+    random = np.random.RandomState(seed)
+    possible = random.randint(1, 100, marks).astype(float)
+    category = random.randint(1, categories + 1, marks).astype(float)
+    category_weight = (np.arange(categories + 1) + 1.0)[category.astype(int)]
+    assignment_type = random.randint(1, types + 1, marks).astype(float)
+    assignment_type_weight = (np.arange(types + 1) / 10.0 + 0.1)[assignment_type.astype(int)]
+    percent = random.randint(0, 101, (students, marks)) / possible
+    percent[random.random_sample((students, marks)) < 0.1] = np.nan
+    return category, category_weight, percent, possible, assignment_type, assignment_type_weight
+
+
+class Command(BaseCommand):
+    """ Times grade_weighted_average for a whole course section against
+    loop_grade_weighted_average for each student, and checks they agree. """
+    help = 'Benchmark grade_weighted_average on random marks and print JSON'
+    option_list = BaseCommand.option_list + (
+        make_option('--students', type='int', default=30),
+        make_option('--marks', type='int', default=40,
+            help='Marks per student'),
+        make_option('--categories', type='int', default=4),
+        make_option('--types', type='int', default=3,
+            help='Assignment types'),
+        make_option('--repeat', type='int', default=5,
+            help='Runs per implementation, the fastest is reported'),
+    )
+
+    def measure(self, function, repeat):
+        best = None
+        for i in range(repeat):
+            start = time.time()
+            result = function()
+            seconds = time.time() - start
+            if best is None or seconds < best:
+                best = seconds
+        return best, result
+
+    def handle(self, *args, **options):
+        category, category_weight, percent, possible, assignment_type, assignment_type_weight = \
+            random_section(options['students'], options['marks'], options['categories'], options['types'])
+
+        def loop():
+            averages = []
+            for row in percent:
+                has_mark = ~np.isnan(row)
+                averages.append(loop_grade_weighted_average(
+                    category[has_mark], category_weight[has_mark], row[has_mark], possible[has_mark],
+                    assignment_type[has_mark], assignment_type_weight[has_mark]))
+            return np.array(averages)
+
+        def vectorized():
+            return grade_weighted_average(
+                category, category_weight, percent, possible, assignment_type, assignment_type_weight)
+
+        loop_seconds, loop_averages = self.measure(loop, options['repeat'])
+        vectorized_seconds, vectorized_averages = self.measure(vectorized, options['repeat'])
+        results = {
+            'students': options['students'],
+            'marks': options['marks'],
+            'categories': options['categories'],
+            'types': options['types'],
+            'loop_seconds': loop_seconds,
+            'vectorized_seconds': vectorized_seconds,
+            'speedup': loop_seconds / vectorized_seconds if vectorized_seconds else None,
+            'max_difference': float(np.max(np.abs(loop_averages - vectorized_averages))),
+        }
+        self.stdout.write(json.dumps(results, indent=2, sort_keys=True))
@@ -2,9 +2,14 @@ from django.db import models
 from django.db.models import Q, Max
 from django.conf import settings
 from ecwsp.sis.models import SchoolYear
+from ecwsp.schedule.models import CourseSection, MarkingPeriod
+from ecwsp.grades.models import Grade, deferred_invalidation, invalidate_grade_keys
 from .exceptions import WeightContainsNone
 from decimal import Decimal
+from functools import wraps
+import datetime
 import numpy as np
+import threading
 
 
 class WeightField(models.DecimalField):
@@ -204,6 +209,33 @@ def array_contains_anything(np_array):
     return False
 
 
+def group_codes(values):
+    """ Codes 0..n-1 for the n distinct values, nan is one value
+    returns codes, n """
+    values = np.where(np.isnan(values), -np.inf, values)
+    distinct, codes = np.unique(values, return_inverse=True)
+    return codes, len(distinct)
+
+
+def first_per_group(groups, values, size):
+    """ The value at the first index of each group, nan for empty groups """
+    first = np.empty(size)
+    first.fill(np.nan)
+    # When an index repeats the last assignment wins
+    first[groups[::-1]] = values[::-1]
+    return first
+
+
+def weighted_means(groups, values, weights, size):
+    """ Weighted mean of values in each group, nan for empty groups """
+    totals = np.bincount(groups, weights=values * weights, minlength=size)
+    weight_totals = np.bincount(groups, weights=weights, minlength=size)
+    if (weight_totals[np.unique(groups)] == 0).any():
+        raise ZeroDivisionError("Weights sum to zero, can't be normalized")
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return totals / weight_totals
+
+
 def grade_weighted_average(
     marks_category,
     marks_category_weight,
@@ -212,39 +244,89 @@ def grade_weighted_average(
     marks_assignment=None,
     marks_assignment_weight=None,
 ):
-    if array_contains_anything(marks_category_weight):
-        if np.isnan(np.sum(marks_category_weight)):
+    """ Average marks_percent weighted by category weight, then assignment
+    type weight within a category and points possible within a type.
+    Category weights count when any is set, and then every mark needs one.
+    Type weights work the same within each category, or within all marks
+    when there are no category weights.
+
+    marks_percent is one student's marks or a students x marks matrix with
+    nan for marks a student doesn't have. The other arrays have one value
+    per mark, shared by every student, or are matrices too.
+    Returns the average, or an array with each student's average
+    """
+    percent = np.asarray(marks_percent, dtype=np.dtype(float))
+    one_student = percent.ndim == 1
+    percent = np.atleast_2d(percent)
+    shape = percent.shape
+    students = shape[0]
+    rows, columns = np.nonzero(~np.isnan(percent))
+
+    def marks(values):
+        """ values of the marks students have, in the order of rows """
+        values = np.zeros(shape) + np.asarray(values, dtype=np.dtype(float))
+        return values[rows, columns]
+
+    percent = percent[rows, columns]
+    possible = marks(marks_possible)
+    category_weight = marks(marks_category_weight)
+    weighted = np.bincount(
+        rows, weights=np.nan_to_num(category_weight), minlength=students) > 0
+    missing_weight = np.bincount(
+        rows, weights=np.isnan(category_weight).astype(float), minlength=students) > 0
+    if (weighted & missing_weight).any():
+        raise WeightContainsNone()
+
+    # A group is a student's category, or all their marks without weights
+    category, categories = group_codes(marks(marks_category))
+    groups = rows * categories + np.where(weighted[rows], category, 0)
+    group_count = students * categories
+    if marks_assignment is not None:
+        assignment_weight = marks(marks_assignment_weight)
+        by_type = np.bincount(
+            groups, weights=np.nan_to_num(assignment_weight), minlength=group_count) > 0
+        missing_weight = np.bincount(
+            groups, weights=np.isnan(assignment_weight).astype(float), minlength=group_count) > 0
+        if (by_type & missing_weight).any():
             raise WeightContainsNone()
-        all_categories, first_indexes = np.unique(
-            marks_category, return_index=True)
-        all_categories_weights = marks_category_weight[first_indexes]
-        cat_totals = []
-        for category in all_categories:
-            cat_indexes = np.where(marks_category == category)
-            if marks_assignment is not None and any(marks_assignment):
-                assign_total = grade_weighted_average(
-                    marks_assignment[cat_indexes],
-                    marks_assignment_weight[cat_indexes],
-                    marks_percent[cat_indexes],
-                    marks_possible[cat_indexes],
-                )
-                cat_totals += [assign_total]
-            else:
-                cat_percent = marks_percent[cat_indexes]
-                cat_weights = marks_possible[cat_indexes]
-                cat_totals += [np.average(cat_percent, weights=cat_weights)]
-    else:  # Easy then
-        if marks_assignment is not None and any(marks_assignment):
-            assign_total = grade_weighted_average(
-                marks_assignment,
-                marks_assignment_weight,
-                marks_percent,
-                marks_possible,
-            )
-            return assign_total
-        cat_totals = marks_percent
-        all_categories_weights = marks_possible
-    return np.average(cat_totals, weights=all_categories_weights)
+        marks_by_type = by_type[groups]
+    else:
+        marks_by_type = np.zeros(len(groups), dtype=bool)
+
+    group_average = np.empty(group_count)
+    group_average.fill(np.nan)
+    plain = ~marks_by_type
+    plain_average = weighted_means(
+        groups[plain], percent[plain], possible[plain], group_count)
+    group_average[groups[plain]] = plain_average[groups[plain]]
+    if marks_by_type.any():
+        assignment_type, types = group_codes(marks(marks_assignment)[marks_by_type])
+        type_groups = groups[marks_by_type] * types + assignment_type
+        type_average = weighted_means(
+            type_groups, percent[marks_by_type], possible[marks_by_type], group_count * types)
+        type_weight = first_per_group(
+            type_groups, assignment_weight[marks_by_type], group_count * types)
+        present_types = np.unique(type_groups)
+        type_group_average = weighted_means(
+            present_types // types, type_average[present_types], type_weight[present_types], group_count)
+        group_average[present_types // types] = type_group_average[present_types // types]
+
+    average = np.empty(students)
+    average.fill(np.nan)
+    present_groups = np.unique(groups)
+    group_students = present_groups // categories
+    unweighted_groups = present_groups[~weighted[group_students]]
+    average[unweighted_groups // categories] = group_average[unweighted_groups]
+    weighted_groups = present_groups[weighted[group_students]]
+    if len(weighted_groups):
+        group_weight = first_per_group(groups, category_weight, group_count)
+        weighted_average = weighted_means(
+            weighted_groups // categories, group_average[weighted_groups],
+            group_weight[weighted_groups], students)
+        average[weighted] = weighted_average[weighted]
+    if one_student:
+        return average[0]
+    return average
 
 
 class Mark(models.Model):
@@ -263,17 +345,30 @@ class Mark(models.Model):
         unique_together = ('assignment', 'demonstration', 'student',)
 
     def calculate_student_course_grade(self):
-        student = self.student
-        marking_period = self.assignment.marking_period
-        course = self.assignment.course_section
-        calc_rule = CalculationRule.find_calculation_rule(
-            marking_period.school_year)
-        grade = course.grade_set.filter(
-            marking_period=marking_period,
-            student=student,
-            course_section=course,
-        ).first()
+        assignment = self.assignment
+        calculate_section_grades(
+            assignment.course_section, assignment.marking_period, [self.student_id])
 
+    def save(self, *args, **kwargs):
+        super(Mark, self).save(*args, **kwargs)
+        students = getattr(_deferred_calculation, 'students', None)
+        if students is not None:
+            assignment = self.assignment
+            key = (assignment.course_section_id, assignment.marking_period_id)
+            students.setdefault(key, set()).add(self.student_id)
+        else:
+            self.calculate_student_course_grade()
+
+
+class SectionMarks(object):
+    """ The marks that count toward the grades of a course section for a
+    marking period, as a students x columns matrix.
+    Each column is an assignment, once for every category weight rule that
+    applies to it, with its points possible, category and assignment type
+    weights in column vectors. Marks a student doesn't have are nan.
+    student_ids: only load these students
+    """
+    def __init__(self, course_section, marking_period, student_ids=None):
         # Holy crap. We need to deal with grades when demonstrations exist
         # and pick the best score for a set of demonstrations. But also
         # select marks that have no demonstrations. We'll use order_by
@@ -282,15 +377,21 @@ class Mark(models.Model):
         # group. See /docs/specs/gradebook.md for more info.
         # Also see Django docs on order_by.
         # https://docs.djangoproject.com/en/dev/topics/db/aggregation/#interaction-with-default-ordering-or-order-by
-        marks = student.gradebook_mark_set.filter(
+        marks = Mark.objects.filter(
+            Q(assignment__course_section=course_section),
             Q(assignment__marking_period=marking_period),
-            Q(assignment__category__calculationrulepercoursecategory__apply_to_departments=course.course.department) |
+            Q(assignment__category__calculationrulepercoursecategory__apply_to_departments=course_section.course.department_id) |
             Q(assignment__category__calculationrulepercoursecategory__apply_to_departments=None),
         ).exclude(
             mark=None,
-        ).order_by(  # Here is the magic - really this is grouping by
-            'assignment'
+        )
+        if student_ids is not None:
+            marks = marks.filter(student__in=student_ids)
+        marks = marks.order_by(  # Here is the magic - really this is grouping by
+            'student', 'assignment'
         ).values_list(
+            'student',
+            'assignment',
             'assignment__points_possible',
             'assignment__category__calculationrulepercoursecategory',
             'assignment__category__calculationrulepercoursecategory__weight',
@@ -298,59 +399,181 @@ class Mark(models.Model):
             'assignment__assignment_type__weight',
         ).annotate(mark=Max('mark'))
 
-        if not marks:
-            grade.set_grade(None)
-            return
-
-        np_marks = np.array(marks, dtype=np.dtype(float))
-        marks_possible = np_marks[:, 0]
-        marks_category = np_marks[:, 1]
-        marks_category_weight = np_marks[:, 2]
-        marks_assignment = np_marks[:, 3]
-        marks_assignment_weight = np_marks[:, 4]
-        marks_mark = np_marks[:, 5]
-        marks_percent = marks_mark / marks_possible
-
-        if np.isnan(np.sum(marks_possible)):
-            raise WeightContainsNone()
-
-        sub_rules = CalculationRuleSubstitution.objects.filter(
-            Q(calculation_rule=calc_rule),
-            Q(apply_to_departments=course.course.department) |
-            Q(apply_to_departments=None)
-        ).distinct()
-
+        self.student_ids = []
+        student_rows = {}
+        columns = {}
+        column_values = []
+        cells = []
+        for student_id, assignment_id, possible, category, category_weight, \
+                assignment_type, assignment_type_weight, mark in marks:
+            row = student_rows.get(student_id)
+            if row is None:
+                row = student_rows[student_id] = len(self.student_ids)
+                self.student_ids.append(student_id)
+            column = columns.get((assignment_id, category))
+            if column is None:
+                column = columns[(assignment_id, category)] = len(column_values)
+                column_values.append(
+                    (possible, category, category_weight, assignment_type, assignment_type_weight))
+            cells.append((row, column, mark))
+
+        np_columns = np.array(column_values, dtype=np.dtype(float)).reshape(len(column_values), 5)
+        self.possible = np_columns[:, 0]
+        self.category = np_columns[:, 1]
+        self.category_weight = np_columns[:, 2]
+        self.assignment_type = np_columns[:, 3]
+        self.assignment_type_weight = np_columns[:, 4]
+        self.marks = np.empty((len(self.student_ids), len(column_values)))
+        self.marks.fill(np.nan)
+        if cells:
+            np_cells = np.array(cells, dtype=np.dtype(float))
+            self.marks[np_cells[:, 0].astype(int), np_cells[:, 1].astype(int)] = np_cells[:, 2]
+        self.has_mark = ~np.isnan(self.marks)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.percents = self.marks / self.possible
+
+    def matching_students(self, rule):
+        """ Boolean vector, True for students with a mark matching the
+        substitution rule """
+        np_function = NP_OPERATOR_MAP[rule.operator]
+        with np.errstate(invalid='ignore'):
+            matches = np_function(self.marks, float(rule.match_value))
+        return (matches & self.has_mark).any(axis=1)
+
+    def weighted_averages(self, rows):
+        """ grade_weighted_average of each student in rows """
+        return grade_weighted_average(
+            self.category,
+            self.category_weight,
+            self.percents[rows],
+            self.possible,
+            self.assignment_type,
+            self.assignment_type_weight,
+        )
+
+
+def calculate_section_grades(course_section, marking_period, student_ids=None):
+    """ Calculate the Grades of every student with marks in course_section
+    for marking_period, or only of student_ids, and save the changed ones
+    together. Students without marks keep their grade. """
+    section_marks = SectionMarks(course_section, marking_period, student_ids)
+    if not section_marks.student_ids:
+        return
+    if np.isnan(section_marks.possible[section_marks.has_mark.any(axis=0)]).any():
+        raise WeightContainsNone()
+    calc_rule = CalculationRule.find_calculation_rule(marking_period.school_year)
+    sub_rules = CalculationRuleSubstitution.objects.filter(
+        Q(calculation_rule=calc_rule),
+        Q(apply_to_departments=course_section.course.department_id) |
+        Q(apply_to_departments=None)
+    ).distinct().order_by('id')
+
+    # The first substitution rule a student's marks match applies
+    student_sub_rules = [None] * len(section_marks.student_ids)
+    unmatched = np.ones(len(section_marks.student_ids), dtype=bool)
+    for rule in sub_rules:
+        matches = section_marks.matching_students(rule) & unmatched
+        for row in np.flatnonzero(matches):
+            student_sub_rules[row] = rule
+        unmatched &= ~matches
+
+    # Students without a substitution to calculate as are averaged together
+    average_rows = [
+        row for row, sub_rule in enumerate(student_sub_rules)
+        if sub_rule is None or sub_rule.calculate_as is None]
+    averages = {}
+    if average_rows:
+        averages = dict(zip(average_rows, section_marks.weighted_averages(average_rows)))
+
+    grades = dict((grade.student_id, grade) for grade in Grade.objects.filter(
+        course_section=course_section,
+        marking_period=marking_period,
+        student__in=section_marks.student_ids,
+    ))
+    new_grades = []
+    changed_grades = {}
+    for row, student_id in enumerate(section_marks.student_ids):
+        sub_rule = student_sub_rules[row]
         total = None
-        match_sub_rule = False
-        for rule in sub_rules:
-            cat_ids = rule.apply_to_categories.values_list('id', flat=True)
-            relevant_marks = marks_mark
-            match_sub_rule = rule.np_check_if_matches(relevant_marks)
-            if match_sub_rule is True:
-                match_sub_rule = rule
-                total = match_sub_rule.calculate_as
-                break
-
-        if match_sub_rule is False or total is None:
-            # Check if contains any weights at all
-            total = grade_weighted_average(
-                marks_category, marks_category_weight, marks_percent,
-                marks_possible, marks_assignment, marks_assignment_weight)
-
+        if sub_rule is not None:
+            total = sub_rule.calculate_as
+        if total is None:
+            total = averages[row]
             if calc_rule is not None and calc_rule.points_possible > 0:
                 total = Decimal(total) * calc_rule.points_possible
             else:  # Assume out of 100 unless specified
                 total = Decimal(total) * 100
 
-        if match_sub_rule is False:
+        grade = grades.get(student_id)
+        if grade is None:
+            grade = Grade(
+                student_id=student_id,
+                course_section=course_section,
+                marking_period=marking_period)
+            new_grades.append(grade)
+        old_value = (grade.grade, grade.letter_grade)
+        if sub_rule is None:
             grade.set_grade(total, treat_as_percent=False)
         else:
             grade.set_grade(
                 total,
-                letter_grade=match_sub_rule.display_as,
+                letter_grade=sub_rule.display_as,
                 treat_as_percent=False)
-        grade.save()
+        if grade.grade is not None:
+            # As the database will store it
+            grade.grade = grade.grade.quantize(Decimal('0.01'))
+        if grade.pk is not None and (grade.grade, grade.letter_grade) != old_value:
+            changed_grades.setdefault((grade.grade, grade.letter_grade), []).append(grade)
+
+    with deferred_invalidation():
+        for grade in new_grades:
+            grade.save()
+        today = datetime.date.today()
+        for (value, letter_grade), changed in changed_grades.items():
+            Grade.objects.filter(pk__in=[grade.pk for grade in changed]).update(
+                grade=value, letter_grade=letter_grade, date=today)
+        invalidate_grade_keys(
+            (grade.student_id, grade.course_section_id, grade.marking_period_id, grade.override_final)
+            for changed in changed_grades.values() for grade in changed)
+
+
+_deferred_calculation = threading.local()
+
+class deferred_grade_calculation(object):
+    """ Context manager and decorator that collects the grades Mark.save
+    would calculate and calculates them at exit with calculate_section_grades,
+    once for every course section and marking period.
+    Use it around code that saves many marks, such as a pasted column.
+
+        with deferred_grade_calculation():
+            for mark in marks:
+                mark.save()
+    """
+    def __enter__(self):
+        self.outermost = getattr(_deferred_calculation, 'students', None) is None
+        if self.outermost:
+            _deferred_calculation.students = {}
 
-    def save(self, *args, **kwargs):
-        super(Mark, self).save(*args, **kwargs)
-        self.calculate_student_course_grade()
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.outermost:
+            return
+        students = _deferred_calculation.students
+        _deferred_calculation.students = None
+        if exc_type is not None:
+            return
+        course_sections = CourseSection.objects.select_related('course').in_bulk(
+            set(course_section_id for course_section_id, marking_period_id in students))
+        marking_periods = MarkingPeriod.objects.select_related('school_year').in_bulk(
+            set(marking_period_id for course_section_id, marking_period_id in students))
+        for (course_section_id, marking_period_id), student_ids in students.items():
+            calculate_section_grades(
+                course_sections[course_section_id],
+                marking_periods[marking_period_id],
+                student_ids)
+
+    def __call__(self, func):
+        @wraps(func)
+        def inner(*args, **kwargs):
+            with deferred_grade_calculation():
+                return func(*args, **kwargs)
+        return inner
@@ -1,7 +1,127 @@
+from django.db import transaction
 from rest_framework import serializers
-from .models import Assignment
+from ecwsp.schedule.models import CourseEnrollment
+from .models import Assignment, Demonstration, Mark, calculate_section_grades
 
 
 class AssignmentSerializer(serializers.ModelSerializer):
     class Meta:
         model = Assignment
+
+
+class MarkListSerializer(serializers.ListSerializer):
+    """ Validates and saves many marks of one course section together
+    Marks that exist for the same assignment, demonstration and student are
+    updated. The grades of the students whose marks changed are calculated
+    once at the end. """
+    def validate(self, data):
+        assignment_ids = set(item['assignment_id'] for item in data)
+        student_ids = set(item['student_id'] for item in data)
+        demonstration_ids = set(item['demonstration_id'] for item in data if item.get('demonstration_id'))
+        assignments = Assignment.objects.in_bulk(assignment_ids)
+        if len(assignments) != len(assignment_ids):
+            raise serializers.ValidationError(
+                'Invalid assignments {0}'.format(sorted(assignment_ids - set(assignments))))
+        course_section_ids = set(assignment.course_section_id for assignment in assignments.values())
+        if len(course_section_ids) > 1:
+            raise serializers.ValidationError('Marks must be for one course section')
+        if any(assignment.marking_period_id is None for assignment in assignments.values()):
+            raise serializers.ValidationError('Assignments must have a marking period')
+        enrolled = set(CourseEnrollment.objects.filter(
+            course_section__in=course_section_ids,
+            user__in=student_ids,
+        ).values_list('user_id', flat=True))
+        if enrolled != student_ids:
+            raise serializers.ValidationError(
+                'Students {0} are not enrolled in the course section'.format(sorted(student_ids - enrolled)))
+        demonstrations = dict(Demonstration.objects.filter(
+            id__in=demonstration_ids).values_list('id', 'assignment_id'))
+        keys = set()
+        for item in data:
+            demonstration_id = item.get('demonstration_id')
+            if demonstration_id and demonstrations.get(demonstration_id) != item['assignment_id']:
+                raise serializers.ValidationError(
+                    'Demonstration {0} is not for assignment {1}'.format(demonstration_id, item['assignment_id']))
+            key = (item['assignment_id'], demonstration_id, item['student_id'])
+            if key in keys:
+                raise serializers.ValidationError('Duplicate mark {0}'.format(key))
+            keys.add(key)
+        return data
+
+    def create(self, validated_data):
+        assignment_ids = set(item['assignment_id'] for item in validated_data)
+        student_ids = set(item['student_id'] for item in validated_data)
+        with transaction.atomic():
+            existing = dict(
+                ((mark.assignment_id, mark.demonstration_id, mark.student_id), mark)
+                for mark in Mark.objects.filter(assignment__in=assignment_ids, student__in=student_ids))
+            new_marks = []
+            changed_marks = {}
+            changed_students = set()
+            for item in validated_data:
+                key = (item['assignment_id'], item.get('demonstration_id'), item['student_id'])
+                values = (item.get('mark'), item.get('letter_grade'))
+                mark = existing.get(key)
+                if mark is None:
+                    new_marks.append(Mark(
+                        assignment_id=key[0],
+                        demonstration_id=key[1],
+                        student_id=key[2],
+                        mark=values[0],
+                        letter_grade=values[1]))
+                elif (mark.mark, mark.letter_grade) != values:
+                    changed_marks.setdefault(values, []).append(mark.pk)
+                else:
+                    continue
+                changed_students.add(key[2])
+            Mark.objects.bulk_create(new_marks)
+            for (value, letter_grade), mark_ids in changed_marks.items():
+                Mark.objects.filter(pk__in=mark_ids).update(mark=value, letter_grade=letter_grade)
+
+            if changed_students:
+                assignments = list(Assignment.objects.filter(id__in=assignment_ids).select_related(
+                    'course_section__course', 'marking_period__school_year'))
+                marking_periods = dict(
+                    (assignment.marking_period_id, assignment.marking_period) for assignment in assignments)
+                for marking_period in marking_periods.values():
+                    calculate_section_grades(assignments[0].course_section, marking_period, changed_students)
+
+            marks = dict(
+                ((mark.assignment_id, mark.demonstration_id, mark.student_id), mark)
+                for mark in Mark.objects.filter(assignment__in=assignment_ids, student__in=student_ids))
+        return [marks[(item['assignment_id'], item.get('demonstration_id'), item['student_id'])]
+                for item in validated_data]
+
+
+class MarkSerializer(serializers.ModelSerializer):
+    """ Ids instead of related fields, so a list of marks is validated with
+    a few queries in MarkListSerializer """
+    assignment = serializers.IntegerField(source='assignment_id')
+    student = serializers.IntegerField(source='student_id')
+    demonstration = serializers.IntegerField(
+        source='demonstration_id', required=False, allow_null=True)
+
+    class Meta:
+        model = Mark
+        fields = ('id', 'assignment', 'student', 'demonstration', 'mark', 'letter_grade')
+        list_serializer_class = MarkListSerializer
+        # Existing marks are updated, see MarkListSerializer
+        validators = []
+
+    def validate(self, data):
+        if self.parent is None:
+            if self.instance is not None:
+                # Partial updates leave out the fields that aren't changing
+                for field in ('assignment_id', 'student_id', 'demonstration_id'):
+                    data.setdefault(field, getattr(self.instance, field))
+                if Mark.objects.filter(
+                        assignment=data['assignment_id'],
+                        demonstration=data['demonstration_id'],
+                        student=data['student_id']).exclude(pk=self.instance.pk).exists():
+                    raise serializers.ValidationError('This mark already exists')
+            MarkListSerializer(child=MarkSerializer()).validate([data])
+        return data
+
+    def create(self, validated_data):
+        """ Update the mark if it exists, like a list of marks """
+        return MarkListSerializer(child=MarkSerializer()).create([validated_data])[0]
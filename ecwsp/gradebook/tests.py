@@ -1,4 +1,4 @@
-from django.test import TestCase
+from django.test import TestCase, SimpleTestCase
 from ecwsp.sis.tests import SisTestMixin
 from ecwsp.sis.models import SchoolYear
 from ecwsp.schedule.models import (
@@ -9,6 +9,7 @@ from .exceptions import WeightContainsNone
 from ecwsp.sis.sample_data import SisData
 from decimal import Decimal
 from decimal import InvalidOperation
+import numpy as np
 import unittest
 
 
@@ -300,6 +301,99 @@ class GradeCalculationTests(SisTestMixin, TestCase):
             self.create_and_check_mark(assignment, data[1], data[2])
 
 
+    def test_deferred_grade_calculation(self):
+        """ Marks saved together get the same grades as one by one """
+        cat1 = AssignmentCategory.objects.create(name="Standards")
+        calc_rule = CalculationRule.objects.create(
+            first_year_effective=self.data.school_year,
+        )
+        CalculationRulePerCourseCategory.objects.create(
+            category=cat1,
+            weight=1,
+            calculation_rule=calc_rule,
+        )
+        assignment1 = self.create_assignment(10, category=cat1)
+        assignment2 = self.create_assignment(20, category=cat1)
+        students = [self.data.student, self.data.student2]
+        with self.assertNumQueries(0):
+            with deferred_grade_calculation():
+                pass
+        with deferred_grade_calculation():
+            for student in students:
+                Mark.objects.create(assignment=assignment1, student=student, mark=5)
+                Mark.objects.create(assignment=assignment2, student=student, mark=20)
+            # Not calculated yet
+            self.assertEquals(self.data.student.grade_set.get(
+                marking_period=self.data.marking_period,
+                course_section=self.data.course_section1).get_grade(), "")
+        for student in students:
+            grade = student.grade_set.get(
+                marking_period=self.data.marking_period,
+                course_section=self.data.course_section1)
+            self.assertAlmostEquals(grade.get_grade(), Decimal('83.33'))
+
+    def test_bulk_marks(self):
+        """ Post a list of marks to create and update them together """
+        from django.contrib.auth.models import User
+        from rest_framework.test import APIClient
+        client = APIClient()
+        client.force_authenticate(user=User.objects.create_superuser('admin', 'admin@example.com', 'admin'))
+        assignment1 = self.create_assignment(10)
+        assignment2 = self.create_assignment(20)
+        students = [self.data.student, self.data.student2]
+        data = [
+            {'assignment': assignment.id, 'student': student.id, 'mark': '5'}
+            for assignment in (assignment1, assignment2) for student in students]
+        response = client.post('/api/marks/', data, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(response.data), 4)
+        self.assertEqual(Mark.objects.count(), 4)
+        for student in students:
+            grade = student.grade_set.get(
+                marking_period=self.data.marking_period,
+                course_section=self.data.course_section1)
+            self.assertAlmostEquals(grade.get_grade(), Decimal('33.33'))
+
+        data[0]['mark'] = '10'
+        response = client.post('/api/marks/', data, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Mark.objects.count(), 4)
+        self.assertAlmostEquals(self.data.student.grade_set.get(
+            marking_period=self.data.marking_period,
+            course_section=self.data.course_section1).get_grade(), Decimal('50'))
+
+        # Marks for a student not in the section are all rejected
+        data.append({'assignment': assignment1.id, 'student': self.data.student3.id, 'mark': '1'})
+        data[0]['mark'] = '0'
+        response = client.post('/api/marks/', data, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Mark.objects.get(assignment=assignment1, student=self.data.student).mark, 10)
+
+    def test_single_mark(self):
+        """ Post one mark twice, then change it with a partial update """
+        from django.contrib.auth.models import User
+        from rest_framework.test import APIClient
+        client = APIClient()
+        client.force_authenticate(user=User.objects.create_superuser('admin', 'admin@example.com', 'admin'))
+        assignment = self.create_assignment(10)
+        data = {'assignment': assignment.id, 'student': self.data.student.id, 'mark': '5'}
+        response = client.post('/api/marks/', data, format='json')
+        self.assertEqual(response.status_code, 201)
+        data['mark'] = '8'
+        response = client.post('/api/marks/', data, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Mark.objects.count(), 1)
+        mark = Mark.objects.get()
+        self.assertEqual(mark.mark, 8)
+
+        response = client.patch('/api/marks/{0}/'.format(mark.id), {'mark': '10'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Mark.objects.get().mark, 10)
+        grade = self.data.student.grade_set.get(
+            marking_period=self.data.marking_period,
+            course_section=self.data.course_section1)
+        self.assertAlmostEquals(grade.get_grade(), Decimal('100'))
+
     def test_demonstration(self):
         cat1 = AssignmentCategory.objects.create(
             name="Standards", allow_multiple_demonstrations=True)
@@ -323,3 +417,37 @@ class GradeCalculationTests(SisTestMixin, TestCase):
         self.create_and_check_mark(assignment3, 3, 76.92)
         self.create_and_check_mark(assignment4, 4, 73.68)
 
+
+class GradeWeightedAverageTests(SimpleTestCase):
+    def test_matches_per_student_average(self):
+        from .management.commands.benchmark_weighted_average import (
+            loop_grade_weighted_average, random_section)
+        for seed in range(20):
+            category, category_weight, percent, possible, assignment_type, assignment_type_weight = \
+                random_section(8, 12, 3, 3, seed)
+            if seed % 2:
+                category_weight[:] = np.nan
+            if seed % 3 == 0:
+                assignment_type_weight[:] = np.nan
+            averages = grade_weighted_average(
+                category, category_weight, percent, possible, assignment_type, assignment_type_weight)
+            for row, student_percent in enumerate(percent):
+                has_mark = ~np.isnan(student_percent)
+                expected = loop_grade_weighted_average(
+                    category[has_mark], category_weight[has_mark], student_percent[has_mark],
+                    possible[has_mark], assignment_type[has_mark], assignment_type_weight[has_mark])
+                self.assertAlmostEqual(averages[row], expected)
+                self.assertAlmostEqual(grade_weighted_average(
+                    category[has_mark], category_weight[has_mark], student_percent[has_mark],
+                    possible[has_mark], assignment_type[has_mark], assignment_type_weight[has_mark]), expected)
+
+    def test_missing_weight(self):
+        self.assertRaises(
+            WeightContainsNone, grade_weighted_average,
+            np.array([1, np.nan]), np.array([0.7, np.nan]),
+            np.array([[0.5, 1], [0.5, np.nan]]), np.array([10, 10]))
+        self.assertRaises(
+            WeightContainsNone, grade_weighted_average,
+            np.array([np.nan, np.nan]), np.array([np.nan, np.nan]),
+            np.array([0.5, 1]), np.array([10, 10]),
+            np.array([1, np.nan]), np.array([0.4, np.nan]))
@@ -0,0 +1,456 @@
+""" Set based grade cache calculations
+
+The per object cache methods (CourseEnrollment.cache_grades,
+StudentMarkingPeriodGrade.calculate_grade, StudentYearGrade.calculate_grade,
+Student.calculate_gpa) each run their own queries. The functions here compute
+the same values for many students at once with a few grouped queries and one
+pass in memory, then write them back with batched UPDATEs.
+Results must always match the per object code.
+"""
+from django.db import connection
+from constance import config
+from ecwsp.sis.models import Student, SchoolYear, get_grade_scale_index
+from ecwsp.sis.helper_functions import round_as_decimal, chunks, bulk_update
+from ecwsp.schedule.models import CourseEnrollment, CourseSection, MarkingPeriod
+from .models import Grade, StudentMarkingPeriodGrade, StudentYearGrade
+
+from decimal import Decimal, ROUND_HALF_UP
+
+
+def _in_clause(column, ids):
+    return '{} IN ({})'.format(column, ', '.join(['%s'] * len(ids)))
+
+
+def _student_chunks(student_ids):
+    """ None means every student, which needs no IN clause at all """
+    if student_ids is None:
+        return [None]
+    return list(chunks(sorted(student_ids)))
+
+
+def final_grade_averages(student_ids=None, date_report=None):
+    """ Same average as CourseEnrollment.calculate_grade_real, grouped by enrollment
+    returns {(course_section_id, student_id): (override_count, ave_grade)}
+    Enrollments without any grade are not included.
+    """
+    sql_string = '''
+SELECT grades_grade.course_section_id, grades_grade.student_id,
+    Sum(CASE WHEN grades_grade.override_final THEN 1 ELSE 0 END),
+    Sum(grade * weight) / NULLIF(Sum(weight), 0)
+FROM grades_grade
+    LEFT JOIN schedule_markingperiod
+    ON schedule_markingperiod.id = grades_grade.marking_period_id
+WHERE ( grade IS NOT NULL
+    OR letter_grade IS NOT NULL ) {extra_where}
+GROUP BY grades_grade.course_section_id, grades_grade.student_id'''
+    results = {}
+    cursor = connection.cursor()
+    for student_chunk in _student_chunks(student_ids):
+        extra_where = ''
+        params = []
+        if date_report:
+            extra_where += ' AND (schedule_markingperiod.end_date <= %s OR grades_grade.override_final = %s)'
+            params += [date_report, True]
+        if student_chunk is not None:
+            extra_where += ' AND ' + _in_clause('grades_grade.student_id', student_chunk)
+            params += student_chunk
+        cursor.execute(sql_string.format(extra_where=extra_where), params)
+        for course_section_id, student_id, override_count, ave_grade in cursor.fetchall():
+            results[(course_section_id, student_id)] = (override_count, ave_grade)
+    return results
+
+
+def marking_period_averages(student_ids=None):
+    """ Same average as StudentMarkingPeriodGrade.calculate_grade, grouped
+    returns {(marking_period_id, student_id): grade} """
+    sql_string = """
+select marking_period_id, student_id, sum(grade * credits) / NULLIF(sum(credits * 1.0), 0)
+from grades_grade
+left join schedule_coursesection on schedule_coursesection.id=grades_grade.course_section_id
+left join schedule_course on schedule_coursesection.course_id=schedule_course.id
+where grade is not null {extra_where}
+group by marking_period_id, student_id"""
+    results = {}
+    cursor = connection.cursor()
+    for student_chunk in _student_chunks(student_ids):
+        extra_where = ''
+        params = []
+        if student_chunk is not None:
+            extra_where = 'and ' + _in_clause('student_id', student_chunk)
+            params = student_chunk
+        cursor.execute(sql_string.format(extra_where=extra_where), params)
+        for marking_period_id, student_id, grade in cursor.fetchall():
+            results[(marking_period_id, student_id)] = grade
+    return results
+
+
+def display_grade(letter_grade, grade):
+    """ Grade.get_grade() without any options, from raw values """
+    if letter_grade:
+        return letter_grade
+    elif grade is not None:
+        return grade
+    return ""
+
+
+def letter_final_grade(grades):
+    """ The letter grade branch of CourseEnrollment.calculate_grade_real
+    grades: list of (get_grade, marking_period_weight) in Grade id order.
+    marking_period_weight is None for grades without a marking period.
+    """
+    final = 0.0
+    if grades:
+        total_weight = Decimal(0)
+        for get_grade, weight in grades:
+            if get_grade in ["I", "IN", "YT"]:
+                return get_grade
+            elif get_grade in ["P","HP","LP"]:
+                if weight is not None:
+                    final += float(100 * weight)
+                    total_weight += weight
+            elif get_grade in ['F', 'M']:
+                if weight is not None:
+                    total_weight += weight
+            elif get_grade:
+                try:
+                    final += get_grade
+                except TypeError:
+                    return get_grade
+        if total_weight:
+            final /= float(total_weight)
+            final = Decimal(final).quantize(Decimal("0.01"), ROUND_HALF_UP)
+            if final > config.LETTER_GRADE_REQUIRED_FOR_PASS:
+                return "P"
+            else:
+                return "F"
+    return None
+
+
+def final_grades(enrollment_keys, averages, date_report=None, ignore_letter=False):
+    """ CourseEnrollment.calculate_grade_real for many enrollments
+    enrollment_keys: iterable of (course_section_id, student_id)
+    averages: result of final_grade_averages covering those enrollments
+    returns {(course_section_id, student_id): grade}
+    """
+    results = {}
+    override_keys = set()
+    letter_keys = set()
+    for key in enrollment_keys:
+        override_count, ave_grade = averages.get(key, (None, None))
+        # -9001 = override in the per object code
+        if override_count == 1:
+            override_keys.add(key)
+        elif ave_grade:
+            results[key] = Decimal(ave_grade)
+        elif ignore_letter is False and key in averages:
+            # Enrollments missing from averages only have blank grades
+            letter_keys.add(key)
+        else:
+            results[key] = None
+
+    for student_chunk in chunks(set(key[1] for key in override_keys)):
+        grades = Grade.objects.filter(
+            override_final=True,
+            student_id__in=student_chunk,
+        ).exclude(grade__isnull=True, letter_grade__isnull=True)
+        for course_section_id, student_id, letter_grade, grade in grades.values_list(
+                'course_section_id', 'student_id', 'letter_grade', 'grade'):
+            key = (course_section_id, student_id)
+            if key in override_keys:
+                grade = display_grade(letter_grade, grade)
+                if ignore_letter and not isinstance(grade, (int, Decimal, float)):
+                    grade = None
+                results[key] = grade
+
+    if letter_keys:
+        letter_grades = dict((key, []) for key in letter_keys)
+        for student_chunk in chunks(set(key[1] for key in letter_keys)):
+            grades = Grade.objects.filter(student_id__in=student_chunk)
+            if date_report:
+                grades = grades.filter(marking_period__end_date__lte=date_report)
+            for course_section_id, student_id, letter_grade, grade, weight in grades.order_by('id').values_list(
+                    'course_section_id', 'student_id', 'letter_grade', 'grade', 'marking_period__weight'):
+                key = (course_section_id, student_id)
+                if key in letter_grades:
+                    letter_grades[key].append((display_grade(letter_grade, grade), weight))
+        for key, grades in letter_grades.iteritems():
+            results[key] = letter_final_grade(grades)
+
+    for key in enrollment_keys:
+        results.setdefault(key, None)
+    return results
+
+
+def to_numeric(grade_scale_id, grade):
+    """ GradeScale.to_numeric without loading the GradeScale """
+    rule = get_grade_scale_index(grade_scale_id).get_rule(grade)
+    if rule:
+        return rule.numeric_scale
+
+
+def expand_dirty_keys(keys):
+    """ Work out every cache row touched by GradeCacheDirtyKey values
+    keys: iterable of (student_id, course_section_id, marking_period_id, year_id)
+    returns sets of (course_section_id, student_id) enrollments,
+    (student_id, marking_period_id) and (student_id, year_id)
+    A course section touches its enrollment and all of its marking periods
+    and years, a marking period touches its year.
+    """
+    keys = set(keys)
+    section_ids = set(key[1] for key in keys if key[1] is not None)
+    section_mps = {}
+    for chunk in chunks(section_ids):
+        for section_id, marking_period_id in CourseSection.marking_period.through.objects.filter(
+                coursesection_id__in=chunk).values_list('coursesection_id', 'markingperiod_id'):
+            section_mps.setdefault(section_id, []).append(marking_period_id)
+    mp_years = dict(MarkingPeriod.objects.values_list('id', 'school_year_id'))
+
+    enrollments = set()
+    marking_periods = set()
+    years = set()
+    for student_id, course_section_id, marking_period_id, year_id in keys:
+        if course_section_id is not None:
+            enrollments.add((course_section_id, student_id))
+            for section_mp in section_mps.get(course_section_id, []):
+                years.add((student_id, mp_years[section_mp]))
+                if marking_period_id is None:
+                    marking_periods.add((student_id, section_mp))
+        if marking_period_id is not None:
+            marking_periods.add((student_id, marking_period_id))
+            years.add((student_id, mp_years.get(marking_period_id)))
+        elif course_section_id is not None:
+            # Grades without a marking period, such as override_final
+            marking_periods.add((student_id, None))
+        if year_id is not None:
+            years.add((student_id, year_id))
+    return enrollments, marking_periods, years
+
+
+class BulkGradeCache(object):
+    """ Rebuild the grade cache in a handful of queries
+    Does the same work as build_grade_cache's per object loop:
+    CourseEnrollment grade and numeric_grade, StudentMarkingPeriodGrade,
+    StudentYearGrade grade and credits, and Student gpa.
+    student_ids: limit the rebuild to these students, None for everyone
+    dirty_keys: only write the rows touched by these GradeCacheDirtyKey
+    values (see expand_dirty_keys), implies their students
+    """
+    def __init__(self, student_ids=None, dirty_keys=None):
+        if dirty_keys is not None:
+            dirty_keys = set(dirty_keys)
+            student_ids = set(student_ids or []) | set(key[0] for key in dirty_keys)
+        if student_ids is not None:
+            student_ids = set(student_ids)
+        self.student_ids = student_ids
+        self.dirty_keys = dirty_keys
+
+    def filter_students(self, queryset, field='student_id'):
+        if self.student_ids is None:
+            return queryset
+        return queryset.filter(**{field + '__in': self.student_ids})
+
+    def build(self):
+        self.create_cache_rows()
+        enrollment_values = self.calculate_enrollments()
+        mp_values = self.calculate_marking_period_grades()
+        year_values = self.calculate_year_grades()
+        gpa_values = self.calculate_gpas()
+        if self.dirty_keys is not None:
+            enrollments, marking_periods, years = expand_dirty_keys(self.dirty_keys)
+            enrollment_values = self.only_rows(enrollment_values, self.enrollment_rows, enrollments)
+            mp_values = self.only_rows(mp_values, self.marking_period_rows, marking_periods)
+            year_values = self.only_rows(year_values, self.year_rows, years)
+        bulk_update(CourseEnrollment, enrollment_values)
+        bulk_update(StudentMarkingPeriodGrade, mp_values)
+        bulk_update(StudentYearGrade, year_values)
+        bulk_update(Student, gpa_values)
+
+    @staticmethod
+    def only_rows(values, rows, keys):
+        """ values: pk -> values, rows: pk -> key
+        Keep the values whose key is in keys """
+        return dict((pk, value) for pk, value in values.iteritems() if rows[pk] in keys)
+
+    def create_cache_rows(self):
+        """ StudentMarkingPeriodGrade.build_all_cache and StudentYearGrade.build_all_cache
+        using set differences and bulk_create """
+        enrollments = self.filter_students(CourseEnrollment.objects.all(), 'user_id')
+
+        wanted = set(enrollments.values_list('user_id', 'course_section__marking_period'))
+        existing = set(self.filter_students(StudentMarkingPeriodGrade.objects.all()).values_list(
+            'student_id', 'marking_period_id'))
+        StudentMarkingPeriodGrade.objects.bulk_create([
+            StudentMarkingPeriodGrade(student_id=student_id, marking_period_id=marking_period_id)
+            for student_id, marking_period_id in wanted - existing])
+
+        wanted = set(enrollments.filter(course_section__marking_period__school_year__isnull=False).values_list(
+            'user_id', 'course_section__marking_period__school_year').distinct())
+        existing = set(self.filter_students(StudentYearGrade.objects.all()).values_list(
+            'student_id', 'year_id'))
+        StudentYearGrade.objects.bulk_create([
+            StudentYearGrade(student_id=student_id, year_id=year_id)
+            for student_id, year_id in wanted - existing])
+
+    def calculate_enrollments(self):
+        """ CourseEnrollment.cache_grades """
+        enrollments = dict(
+            ((course_section_id, user_id), pk) for pk, course_section_id, user_id in
+            self.filter_students(CourseEnrollment.objects.all(), 'user_id').values_list(
+                'id', 'course_section_id', 'user_id'))
+        self.averages = final_grade_averages(self.student_ids)
+        grades = final_grades(enrollments.keys(), self.averages)
+        self.enrollment_rows = dict((pk, key) for key, pk in enrollments.iteritems())
+        self.numeric_grades = {}
+        values = {}
+        for key, grade in grades.iteritems():
+            if isinstance(grade, Decimal):
+                grade = grade.quantize(Decimal(".01"), rounding=ROUND_HALF_UP)
+                numeric_grade = grade
+            else:
+                numeric_grade = None
+            if grade == None:
+                grade = ''
+            self.numeric_grades[enrollments[key]] = numeric_grade
+            values[enrollments[key]] = {
+                'cached_grade': grade,
+                'cached_numeric_grade': numeric_grade,
+                'grade_recalculation_needed': False,
+                'numeric_grade_recalculation_needed': False,
+            }
+        return values
+
+    def calculate_marking_period_grades(self):
+        """ StudentMarkingPeriodGrade.calculate_grade """
+        averages = marking_period_averages(self.student_ids)
+        self.marking_period_rows = {}
+        values = {}
+        for pk, student_id, marking_period_id in self.filter_students(
+                StudentMarkingPeriodGrade.objects.all()).values_list('id', 'student_id', 'marking_period_id'):
+            self.marking_period_rows[pk] = (student_id, marking_period_id)
+            values[pk] = {
+                'cached_grade': averages.get((marking_period_id, student_id)),
+                'grade_recalculation_needed': False,
+            }
+        return values
+
+    def load_year_enrollments(self):
+        """ One row per enrollment per reported marking period, exactly like
+        the (not distinct) enrollment queryset in StudentYearGrade.get_grade """
+        return list(self.filter_students(CourseEnrollment.objects.filter(
+            course_section__marking_period__show_reports=True,
+            course_section__course__credits__isnull=False,
+            course_section__course__course_type__weight__gt=0,
+        ), 'user_id').values_list(
+            'user_id',
+            'course_section__marking_period__school_year',
+            'id',
+            'course_section_id',
+            'course_section__course__credits',
+            'course_section__course__course_type__boost',
+        ))
+
+    def calculate_year_grades(self):
+        """ StudentYearGrade.calculate_grade_and_credits """
+        self.year_enrollments = self.load_year_enrollments()
+        seen = set()
+        enrollment_keys = []
+        per_year = {}
+        for student_id, year_id, enrollment_id, course_section_id, credits, boost in self.year_enrollments:
+            if (enrollment_id, year_id) in seen:
+                continue
+            seen.add((enrollment_id, year_id))
+            enrollment_keys.append((course_section_id, student_id))
+            per_year.setdefault((student_id, year_id), []).append(((course_section_id, student_id), credits))
+        grades = final_grades(enrollment_keys, self.averages, ignore_letter=True)
+
+        self.year_grades = {}
+        self.year_rows = {}
+        values = {}
+        for pk, student_id, year_id in self.filter_students(
+                StudentYearGrade.objects.all()).values_list('id', 'student_id', 'year_id'):
+            self.year_rows[pk] = (student_id, year_id)
+            total = Decimal(0)
+            credits = Decimal(0)
+            for key, num_credits in per_year.get((student_id, year_id), []):
+                grade = grades[key]
+                if grade:
+                    total += grade * num_credits
+                    credits += num_credits
+            if credits > 0:
+                grade = total / credits
+            else:
+                grade = None
+            self.year_grades[(student_id, year_id)] = (grade, credits)
+            values[pk] = {
+                'cached_grade': grade,
+                'cached_credits': credits,
+                'grade_recalculation_needed': False,
+                'credits_recalculation_needed': False,
+            }
+        return values
+
+    def calculate_gpas(self, rounding=2, boost=True):
+        """ Student.calculate_gpa with StudentYearGrade.get_grade(numeric_scale=True) """
+        years = dict(SchoolYear.objects.values_list('id', 'grade_scale_id'))
+        reported_years = set(SchoolYear.objects.filter(
+            markingperiod__show_reports=True).values_list('id', flat=True))
+        year_enrollments = {}
+        for student_id, year_id, enrollment_id, course_section_id, credits, course_boost in self.year_enrollments:
+            year_enrollments.setdefault((student_id, year_id), []).append((enrollment_id, credits, course_boost))
+
+        student_years = {}
+        for (student_id, year_id), year_grade in self.year_grades.iteritems():
+            if year_id in reported_years:
+                student_years.setdefault(student_id, []).append((year_id, year_grade))
+
+        student_ids = self.student_ids
+        if student_ids is None:
+            student_ids = Student.objects.values_list('id', flat=True)
+        values = {}
+        for student_id in student_ids:
+            total = Decimal(0)
+            years_with_grade = 0
+            for year_id, (grade, year_credits) in student_years.get(student_id, []):
+                grade_scale_id = years[year_id]
+                if grade_scale_id:
+                    grade = to_numeric(grade_scale_id, grade)
+                if boost:
+                    enrollments = year_enrollments.get((student_id, year_id), [])
+                    if not grade_scale_id:
+                        boost_sum = sum(course_boost for enrollment_id, credits, course_boost in enrollments)
+                        if not boost_sum:
+                            boost_sum = 0.0
+                        try:
+                            boost_factor = boost_sum / len(enrollments)
+                        except ZeroDivisionError:
+                            boost_factor = 0.0
+                    else:
+                        boost_sum = 0.0
+                        total_credits = 0.0
+                        for enrollment_id, course_credits, course_boost in enrollments:
+                            numeric_grade = self.numeric_grades.get(enrollment_id)
+                            if numeric_grade:
+                                course_grade = Decimal(numeric_grade)
+                                total_credits += float(course_credits)
+                                if to_numeric(grade_scale_id, course_grade) > 0:
+                                    # only add boost to grades that are not failing...
+                                    boost_sum += float(course_boost*course_credits)
+                        try:
+                            boost_factor = boost_sum / total_credits
+                        except ZeroDivisionError:
+                            boost_factor = None
+                    if len(enrollments) > 0 and boost_factor and grade:
+                        grade = float(grade) + float(boost_factor)
+                if rounding:
+                    grade = round_as_decimal(grade, rounding)
+                if grade:
+                    total += grade * year_credits
+                    years_with_grade += year_credits
+            gpa = None
+            if years_with_grade:
+                gpa = round_as_decimal(total / years_with_grade, decimal_places=rounding)
+            values[student_id] = {
+                'cached_gpa': gpa,
+                'gpa_recalculation_needed': False,
+            }
+        return values
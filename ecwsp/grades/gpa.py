@@ -0,0 +1,212 @@
+""" GPA for many students at once
+
+Student.calculate_gpa walks each StudentYearGrade and each of its
+enrollments, which costs several queries per student. calculate_gpas loads
+every (student, year, enrollment) row for a group of students with a few
+queries and computes year grades, scaling, boosts and the gpa with NumPy.
+Arithmetic is done in floats, then rounded like the per object code.
+"""
+from django.db.models import Count, Q
+from ecwsp.sis.models import SchoolYear, get_grade_scale_index
+from ecwsp.sis.helper_functions import round_as_decimal, chunks
+from ecwsp.schedule.models import CourseEnrollment, MarkingPeriod
+from .models import StudentYearGrade
+from .bulk_cache import final_grade_averages, final_grades
+from decimal import Decimal, ROUND_HALF_UP
+
+import numpy as np
+
+
+def scale_to_numeric(grade_scale_id, grades):
+    """ GradeScale.to_numeric over a float array, nan where there is no rule """
+    index = get_grade_scale_index(grade_scale_id)
+    bounds = np.array([float(bound) for bound in index.bounds], dtype=float)
+
+    def numeric(rules):
+        return np.array(
+            [np.nan if rule is None or rule.numeric_scale is None else float(rule.numeric_scale)
+             for rule in rules], dtype=float)
+
+    point_values = numeric(index.point_rules)
+    gap_values = numeric(index.gap_rules)
+    result = np.full(len(grades), np.nan)
+    if not len(bounds):
+        return result
+    i = np.searchsorted(bounds, grades, side='left')
+    on_point = (i < len(bounds)) & (bounds[np.minimum(i, len(bounds) - 1)] == grades)
+    result[on_point] = point_values[i[on_point]]
+    result[~on_point] = gap_values[i[~on_point]]
+    result[np.isnan(grades)] = np.nan
+    return result
+
+
+def _nan(value):
+    if value is None:
+        return np.nan
+    return float(value)
+
+
+def _scale_ids(scale_ids):
+    """ Distinct grade scale ids in an array, 0 means no scale """
+    return set(int(scale_id) for scale_id in scale_ids if scale_id)
+
+
+def calculate_gpas(student_ids, date_report=None, rounding=2, prescale=False, boost=True):
+    """ Student.calculate_gpa for every student in student_ids
+    Takes the same options as Student.calculate_gpa
+    returns {student_id: gpa}, None for students without a gpa
+    """
+    student_ids = set(student_ids)
+    gpas = dict((student_id, None) for student_id in student_ids)
+    if not student_ids:
+        return gpas
+
+    years = {}
+    year_filter = Q(markingperiod__show_reports=True)
+    if date_report:
+        year_filter &= Q(start_date__lt=date_report)
+    for year_id, grade_scale_id, end_date in SchoolYear.objects.filter(
+            year_filter).distinct().values_list('id', 'grade_scale', 'end_date'):
+        years[year_id] = (grade_scale_id, end_date, 1.0)
+    if date_report:
+        # Fraction of an unfinished year that is complete
+        all_mps = dict(MarkingPeriod.objects.values('school_year').annotate(
+            count=Count('id')).values_list('school_year', 'count'))
+        complete_mps = dict(MarkingPeriod.objects.filter(end_date__lte=date_report).values(
+            'school_year').annotate(count=Count('id')).values_list('school_year', 'count'))
+        for year_id, (grade_scale_id, end_date, fraction) in years.items():
+            if date_report < end_date:
+                fraction = float(complete_mps.get(year_id, 0)) / all_mps[year_id]
+            years[year_id] = (grade_scale_id, end_date, fraction)
+
+    year_grades = []
+    stale_year_grades = []
+    for student_chunk in chunks(student_ids):
+        for year_grade_id, student_id, year_id, credits, recalculation_needed in StudentYearGrade.objects.filter(
+                student__in=student_chunk,
+                year__in=years.keys(),
+                ).values_list('id', 'student_id', 'year_id', 'cached_credits', 'credits_recalculation_needed'):
+            if recalculation_needed:
+                stale_year_grades.append(year_grade_id)
+            year_grades.append((student_id, year_id, credits))
+    if not year_grades:
+        return gpas
+    if stale_year_grades:
+        # Reading credits recalculates and saves the stale cache
+        stale_credits = dict(
+            ((year_grade.student_id, year_grade.year_id), year_grade.credits)
+            for year_grade in StudentYearGrade.objects.filter(id__in=stale_year_grades))
+        year_grades = [(student_id, year_id, stale_credits.get((student_id, year_id), credits))
+                       for student_id, year_id, credits in year_grades]
+    group_index = dict(((student_id, year_id), i) for i, (student_id, year_id, credits) in enumerate(year_grades))
+    n_groups = len(year_grades)
+
+    # One row per enrollment per reported marking period, like the
+    # (not distinct) enrollment queryset in StudentYearGrade.get_grade
+    rows = []
+    for student_chunk in chunks(student_ids):
+        rows += CourseEnrollment.objects.filter(
+            user__in=student_chunk,
+            course_section__marking_period__show_reports=True,
+            course_section__course__credits__isnull=False,
+            course_section__course__course_type__weight__gt=0,
+        ).values_list(
+            'user_id',
+            'course_section__marking_period__school_year',
+            'id',
+            'course_section_id',
+            'course_section__course__credits',
+            'course_section__course__course_type__boost',
+            'cached_numeric_grade',
+            'numeric_grade_recalculation_needed',
+        )
+    rows = [row for row in rows if (row[0], row[1]) in group_index]
+    stale = dict((row[2], CourseEnrollment(id=row[2], user_id=row[0], course_section_id=row[3]))
+                 for row in rows if row[7])
+    if stale:
+        # Same value cache_grades would store as the numeric grade
+        recalculated = CourseEnrollment.calculate_grades_real(stale.values())
+        numeric_grades = {}
+        for enrollment_id, numeric_grade in recalculated.iteritems():
+            if isinstance(numeric_grade, Decimal):
+                numeric_grades[enrollment_id] = numeric_grade.quantize(Decimal(".01"), rounding=ROUND_HALF_UP)
+        rows = [row[:6] + (numeric_grades.get(row[2]) if row[7] else row[6],) for row in rows]
+
+    # Final grades, once per enrollment and year
+    distinct_rows = []
+    seen = set()
+    for row in rows:
+        if (row[2], row[1]) not in seen:
+            seen.add((row[2], row[1]))
+            distinct_rows.append(row)
+    keys = [(row[3], row[0]) for row in distinct_rows]
+    averages = final_grade_averages(student_ids, date_report=date_report)
+    grades = final_grades(keys, averages, date_report=date_report, ignore_letter=True)
+
+    group = np.array([group_index[(row[0], row[1])] for row in distinct_rows], dtype=int)
+    grade = np.array([_nan(grades[key]) for key in keys], dtype=float)
+    credits = np.array([float(row[4]) for row in distinct_rows], dtype=float)
+    scale_ids = np.array([years[row[1]][0] or 0 for row in distinct_rows], dtype=int)
+    # calculate_grade_and_credits skips empty and zero grades
+    has_grade = ~np.isnan(grade) & (grade != 0)
+    if prescale:
+        for grade_scale_id in _scale_ids(scale_ids):
+            in_scale = scale_ids == grade_scale_id
+            grade[in_scale] = scale_to_numeric(grade_scale_id, grade[in_scale])
+    grade_credits = np.bincount(group, np.where(has_grade, credits, 0), minlength=n_groups)
+    grade_total = np.bincount(group, np.where(has_grade, np.nan_to_num(grade) * credits, 0), minlength=n_groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        year_grade = np.where(grade_credits > 0, grade_total / grade_credits, np.nan)
+
+    group_years = np.array([year_id for student_id, year_id, year_credits in year_grades])
+    group_scale_ids = np.array([years[year_id][0] or 0 for year_id in group_years], dtype=int)
+    if not prescale:
+        for grade_scale_id in _scale_ids(group_scale_ids):
+            in_scale = group_scale_ids == grade_scale_id
+            year_grade[in_scale] = scale_to_numeric(grade_scale_id, year_grade[in_scale])
+
+    if boost and rows:
+        row_group = np.array([group_index[(row[0], row[1])] for row in rows], dtype=int)
+        row_credits = np.array([float(row[4]) for row in rows], dtype=float)
+        row_boost = np.array([float(row[5]) for row in rows], dtype=float)
+        row_numeric = np.array([_nan(row[6]) for row in rows], dtype=float)
+        row_scale_ids = np.array([years[row[1]][0] or 0 for row in rows], dtype=int)
+        row_count = np.bincount(row_group, minlength=n_groups)
+        # Years without a scale average the boost of every enrollment
+        boost_sum = np.bincount(row_group, row_boost, minlength=n_groups)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            boost_factor = np.where(row_count > 0, boost_sum / row_count, 0.0)
+        # Years with a scale weigh by credits and skip failing grades
+        scaled = row_scale_ids != 0
+        if scaled.any():
+            row_scaled = np.full(len(rows), np.nan)
+            for grade_scale_id in _scale_ids(row_scale_ids):
+                in_scale = row_scale_ids == grade_scale_id
+                row_scaled[in_scale] = scale_to_numeric(grade_scale_id, row_numeric[in_scale])
+            counted = scaled & ~np.isnan(row_numeric) & (row_numeric != 0)
+            passing = counted & (np.nan_to_num(row_scaled) > 0)
+            scaled_credits = np.bincount(row_group, np.where(counted, row_credits, 0), minlength=n_groups)
+            scaled_boost = np.bincount(row_group, np.where(passing, row_boost * row_credits, 0), minlength=n_groups)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                scaled_factor = np.where(scaled_credits > 0, scaled_boost / scaled_credits, 0.0)
+            boost_factor = np.where(group_scale_ids != 0, scaled_factor, boost_factor)
+        boosted = (row_count > 0) & (boost_factor != 0) & ~np.isnan(year_grade) & (year_grade != 0)
+        year_grade = np.where(boosted, year_grade + boost_factor, year_grade)
+
+    totals = {}
+    for i, (student_id, year_id, year_credits) in enumerate(year_grades):
+        value = year_grade[i]
+        if np.isnan(value):
+            continue
+        if rounding:
+            value = round_as_decimal(value, rounding)
+        if value and year_credits:
+            fraction = years[year_id][2]
+            total, total_credits = totals.get(student_id, (0.0, 0.0))
+            totals[student_id] = (
+                total + float(value) * float(year_credits) * fraction,
+                total_credits + float(year_credits) * fraction)
+    for student_id, (total, total_credits) in totals.iteritems():
+        if total_credits:
+            gpas[student_id] = round_as_decimal(total / total_credits, decimal_places=rounding)
+    return gpas
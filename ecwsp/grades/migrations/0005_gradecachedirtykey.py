@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sis', '0004_auto_20150126_1540'),
+        ('schedule', '0004_auto_20150102_1238'),
+        ('grades', '0004_auto_20150204_0811'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GradeCacheDirtyKey',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('course_section', models.ForeignKey(blank=True, to='schedule.CourseSection', null=True)),
+                ('marking_period', models.ForeignKey(blank=True, to='schedule.MarkingPeriod', null=True)),
+                ('student', models.ForeignKey(to='sis.Student')),
+                ('year', models.ForeignKey(blank=True, to='sis.SchoolYear', null=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+    ]
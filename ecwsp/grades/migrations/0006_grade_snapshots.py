@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sis', '0004_auto_20150126_1540'),
+        ('schedule', '0004_auto_20150102_1238'),
+        ('grades', '0005_gradecachedirtykey'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CourseEnrollmentSnapshot',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('date', models.DateField()),
+                ('grade', models.CharField(max_length=8, blank=True)),
+                ('numeric_grade', models.DecimalField(null=True, max_digits=9, decimal_places=4, blank=True)),
+                ('enrollment', models.ForeignKey(to='schedule.CourseEnrollment')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='courseenrollmentsnapshot',
+            unique_together=set([('enrollment', 'date')]),
+        ),
+        migrations.CreateModel(
+            name='StudentGpaSnapshot',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('date', models.DateField()),
+                ('gpa', models.DecimalField(null=True, max_digits=5, decimal_places=2, blank=True)),
+                ('student', models.ForeignKey(to='sis.Student')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='studentgpasnapshot',
+            unique_together=set([('student', 'date')]),
+        ),
+        migrations.CreateModel(
+            name='StudentYearGradeSnapshot',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('date', models.DateField()),
+                ('grade', models.DecimalField(null=True, max_digits=9, decimal_places=4, blank=True)),
+                ('credits', models.DecimalField(null=True, max_digits=5, decimal_places=2, blank=True)),
+                ('year_grade', models.ForeignKey(to='grades.StudentYearGrade')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='studentyeargradesnapshot',
+            unique_together=set([('year_grade', 'date')]),
+        ),
+    ]
@@ -1,18 +1,20 @@
 from django.core.exceptions import ValidationError
-from django.db import models, connection
-from django.db.models import Count, Sum
+from django.db import models, connection, transaction, IntegrityError
+from django.db.models import Count
 from django.conf import settings
 from django.core.validators import MaxLengthValidator
-from ecwsp.sis.models import Student, GradeScaleRule
-from ecwsp.sis.helper_functions import round_as_decimal
+from ecwsp.sis.models import Student, GradeScaleRule, get_grade_scale_index
+from ecwsp.sis.helper_functions import round_as_decimal, chunks
 from ecwsp.administration.models import Configuration
 from django_cached_field import CachedDecimalField
+from functools import wraps
 
 import decimal
 from decimal import Decimal
 import datetime
 import ecwsp
 import logging
+import threading
 
 
 class GradeComment(models.Model):
@@ -67,7 +69,11 @@ class StudentMarkingPeriodGrade(models.Model):
         )
 
         for grade in grades:
-            grade_value = float(grade.optimized_grade_to_scale(letter=False))
+            grade_value = grade.optimized_grade_to_scale(letter=False)
+            if grade_value is None:
+                # No grade scale rule covers this grade
+                continue
+            grade_value = float(grade_value)
             if grade_value > 0 and boost:
                 # only add boost for non-failing grades
                 grade_value += float(grade.course_section.course.course_type.boost)
@@ -155,13 +161,16 @@ class StudentYearGrade(models.Model):
         credits = Decimal(0)
         prescaled_grade = Decimal(0)
         grade_scale = self.year.grade_scale
-        for course_enrollment in self.student.courseenrollment_set.filter(
+        course_enrollments = self.student.courseenrollment_set.filter(
             course_section__marking_period__show_reports=True,
             course_section__marking_period__school_year=self.year,
             course_section__course__credits__isnull=False,
             course_section__course__course_type__weight__gt=0,
-            ).distinct():
-            grade = course_enrollment.calculate_grade_real(date_report=date_report, ignore_letter=True)
+            ).distinct().select_related('course_section__course')
+        grades = ecwsp.schedule.models.CourseEnrollment.calculate_grades_real(
+            course_enrollments, date_report=date_report, ignore_letter=True)
+        for course_enrollment in course_enrollments:
+            grade = grades[course_enrollment.id]
             if grade:
                 num_credits = course_enrollment.course_section.course.credits
                 if prescale:
@@ -202,23 +211,29 @@ class StudentYearGrade(models.Model):
             # Cache will always have the latest grade, so it's fine for
             # today's date and any future date
             return self.grade
-        grade = self.calculate_grade(date_report=date_report, prescale=prescale)
+        if date_report is not None and not prescale:
+            grade = StudentYearGradeSnapshot.lookup(self, date_report)[0]
+        else:
+            grade = self.calculate_grade(date_report=date_report, prescale=prescale)
         if numeric_scale == True:
             grade_scale = self.year.grade_scale
             if grade_scale and not prescale:
                 grade = grade_scale.to_numeric(grade)
             if boost:
-                enrollments = self.student.courseenrollment_set.filter(
+                enrollments = list(self.student.courseenrollment_set.filter(
                     course_section__marking_period__show_reports=True,
                     course_section__marking_period__school_year=self.year,
                     course_section__course__credits__isnull=False,
-                    course_section__course__course_type__weight__gt=0,)
+                    course_section__course__course_type__weight__gt=0,
+                    ).select_related('course_section__course__course_type'))
                 if not grade_scale:
-                    boost_sum = enrollments.aggregate(boost_sum=Sum('course_section__course__course_type__boost'))['boost_sum']
+                    boost_sum = sum(
+                        enrollment.course_section.course.course_type.boost
+                        for enrollment in enrollments)
                     if not boost_sum:
                         boost_sum = 0.0
                     try:
-                        boost_factor = boost_sum / enrollments.count()
+                        boost_factor = boost_sum / len(enrollments)
                     except ZeroDivisionError:
                         boost_factor = 0.0
                 else:
@@ -238,7 +253,7 @@ class StudentYearGrade(models.Model):
                         boost_factor = boost_sum / total_credits
                     except ZeroDivisionError:
                         boost_factor = None
-                if enrollments.count() > 0 and boost_factor and grade:
+                if len(enrollments) > 0 and boost_factor and grade:
                     grade = float(grade) + float(boost_factor)
         if rounding:
             grade = round_as_decimal(grade, rounding)
@@ -247,6 +262,334 @@ class StudentYearGrade(models.Model):
 #signals.post_save.connect(StudentYearGrade.build_all_cache, sender=Student)
 
 
+class GradeCacheDirtyKey(models.Model):
+    """ Grade cache that needs to be recalculated, only used for cache
+    Written by grade, mark and enrollment changes. Drained in coalesced
+    batches by ecwsp.grades.tasks.process_dirty_grade_cache
+    Blank course_section, marking_period or year mean "not known", they are
+    worked out from the other fields when the key is drained.
+    """
+    student = models.ForeignKey('sis.Student')
+    course_section = models.ForeignKey('schedule.CourseSection', blank=True, null=True)
+    marking_period = models.ForeignKey('schedule.MarkingPeriod', blank=True, null=True)
+    year = models.ForeignKey('sis.SchoolYear', blank=True, null=True)
+
+    @staticmethod
+    def add_keys(keys):
+        """ keys: iterable of
+        (student_id, course_section_id, marking_period_id, year_id) """
+        GradeCacheDirtyKey.objects.bulk_create([
+            GradeCacheDirtyKey(
+                student_id=student_id,
+                course_section_id=course_section_id,
+                marking_period_id=marking_period_id,
+                year_id=year_id,
+            ) for student_id, course_section_id, marking_period_id, year_id in set(keys)])
+
+
+def get_snapshot_date(date_report):
+    """ Date a date_report bounded grade is snapshotted under
+    None when it can't be snapshotted, because nothing has closed by
+    date_report or because grades may still change on that date """
+    snapshot_date = ecwsp.schedule.models.get_grade_change_date(date_report)
+    if snapshot_date is not None and snapshot_date < datetime.date.today():
+        return snapshot_date
+
+
+def clear_grade_snapshots(student_ids=None, from_date=None, enrollments=True):
+    """ Delete snapshots that may no longer be correct
+    student_ids: only these students' snapshots
+    from_date: only snapshots on or after this date
+    enrollments: False to keep course enrollment snapshots """
+    snapshot_models = [
+        (StudentYearGradeSnapshot, 'year_grade__student'),
+        (StudentGpaSnapshot, 'student')]
+    if enrollments:
+        snapshot_models.append((CourseEnrollmentSnapshot, 'enrollment__user'))
+    for model, student_field in snapshot_models:
+        snapshots = model.objects.all()
+        if student_ids is not None:
+            snapshots = snapshots.filter(**{student_field + '__in': student_ids})
+        if from_date is not None:
+            snapshots = snapshots.filter(date__gte=from_date)
+        snapshots.delete()
+
+
+def save_snapshots(model, snapshots, field):
+    """ Bulk create snapshots, unless another process created some of
+    them first. Then save one at a time, keeping the existing rows. """
+    try:
+        with transaction.atomic():
+            model.objects.bulk_create(snapshots)
+    except IntegrityError:
+        key_fields = ('id', 'date', field + '_id')
+        for snapshot in snapshots:
+            model.objects.get_or_create(
+                date=snapshot.date,
+                defaults=dict((f.attname, getattr(snapshot, f.attname))
+                              for f in model._meta.fields if f.attname not in key_fields),
+                **{field + '_id': getattr(snapshot, field + '_id')})
+
+
+class CourseEnrollmentSnapshot(models.Model):
+    """ CourseEnrollment final grade as of a past date, only used for cache
+    Filled lazily and by the snapshot_grades task """
+    enrollment = models.ForeignKey('schedule.CourseEnrollment')
+    date = models.DateField()
+    grade = models.CharField(max_length=8, blank=True)
+    numeric_grade = models.DecimalField(max_digits=9, decimal_places=4, blank=True, null=True)
+
+    class Meta:
+        unique_together = ('enrollment', 'date')
+
+    @staticmethod
+    def lookup(enrollment, date_report):
+        """ enrollment.calculate_grade_real(date_report=date_report) """
+        snapshot_date = get_snapshot_date(date_report)
+        if snapshot_date is None:
+            return enrollment.calculate_grade_real(date_report=date_report)
+        snapshot = CourseEnrollmentSnapshot.objects.filter(
+            enrollment=enrollment, date=snapshot_date).first()
+        if snapshot is None:
+            grade = enrollment.calculate_grade_real(date_report=snapshot_date)
+            if isinstance(grade, Decimal):
+                snapshot = CourseEnrollmentSnapshot(numeric_grade=grade)
+            else:
+                snapshot = CourseEnrollmentSnapshot(grade=grade or '')
+            snapshot = CourseEnrollmentSnapshot.objects.get_or_create(
+                enrollment=enrollment, date=snapshot_date,
+                defaults={'grade': snapshot.grade, 'numeric_grade': snapshot.numeric_grade})[0]
+        return snapshot.get_grade()
+
+    @staticmethod
+    def lookup_many(enrollments, date_report):
+        """ lookup for many enrollments at once
+        returns {enrollment id: grade} """
+        enrollments = list(enrollments)
+        snapshot_date = get_snapshot_date(date_report)
+        if snapshot_date is None:
+            return ecwsp.schedule.models.CourseEnrollment.calculate_grades_real(
+                enrollments, date_report=date_report)
+        snapshots = {}
+        for enrollment_chunk in chunks([enrollment.id for enrollment in enrollments]):
+            for snapshot in CourseEnrollmentSnapshot.objects.filter(
+                    enrollment__in=enrollment_chunk, date=snapshot_date):
+                snapshots[snapshot.enrollment_id] = snapshot
+        missing = [enrollment for enrollment in enrollments if enrollment.id not in snapshots]
+        if missing:
+            grades = ecwsp.schedule.models.CourseEnrollment.calculate_grades_real(
+                missing, date_report=snapshot_date)
+            new_snapshots = []
+            for enrollment in missing:
+                grade = grades[enrollment.id]
+                if isinstance(grade, Decimal):
+                    snapshot = CourseEnrollmentSnapshot(numeric_grade=grade)
+                else:
+                    snapshot = CourseEnrollmentSnapshot(grade=grade or '')
+                snapshot.enrollment_id = enrollment.id
+                snapshot.date = snapshot_date
+                new_snapshots.append(snapshot)
+            save_snapshots(CourseEnrollmentSnapshot, new_snapshots, 'enrollment')
+            for snapshot in new_snapshots:
+                snapshots[snapshot.enrollment_id] = snapshot
+        return dict((pk, snapshot.get_grade()) for pk, snapshot in snapshots.iteritems())
+
+    def get_grade(self):
+        if self.numeric_grade is not None:
+            return self.numeric_grade
+        return self.grade or None
+
+
+class StudentYearGradeSnapshot(models.Model):
+    """ StudentYearGrade grade and credits as of a past date, only used for cache """
+    year_grade = models.ForeignKey(StudentYearGrade)
+    date = models.DateField()
+    grade = models.DecimalField(max_digits=9, decimal_places=4, blank=True, null=True)
+    credits = models.DecimalField(max_digits=5, decimal_places=2, blank=True, null=True)
+
+    class Meta:
+        unique_together = ('year_grade', 'date')
+
+    @staticmethod
+    def lookup(year_grade, date_report):
+        """ year_grade.calculate_grade_and_credits(date_report=date_report) """
+        snapshot_date = get_snapshot_date(date_report)
+        if snapshot_date is None:
+            return year_grade.calculate_grade_and_credits(date_report=date_report)
+        snapshot = StudentYearGradeSnapshot.objects.filter(
+            year_grade=year_grade, date=snapshot_date).first()
+        if snapshot is None:
+            grade, credits = year_grade.calculate_grade_and_credits(date_report=snapshot_date)
+            snapshot = StudentYearGradeSnapshot.objects.get_or_create(
+                year_grade=year_grade, date=snapshot_date,
+                defaults={'grade': grade, 'credits': credits})[0]
+        return (snapshot.grade, snapshot.credits)
+
+    @staticmethod
+    def lookup_many(year_grades, date_report):
+        """ lookup for many year grades at once
+        returns {year grade id: (grade, credits)} """
+        year_grades = list(year_grades)
+        snapshot_date = get_snapshot_date(date_report)
+        if snapshot_date is None:
+            return dict((year_grade.id, year_grade.calculate_grade_and_credits(date_report=date_report))
+                        for year_grade in year_grades)
+        snapshots = {}
+        for year_grade_chunk in chunks([year_grade.id for year_grade in year_grades]):
+            for snapshot in StudentYearGradeSnapshot.objects.filter(
+                    year_grade__in=year_grade_chunk, date=snapshot_date):
+                snapshots[snapshot.year_grade_id] = snapshot
+        new_snapshots = []
+        for year_grade in year_grades:
+            if year_grade.id not in snapshots:
+                grade, credits = year_grade.calculate_grade_and_credits(date_report=snapshot_date)
+                new_snapshots.append(StudentYearGradeSnapshot(
+                    year_grade_id=year_grade.id, date=snapshot_date, grade=grade, credits=credits))
+        save_snapshots(StudentYearGradeSnapshot, new_snapshots, 'year_grade')
+        for snapshot in new_snapshots:
+            snapshots[snapshot.year_grade_id] = snapshot
+        return dict((pk, (snapshot.grade, snapshot.credits)) for pk, snapshot in snapshots.iteritems())
+
+
+class StudentGpaSnapshot(models.Model):
+    """ Student gpa as of a past date, only used for cache
+    Only the default rounding, prescale and boost options are kept """
+    student = models.ForeignKey('sis.Student')
+    date = models.DateField()
+    gpa = models.DecimalField(max_digits=5, decimal_places=2, blank=True, null=True)
+
+    class Meta:
+        unique_together = ('student', 'date')
+
+    @staticmethod
+    def lookup(student, date_report):
+        """ student.calculate_gpa_real(date_report=date_report) """
+        snapshot_date = get_snapshot_date(date_report)
+        if snapshot_date is None:
+            return student.calculate_gpa_real(date_report=date_report)
+        snapshot = StudentGpaSnapshot.objects.filter(
+            student=student, date=snapshot_date).first()
+        if snapshot is None:
+            snapshot = StudentGpaSnapshot.objects.get_or_create(
+                student=student, date=snapshot_date,
+                defaults={'gpa': student.calculate_gpa_real(date_report=snapshot_date)})[0]
+        return snapshot.gpa
+
+
+def invalidate_grades(keys):
+    """ Invalidate the caches related to many grades at once
+    keys: iterable of
+    (student_id, course_section_id, marking_period_id, override_final)
+    Cached rows are only flagged as stale here, so reading them is still
+    correct. Recalculating them is left to process_dirty_grade_cache """
+    keys = set(keys)
+    if not keys:
+        return
+    CourseEnrollment = ecwsp.schedule.models.CourseEnrollment
+    MarkingPeriod = ecwsp.schedule.models.MarkingPeriod
+    student_ids = sorted(set(key[0] for key in keys))
+    section_ids = set(key[1] for key in keys)
+    marking_period_ids = set(key[2] for key in keys if key[2] is not None)
+    enrollments = set((key[0], key[1]) for key in keys)
+    marking_periods = set((key[0], key[2]) for key in keys)
+
+    marking_period_filter = models.Q(marking_period__in=marking_period_ids)
+    if any(key[2] is None for key in keys):
+        marking_period_filter |= models.Q(marking_period__isnull=True)
+    for student_chunk in chunks(student_ids):
+        enrollment_ids = [
+            pk for pk, student_id, section_id in CourseEnrollment.objects.filter(
+                user__in=student_chunk, course_section__in=section_ids,
+            ).values_list('id', 'user_id', 'course_section_id')
+            if (student_id, section_id) in enrollments]
+        CourseEnrollment.objects.filter(pk__in=enrollment_ids).update(
+            grade_recalculation_needed=True, numeric_grade_recalculation_needed=True)
+        mp_grade_ids = [
+            pk for pk, student_id, marking_period_id in StudentMarkingPeriodGrade.objects.filter(
+                marking_period_filter, student__in=student_chunk,
+            ).values_list('id', 'student_id', 'marking_period_id')
+            if (student_id, marking_period_id) in marking_periods]
+        StudentMarkingPeriodGrade.objects.filter(pk__in=mp_grade_ids).update(
+            grade_recalculation_needed=True)
+        StudentYearGrade.objects.filter(
+            student__in=student_chunk,
+            year__markingperiod__coursesection__in=section_ids,
+        ).update(grade_recalculation_needed=True, credits_recalculation_needed=True)
+        Student.objects.filter(pk__in=student_chunk).update(gpa_recalculation_needed=True)
+        # Year grade and gpa snapshots use current credits and the current
+        # enrollment grades for boost, so any grade change can alter them
+        clear_grade_snapshots(student_ids=student_chunk, enrollments=False)
+
+    # Enrollment snapshots on or after the first closed marking period touched
+    end_dates = dict(MarkingPeriod.objects.filter(
+        id__in=marking_period_ids).values_list('id', 'end_date'))
+    today = datetime.date.today()
+    from_dates = {}
+    for student_id, section_id, marking_period_id, override_final in keys:
+        if override_final or marking_period_id is None:
+            from_date = datetime.date.min
+        elif end_dates[marking_period_id] < today:
+            from_date = end_dates[marking_period_id]
+        else:
+            continue
+        from_dates[student_id] = min(from_date, from_dates.get(student_id, from_date))
+    students_by_date = {}
+    for student_id, from_date in from_dates.iteritems():
+        students_by_date.setdefault(from_date, []).append(student_id)
+    for from_date, date_student_ids in students_by_date.iteritems():
+        if from_date == datetime.date.min:
+            from_date = None
+        for student_chunk in chunks(date_student_ids):
+            clear_grade_snapshots(student_ids=student_chunk, from_date=from_date)
+
+    GradeCacheDirtyKey.add_keys(
+        (student_id, section_id, marking_period_id, None)
+        for student_id, section_id, marking_period_id, override_final in keys)
+
+
+_deferred_invalidation = threading.local()
+
+def invalidate_grade_keys(keys):
+    """ invalidate_grades, or only record the keys inside deferred_invalidation
+    For code that updates grades without Grade.save """
+    if getattr(_deferred_invalidation, 'keys', None) is not None:
+        _deferred_invalidation.keys.update(keys)
+    else:
+        invalidate_grades(keys)
+
+
+class deferred_invalidation(object):
+    """ Context manager and decorator that collects Grade.invalidate_cache
+    calls and runs them together with invalidate_grades at exit.
+    Use it around code that writes many grades, such as imports.
+
+        with deferred_invalidation():
+            for grade in grades:
+                grade.save()
+    """
+    def __enter__(self):
+        self.outermost = getattr(_deferred_invalidation, 'keys', None) is None
+        if self.outermost:
+            _deferred_invalidation.keys = set()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.outermost:
+            return
+        keys = _deferred_invalidation.keys
+        _deferred_invalidation.keys = None
+        # Queries fail in a transaction that is about to roll back, and the
+        # grades go away with it anyway.
+        if exc_type is None or not connection.needs_rollback:
+            invalidate_grades(keys)
+
+    def __call__(self, func):
+        @wraps(func)
+        def inner(*args, **kwargs):
+            with deferred_invalidation():
+                return func(*args, **kwargs)
+        return inner
+
+
 letter_grade_choices = (
     ("I", "Incomplete"),
     ("P", "Pass"),
@@ -326,25 +669,25 @@ class Grade(models.Model):
         raise ValidationError('Invalid letter grade.')
 
     def invalidate_cache(self):
-        """ Invalidate any related caches """
-        try:
-            enrollment = self.course_section.courseenrollment_set.get(user=self.student)
-            enrollment.flag_grade_as_stale()
-            enrollment.flag_numeric_grade_as_stale()
-        except ecwsp.schedule.models.CourseEnrollment.DoesNotExist:
-            pass
-        self.student.cached_gpa = self.student.calculate_gpa()
-        if self.student.cached_gpa != "N/A":
-            self.student.save()
+        """ Invalidate any related caches
+        Inside deferred_invalidation this is only recorded, see invalidate_grades """
+        key = (self.student_id, self.course_section_id, self.marking_period_id, self.override_final)
+        if getattr(_deferred_invalidation, 'keys', None) is not None:
+            _deferred_invalidation.keys.add(key)
+        else:
+            invalidate_grades([key])
+            self.student.gpa_recalculation_needed = True
 
     def optimized_grade_to_scale(self, letter):
         """ Optimized version of GradeScale.to_letter
         letter - True for letter grade, false for numeric (ex: 4.0 scale) """
-        rule = GradeScaleRule.objects.filter(
-                grade_scale__schoolyear__markingperiod=self.marking_period_id,
-                min_grade__lte=self.grade,
-                max_grade__gte=self.grade,
-                ).first()
+        grade_scale_id = ecwsp.schedule.models.get_marking_period_grade_scale_id(
+            self.marking_period_id)
+        rule = None
+        if grade_scale_id:
+            rule = get_grade_scale_index(grade_scale_id).get_rule(self.grade)
+        if rule is None:
+            return None
         if letter:
             return rule.letter_grade
         return rule.numeric_scale
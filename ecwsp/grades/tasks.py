@@ -1,14 +1,24 @@
 from celery.decorators import periodic_task
-from .models import StudentMarkingPeriodGrade, StudentYearGrade
+from .models import StudentMarkingPeriodGrade, StudentYearGrade, GradeCacheDirtyKey
+from .models import CourseEnrollmentSnapshot, StudentYearGradeSnapshot, StudentGpaSnapshot
+from .bulk_cache import BulkGradeCache
+from ecwsp.sis.helper_functions import chunks
 from ecwsp.sis.models import Student
 from ecwsp.sis.helper_functions import all_tenants
 from ecwsp.schedule.models import CourseEnrollment
 from django_sis.celery import app
 from django.conf import settings
+import datetime
 
 @app.task
-def build_grade_cache():
-    """ Rebuild all grade related cache in the world """
+def build_grade_cache(bulk=True):
+    """ Rebuild all grade related cache in the world
+    bulk: compute everything with a few grouped queries (see BulkGradeCache)
+    instead of recalculating one object at a time. Both give the same results.
+    """
+    if bulk:
+        BulkGradeCache().build()
+        return
     StudentMarkingPeriodGrade.build_all_cache()
     StudentYearGrade.build_all_cache()
     for student in Student.objects.all():
@@ -25,3 +35,51 @@ def build_grade_cache():
 @all_tenants
 def build_grade_cache_task():
     build_grade_cache()
+
+
+@app.task
+def process_dirty_grade_cache(batch_size=500):
+    """ Recalculate only the grade cache rows queued in GradeCacheDirtyKey
+    Keys are coalesced per student, batch_size students at a time """
+    dirty_keys = GradeCacheDirtyKey.objects.all()
+    last_key = dirty_keys.order_by('id').last()
+    if last_key is None:
+        return
+    # Keys written while we work are left for the next run
+    dirty_keys = dirty_keys.filter(id__lte=last_key.id)
+    student_ids = set(dirty_keys.values_list('student_id', flat=True))
+    for student_chunk in chunks(sorted(student_ids), batch_size):
+        batch = dirty_keys.filter(student_id__in=student_chunk)
+        BulkGradeCache(dirty_keys=batch.values_list(
+            'student_id', 'course_section_id', 'marking_period_id', 'year_id')).build()
+        batch.delete()
+
+
+@app.task
+@all_tenants
+def process_dirty_grade_cache_task():
+    process_dirty_grade_cache()
+
+
+@app.task
+def snapshot_grades(date=None):
+    """ Snapshot date bounded grades for students in marking periods that
+    closed on date (default yesterday). Other dates are filled lazily. """
+    if date is None:
+        date = datetime.date.today() - datetime.timedelta(days=1)
+    enrollments = CourseEnrollment.objects.filter(
+        course_section__marking_period__end_date=date).distinct()
+    for enrollment in enrollments:
+        CourseEnrollmentSnapshot.lookup(enrollment, date)
+    students = Student.objects.filter(
+        courseenrollment__course_section__marking_period__end_date=date).distinct()
+    for year_grade in StudentYearGrade.objects.filter(student__in=students):
+        StudentYearGradeSnapshot.lookup(year_grade, date)
+    for student in students:
+        StudentGpaSnapshot.lookup(student, date)
+
+
+@app.task
+@all_tenants
+def snapshot_grades_task():
+    snapshot_grades()
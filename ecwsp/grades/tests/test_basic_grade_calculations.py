@@ -105,3 +105,15 @@ class GradeCalculationTests(SisTestMixin, TestCase):
         older = syg.calculate_grade_and_credits()
         self.assertEqual(current, older)
 
+
+    def test_populate_all_grades_in_bulk(self):
+        section = self.data.course_section1
+        Grade.objects.filter(course_section=section).delete()
+        with self.assertNumQueries(4):
+            section.populate_all_grades()
+        expected = section.courseenrollment_set.count() * section.marking_period.count()
+        self.assertEqual(Grade.objects.filter(course_section=section).count(), expected)
+        self.assertFalse(Grade.objects.filter(course_section=section, enrollment=None).exists())
+        # Nothing left to create the second time
+        with self.assertNumQueries(3):
+            section.populate_all_grades()
@@ -0,0 +1,118 @@
+from ecwsp.sis.tests import SisTestMixin
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from ecwsp.sis.sample_data import SisData
+from ecwsp.sis.models import Student
+from ecwsp.schedule.models import CourseEnrollment
+from ecwsp.grades.models import Grade, StudentMarkingPeriodGrade, StudentYearGrade, GradeCacheDirtyKey
+from ecwsp.grades.tasks import build_grade_cache, process_dirty_grade_cache
+from ecwsp.grades.bulk_cache import BulkGradeCache
+
+
+class BulkGradeCacheTests(SisTestMixin, TestCase):
+    """ The bulk rebuild must give the same results as the per object one """
+
+    def populate_database(self):
+        self.data = SisData()
+        self.data.create_balt_like_sample_data()
+        # Some letter grades and an override to exercise every branch
+        grade = Grade.objects.filter(student=self.data.honors_student).first()
+        grade.set_grade('P')
+        grade.save()
+        grade = Grade.objects.filter(student=self.data.sample_student1).last()
+        grade.set_grade('I')
+        grade.save()
+
+    def get_cache(self):
+        return {
+            'enrollments': list(CourseEnrollment.objects.order_by('id').values_list(
+                'id', 'cached_grade', 'cached_numeric_grade', 'grade_recalculation_needed')),
+            'mp_grades': list(StudentMarkingPeriodGrade.objects.order_by('student_id', 'marking_period_id').values_list(
+                'student', 'marking_period', 'cached_grade', 'grade_recalculation_needed')),
+            'year_grades': list(StudentYearGrade.objects.order_by('student_id', 'year_id').values_list(
+                'student', 'year', 'cached_grade', 'cached_credits', 'grade_recalculation_needed')),
+            'gpas': list(Student.objects.order_by('id').values_list(
+                'id', 'cached_gpa', 'gpa_recalculation_needed')),
+        }
+
+    def clear_cache(self):
+        StudentMarkingPeriodGrade.objects.all().delete()
+        StudentYearGrade.objects.all().delete()
+        CourseEnrollment.objects.update(cached_grade='', cached_numeric_grade=None)
+        Student.objects.update(cached_gpa=None)
+
+    def test_bulk_matches_per_object(self):
+        build_grade_cache(bulk=False)
+        expected = self.get_cache()
+        self.clear_cache()
+        build_grade_cache(bulk=True)
+        actual = self.get_cache()
+        for key in expected:
+            self.assertEqual(actual[key], expected[key])
+
+    def test_bulk_query_count(self):
+        """ Queries must not grow with the number of students """
+        with CaptureQueriesContext(connection) as queries:
+            BulkGradeCache().build()
+        self.assertLess(len(queries), 40)
+
+    def test_bulk_single_student(self):
+        build_grade_cache(bulk=False)
+        expected = self.get_cache()
+        student = self.data.honors_student
+        StudentYearGrade.objects.filter(student=student).update(cached_grade=None)
+        CourseEnrollment.objects.filter(user=student).update(cached_numeric_grade=None)
+        BulkGradeCache(student_ids=[student.id]).build()
+        self.assertEqual(self.get_cache(), expected)
+
+    def test_dirty_keys_match_per_object(self):
+        build_grade_cache(bulk=False)
+        grade = Grade.objects.filter(student=self.data.honors_student, grade__isnull=False).first()
+        grade.set_grade(grade.grade - 10)
+        grade.save()
+        self.assertTrue(GradeCacheDirtyKey.objects.filter(student=self.data.honors_student).exists())
+        process_dirty_grade_cache()
+        self.assertFalse(GradeCacheDirtyKey.objects.exists())
+        actual = self.get_cache()
+        build_grade_cache(bulk=False)
+        self.assertEqual(actual, self.get_cache())
+
+    def test_calculate_grades_real(self):
+        enrollments = CourseEnrollment.objects.all()
+        for date_report in (None, self.data.mp2.end_date):
+            for ignore_letter in (False, True):
+                grades = CourseEnrollment.calculate_grades_real(
+                    enrollments, date_report=date_report, ignore_letter=ignore_letter)
+                for enrollment in enrollments:
+                    self.assertEqual(grades[enrollment.id], enrollment.calculate_grade_real(
+                        date_report=date_report, ignore_letter=ignore_letter))
+
+
+class SyntheticSchoolTests(SisTestMixin, TestCase):
+    """ The benchmark school must behave like a real one """
+
+    def populate_database(self):
+        self.data = SisData()
+        self.data.create_required()
+        self.data.create_synthetic_school(students=12, courses=2, marking_periods=2, section_size=5)
+
+    def test_synthetic_school(self):
+        self.assertEqual(CourseEnrollment.objects.count(), 24)
+        self.assertEqual(Grade.objects.filter(grade__isnull=False).count(), 48)
+        self.assertEqual(CourseEnrollment.objects.values('course_section').distinct().count(), 6)
+        build_grade_cache(bulk=True)
+        bulk = list(Student.objects.order_by('id').values_list('id', 'cached_gpa'))
+        build_grade_cache(bulk=False)
+        self.assertEqual(list(Student.objects.order_by('id').values_list('id', 'cached_gpa')), bulk)
+
+    def test_benchmark_command(self):
+        from django.core.management import call_command
+        from django.utils.six import StringIO
+        import json
+        out = StringIO()
+        call_command('benchmark_grades', students='10', courses=2, marking_periods=2,
+                     sample=5, repeat=1, stdout=out, stderr=StringIO())
+        result = json.loads(out.getvalue())
+        self.assertEqual(result['schools'][0]['students'], 10)
+        self.assertIn('calculate_gpas', result['schools'][0]['timings'])
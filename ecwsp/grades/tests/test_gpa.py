@@ -0,0 +1,53 @@
+from django.test import TestCase
+from ecwsp.sis.tests import SisTestMixin
+from ecwsp.sis.sample_data import SisData
+from ecwsp.sis.sample_tc_data import SampleTCData
+from ecwsp.sis.models import Student
+from ecwsp.schedule.models import CourseEnrollment
+from ecwsp.grades.models import StudentYearGrade
+from ecwsp.grades.tasks import build_grade_cache
+from ecwsp.grades.gpa import calculate_gpas
+import datetime
+
+
+class GpaEngineMixin(object):
+    """ calculate_gpas must agree with Student.calculate_gpa """
+    def assertGpasMatch(self, **kwargs):
+        students = Student.objects.all()
+        gpas = calculate_gpas(students.values_list('id', flat=True), **kwargs)
+        for student in students:
+            expected = student.calculate_gpa_real(**kwargs)
+            if expected is None:
+                self.assertEqual(gpas[student.id], None)
+            else:
+                self.assertAlmostEqual(gpas[student.id], expected, places=2)
+
+
+class GpaEngineTests(GpaEngineMixin, SisTestMixin, TestCase):
+    def populate_database(self):
+        self.data = SisData()
+        self.data.create_balt_like_sample_data()
+        build_grade_cache()
+
+    def test_gpas(self):
+        self.assertGpasMatch()
+        self.assertGpasMatch(prescale=True, rounding=1)
+        self.assertGpasMatch(boost=False)
+
+    def test_gpas_with_stale_cache(self):
+        """ Stale cached credits and numeric grades are recalculated """
+        StudentYearGrade.objects.update(cached_credits=0, credits_recalculation_needed=True)
+        CourseEnrollment.objects.update(cached_numeric_grade=0, numeric_grade_recalculation_needed=True)
+        self.assertGpasMatch()
+
+
+class GpaEngineTCTests(GpaEngineMixin, TestCase):
+    def setUp(self):
+        self.data = SampleTCData()
+        self.data.create_sample_tc_data()
+        build_grade_cache()
+
+    def test_gpas(self):
+        self.assertGpasMatch()
+        for date_report in (datetime.date(2014,10,3), datetime.date(2015,1,23)):
+            self.assertGpasMatch(date_report=date_report)
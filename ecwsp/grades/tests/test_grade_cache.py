@@ -13,3 +13,18 @@ class GradeCacheTests(SisTestMixin, TestCase):
         ce = student.courseenrollment_set.filter(course_section=section).first()
         self.assertEqual(ce.grade, 'P')
 
+
+    def test_deferred_invalidation(self):
+        from ecwsp.grades.models import GradeCacheDirtyKey, deferred_invalidation
+        student = self.data.student2
+        section = self.data.course_section
+        GradeCacheDirtyKey.objects.all().delete()
+        with deferred_invalidation():
+            for grade in student.grade_set.filter(course_section=section):
+                grade.set_grade('HP')
+                grade.save()
+            self.assertFalse(GradeCacheDirtyKey.objects.exists())
+        self.assertTrue(GradeCacheDirtyKey.objects.filter(student=student, course_section=section).exists())
+        ce = student.courseenrollment_set.filter(course_section=section).first()
+        self.assertTrue(ce.grade_recalculation_needed)
+        self.assertEqual(ce.grade, 'P')
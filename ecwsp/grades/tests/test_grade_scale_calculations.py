@@ -1,7 +1,10 @@
 from ecwsp.sis.tests import SisTestMixin
 from django.test import TestCase
-from ecwsp.sis.models import GradeScaleRule, GradeScale
+from ecwsp.sis.models import GradeScaleRule, GradeScale, get_grade_scale_index, _grade_scale_indexes
+from ecwsp.schedule.models import get_marking_period_grade_scale_id, _marking_period_grade_scales
 from ecwsp.grades.models import Grade
+from django.core.cache import cache
+from django.db import connection
 import time
 from decimal import Decimal
 
@@ -47,5 +50,45 @@ class GradeScaleTests(SisTestMixin, TestCase):
         end = time.time()
         run_time = end - start
         print '{} scale lookups took {} seconds'.format(i, run_time)
+        with self.assertNumQueries(0):
+            grade.get_grade(letter=True)
+
+    def test_scale_index(self):
+        scale = self.scale
+        index = get_grade_scale_index(scale.id)
+        self.assertEqual(
+            index.to_letter([50, Decimal('59.99'), Decimal('59.995'), 90, 1000, None]),
+            ['F', 'F', None, 'A', None, None])
+        self.assertEqual(index.to_numeric([65, 85]), [Decimal('1.5'), 3])
+        # Changing a rule rebuilds the index
+        GradeScaleRule.objects.create(min_grade=Decimal('90.01'), max_grade=100, letter_grade='A+', numeric_scale=4, grade_scale=scale)
         with self.assertNumQueries(1):
-            grade.get_grade(letter=True)
\ No newline at end of file
+            self.assertEqual(scale.to_letter(95), 'A+')
+        with self.assertNumQueries(0):
+            self.assertEqual(scale.to_letter(95), 'A+')
+
+    def test_scale_index_shared_invalidation(self):
+        """ Indexes are rebuilt when another process clears them """
+        self.assertEqual(self.scale.to_letter(95), None)
+        # Another process adds a rule; only the shared version changes here
+        GradeScaleRule.objects.bulk_create([GradeScaleRule(
+            min_grade=Decimal('90.01'), max_grade=100, letter_grade='A+', numeric_scale=4, grade_scale=self.scale)])
+        cache.set(_grade_scale_indexes.version_key(getattr(connection, 'schema_name', None)), 'changed')
+        _grade_scale_indexes.checked.clear()
+        self.assertEqual(self.scale.to_letter(95), 'A+')
+
+    def test_marking_period_grade_scale_miss(self):
+        # As if the map was loaded before the marking period existed
+        _marking_period_grade_scales.get_values()['grade_scales'] = {}
+        self.assertEqual(
+            get_marking_period_grade_scale_id(self.data.marking_period.id), self.scale.id)
+
+    def test_grade_without_rule(self):
+        grade = Grade.objects.get(
+            student = self.data.student2,
+            course_section = self.data.course_section2,
+            marking_period = self.data.marking_period
+            )
+        grade.grade = Decimal(1000)
+        self.assertEqual(grade.optimized_grade_to_scale(letter=True), None)
+        self.assertEqual(grade.get_grade(letter=True), None)
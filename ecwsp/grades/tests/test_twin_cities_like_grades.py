@@ -1,8 +1,8 @@
 from django.test import TestCase
 from ecwsp.sis.sample_tc_data import SampleTCData
 from ecwsp.grades.tasks import build_grade_cache
-from ecwsp.schedule.models import CourseSection
-from ecwsp.grades.models import StudentYearGrade
+from ecwsp.schedule.models import CourseSection, CourseEnrollment, MarkingPeriod, OmitCourseGPA
+from ecwsp.grades.models import StudentYearGrade, StudentGpaSnapshot, Grade
 import datetime
 
 class GradeTestTCSampleData(TestCase):
@@ -59,6 +59,82 @@ class GradeTestTCSampleData(TestCase):
             gpa = student.calculate_gpa(date_report=end_dates[i])
             self.assertEqual(round(gpa, 2), expected_gpas[i])
 
+    def test_gpa_snapshots(self):
+        student = self.data.tc_student1
+        date_report = datetime.date(2014,11,20)
+        gpa = student.calculate_gpa(date_report=date_report)
+        self.assertEqual(gpa, student.calculate_gpa_real(date_report=date_report))
+        # Stored under the last marking period end date and reused from there
+        self.assertEqual(StudentGpaSnapshot.objects.get(student=student).date, datetime.date(2014,11,14))
+        with self.assertNumQueries(1):
+            self.assertEqual(student.calculate_gpa(date_report=datetime.date(2014,11,15)), gpa)
+        # Changing a grade in that marking period drops the snapshot
+        grade = Grade.objects.filter(student=student, marking_period__end_date=datetime.date(2014,11,14)).first()
+        grade.set_grade(0)
+        grade.save()
+        self.assertFalse(StudentGpaSnapshot.objects.filter(student=student).exists())
+        self.assertEqual(student.calculate_gpa(date_report=date_report),
+                         student.calculate_gpa_real(date_report=date_report))
+
+    def test_gpa_snapshots_after_open_marking_period_change(self):
+        student = self.data.tc_student1
+        date_report = datetime.date(2015,11,20)
+        open_marking_period = MarkingPeriod.objects.get(name="S6-TC2")
+        open_marking_period.end_date = datetime.date.today() + datetime.timedelta(days=30)
+        open_marking_period.save()
+        bus3 = CourseSection.objects.get(name="bus3-section-TC-2015-2016")
+        span3 = CourseSection.objects.get(name="span3-section-TC-2015-2016")
+        for section in (bus3, span3):
+            CourseEnrollment.objects.create(user=student, course_section=section)
+        StudentYearGrade.objects.get_or_create(student=student, year=self.data.year2)
+        def set_grade(section, marking_period_name, value):
+            grade = Grade.objects.get(
+                student=student, course_section=section, marking_period__name=marking_period_name)
+            grade.grade = value
+            grade.save()
+
+        set_grade(bus3, "S1-TC2", 1)
+        self.assertEqual(student.calculate_gpa(date_report=date_report),
+                         student.calculate_gpa_real(date_report=date_report))
+        # span3's first grade is in the open marking period, but it still
+        # adds to the current credits the gpa weighs year 2 by
+        set_grade(span3, "S6-TC2", 4)
+        self.assertEqual(student.calculate_gpa(date_report=date_report),
+                         student.calculate_gpa_real(date_report=date_report))
+
+    def test_gpa_snapshots_cleared_by_course_changes(self):
+        student = self.data.tc_student1
+        date_report = datetime.date(2014,11,20)
+        section = CourseSection.objects.filter(courseenrollment__user=student).first()
+        course = section.course
+        def snapshot_exists():
+            return StudentGpaSnapshot.objects.filter(student=student).exists()
+
+        student.calculate_gpa(date_report=date_report)
+        course.fullname += ' (renamed)'
+        course.save()
+        self.assertTrue(snapshot_exists())
+        course.credits += 1
+        course.save()
+        self.assertFalse(snapshot_exists())
+
+        student.calculate_gpa(date_report=date_report)
+        course_type = course.course_type
+        course_type.boost += 1
+        course_type.save()
+        self.assertFalse(snapshot_exists())
+
+        student.calculate_gpa(date_report=date_report)
+        section.marking_period.remove(section.marking_period.all()[0])
+        self.assertFalse(snapshot_exists())
+
+        student.calculate_gpa(date_report=date_report)
+        omit = OmitCourseGPA.objects.create(student=student, course=course)
+        self.assertFalse(snapshot_exists())
+        student.calculate_gpa(date_report=date_report)
+        omit.delete()
+        self.assertFalse(snapshot_exists())
+
     def test_student_2_year_grades(self):
         student = self.data.tc_student2
         year_grade_1 = StudentYearGrade.objects.get(student = student, year = self.data.year1)
@@ -1,6 +1,7 @@
 from constance import config
 from ecwsp.sis.models import Student
 from ecwsp.sis.helper_functions import strip_unicode_to_ascii, all_tenants
+from ecwsp.sis.report_data import current_gpas
 
 from celery.task.schedules import crontab
 from celery.decorators import periodic_task
@@ -19,7 +20,9 @@ def create_new_naviance_students():
     if config.NAVIANCE_IMPORT_KEY:
         data = [['Student_ID','Class_Year','Last Name','First Name','Middle Name','Gender','Birthdate','GPA']]
 
-        for student in Student.objects.filter(is_active=True):
+        students = list(Student.objects.filter(is_active=True))
+        gpas = current_gpas(students)
+        for student in students:
             row = []
             if config.NAVIANCE_SWORD_ID == "username":
                 row += [student.username]
@@ -41,7 +44,7 @@ def create_new_naviance_students():
                 row += [student.bday.strftime('%Y%m%d')]
             else:
                 row += ['']
-            row += [student.gpa]
+            row += [gpas[student.id]]
             data += [row]
 
         temp = tempfile.TemporaryFile()
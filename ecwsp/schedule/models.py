@@ -4,14 +4,17 @@ from django_cached_field import CachedCharField, CachedDecimalField
 from django.db import connection
 from django.db import models
 from django.db.models.query import QuerySet
+from django.db.models.signals import post_save, post_delete, pre_save, m2m_changed
+from django.dispatch import receiver
 from django.core.urlresolvers import reverse
 
-from ecwsp.sis.models import Student, GradeScaleRule
-from ecwsp.sis.helper_functions import round_as_decimal, round_to_standard
-from ecwsp.grades.models import Grade
+from ecwsp.sis.models import Student, SchoolYear, GradeScaleRule, get_grade_scale_index
+from ecwsp.sis.helper_functions import round_as_decimal, round_to_standard, ProcessCache
+from ecwsp.grades.models import Grade, GradeCacheDirtyKey, CourseEnrollmentSnapshot, clear_grade_snapshots
 from ecwsp.administration.models import Configuration
 from constance import config
 
+import bisect
 import datetime
 import decimal
 from decimal import Decimal, ROUND_HALF_UP
@@ -83,8 +86,13 @@ class MarkingPeriod(models.Model):
     def save(self, **kwargs):
         obj = super(MarkingPeriod, self).save(**kwargs)
         if 'ecwsp.grades' in settings.INSTALLED_APPS:
-            from ecwsp.grades.tasks import build_grade_cache
-            build_grade_cache.apply_async()
+            # Only students enrolled in this marking period are affected
+            from ecwsp.grades.tasks import process_dirty_grade_cache
+            GradeCacheDirtyKey.add_keys(
+                (student_id, course_section_id, self.id, self.school_year_id)
+                for student_id, course_section_id in CourseEnrollment.objects.filter(
+                    course_section__marking_period=self).values_list('user_id', 'course_section_id'))
+            process_dirty_grade_cache.apply_async()
         return obj
 
     def get_number_days(self, date=datetime.date.today()):
@@ -117,6 +125,58 @@ class MarkingPeriod(models.Model):
             current_day += datetime.timedelta(days=1)
         return day
 
+_marking_period_grade_scales = ProcessCache('marking_period_grade_scales')
+_grade_change_dates = ProcessCache('grade_change_dates')
+
+def get_marking_period_grade_scale_id(marking_period_id):
+    """ Grade scale id of a marking period's school year, cached per process """
+    if marking_period_id is None:
+        return None
+    values = _marking_period_grade_scales.get_values()
+    grade_scales = values.get('grade_scales')
+    if grade_scales is None or marking_period_id not in grade_scales:
+        # Reload on a miss, the marking period may be newer than the cache
+        grade_scales = values['grade_scales'] = dict(
+            MarkingPeriod.objects.values_list('id', 'school_year__grade_scale'))
+    return grade_scales.get(marking_period_id)
+
+def get_grade_change_date(date_report):
+    """ Latest date <= date_report on which a date_report bounded grade or
+    gpa can change, None if there is none. Those calculations only compare
+    date_report to marking period end dates and school year start and end
+    dates, so any date_report gives the same result as this date. """
+    values = _grade_change_dates.get_values()
+    dates = values.get('dates')
+    if dates is None:
+        dates = set(MarkingPeriod.objects.values_list('end_date', flat=True))
+        for start_date, end_date in SchoolYear.objects.values_list('start_date', 'end_date'):
+            # calculate_gpa uses start_date < date_report
+            dates.add(start_date + datetime.timedelta(days=1))
+            dates.add(end_date)
+        dates = values['dates'] = sorted(dates)
+    i = bisect.bisect_right(dates, date_report)
+    if i:
+        return dates[i - 1]
+
+@receiver(post_save, sender=MarkingPeriod)
+@receiver(post_delete, sender=MarkingPeriod)
+@receiver(post_save, sender=SchoolYear)
+@receiver(post_delete, sender=SchoolYear)
+def clear_marking_period_caches(sender, **kwargs):
+    _marking_period_grade_scales.clear()
+    _grade_change_dates.clear()
+
+@receiver(post_save, sender=MarkingPeriod)
+@receiver(post_delete, sender=MarkingPeriod)
+@receiver(post_save, sender=SchoolYear)
+@receiver(post_delete, sender=SchoolYear)
+@receiver(post_save, sender=GradeScaleRule)
+@receiver(post_delete, sender=GradeScaleRule)
+def clear_all_grade_snapshots(sender, **kwargs):
+    """ Dates, weights and scales change every snapshot """
+    clear_grade_snapshots()
+
+
 class DaysOff(models.Model):
     date = models.DateField(validators=settings.DATE_VALIDATORS)
     marking_period = models.ForeignKey(MarkingPeriod)
@@ -173,6 +233,8 @@ class CourseEnrollment(models.Model):
         super(CourseEnrollment, self).save(*args, **kwargs)
         if populate_all_grades is True:
             self.course_section.populate_all_grades()
+            GradeCacheDirtyKey.add_keys([(self.user_id, self.course_section_id, None, None)])
+            clear_grade_snapshots(student_ids=[self.user_id])
 
     def cache_grades(self):
         """ Set cache on both grade and numeric_grade """
@@ -242,10 +304,7 @@ WHERE grades_grade.course_section_id = %s
             min_grade__lte=grade,
             max_grade__gte=grade).first()'''
         grade = round_to_standard(grade)
-        rule = GradeScaleRule.objects.filter(
-            min_grade__lte=grade,
-            max_grade__gte=grade,
-            ).select_related('course_section').first()
+        rule = get_grade_scale_index().get_rule(grade)
         if letter:
             return rule.letter_grade
         return rule.numeric_scale
@@ -264,13 +323,29 @@ WHERE grades_grade.course_section_id = %s
             else:
                 grade = self.grade
         else:
-            grade = self.calculate_grade_real(date_report=date_report)
+            grade = CourseEnrollmentSnapshot.lookup(self, date_report)
         if rounding and isinstance(grade, (int, long, float, complex, Decimal)):
             grade = round_as_decimal(grade, rounding)
         if letter == True and isinstance(grade, (int, long, float, complex, Decimal)):
             return self.optimized_grade_to_scale(grade)
         return grade
 
+    @classmethod
+    def get_grades(cls, enrollments, date_report=None, rounding=2):
+        """ get_grade for many enrollments at once
+        returns {enrollment id: grade}
+        """
+        if date_report is None or date_report >= datetime.date.today():
+            grades = dict((enrollment.id, enrollment.numeric_grade or enrollment.grade)
+                          for enrollment in enrollments)
+        else:
+            grades = CourseEnrollmentSnapshot.lookup_many(enrollments, date_report)
+        if rounding:
+            for pk, grade in grades.items():
+                if isinstance(grade, (int, long, float, complex, Decimal)):
+                    grades[pk] = round_as_decimal(grade, rounding)
+        return grades
+
     def calculate_grade(self):
         return self.cache_grades()
 
@@ -280,6 +355,22 @@ WHERE grades_grade.course_section_id = %s
             return grade
         return None
 
+    @classmethod
+    def calculate_grades_real(cls, enrollments, date_report=None, ignore_letter=False):
+        """ calculate_grade_real for many enrollments at once
+        Averages come from one grouped query, override and letter grades
+        from one more query each when needed.
+        returns {enrollment id: grade}
+        """
+        from ecwsp.grades.bulk_cache import final_grade_averages, final_grades
+        keys = dict((enrollment.id, (enrollment.course_section_id, enrollment.user_id))
+                    for enrollment in enrollments)
+        averages = final_grade_averages(
+            set(key[1] for key in keys.values()), date_report=date_report)
+        grades = final_grades(
+            keys.values(), averages, date_report=date_report, ignore_letter=ignore_letter)
+        return dict((pk, grades[key]) for pk, key in keys.iteritems())
+
     def calculate_grade_real(self, date_report=None, ignore_letter=False):
         """ Calculate the final grade for a course section
         ignore_letter can be useful when computing averages
@@ -371,6 +462,11 @@ WHERE (grades_grade.course_section_id = %s
         return None
 
 
+@receiver(post_delete, sender=CourseEnrollment)
+def clear_enrollment_grade_snapshots(sender, instance, **kwargs):
+    clear_grade_snapshots(student_ids=[instance.user_id])
+
+
 class Department(models.Model):
     name = models.CharField(max_length=255, unique=True, verbose_name="Department Name")
     order_rank = models.IntegerField(blank=True, null=True, help_text="Rank that courses will show up in reports")
@@ -557,16 +653,25 @@ class CourseSection(models.Model):
 
     def populate_all_grades(self):
         """
-        calling this method calls Grade.populate_grade on each combination
-        of enrolled_student + marking_period + course_section
+        Make sure each combination of enrolled_student + marking_period +
+        course_section has a grade, like Grade.populate_grade does for one.
+        Missing grades are found with a set difference and created with
+        bulk_create. They are empty, so there is no cache to invalidate.
         """
-        for student in self.enrollments.all():
-            for marking_period in self.marking_period.all():
-                Grade.populate_grade(
-                    student = student,
-                    marking_period = marking_period,
-                    course_section = self
-                    )
+        enrollments = dict(self.courseenrollment_set.values_list('user_id', 'id'))
+        marking_period_ids = self.marking_period.values_list('id', flat=True)
+        wanted = set(
+            (student_id, marking_period_id)
+            for student_id in enrollments for marking_period_id in marking_period_ids)
+        existing = set(self.grade_set.values_list('student_id', 'marking_period_id'))
+        Grade.objects.bulk_create([
+            Grade(
+                student_id=student_id,
+                course_section=self,
+                marking_period_id=marking_period_id,
+                enrollment_id=enrollments[student_id],
+                grade=None,
+            ) for student_id, marking_period_id in wanted - existing])
 
     def save(self, *args, **kwargs):
         super(CourseSection, self).save(*args, **kwargs)
@@ -620,6 +725,57 @@ class OmitYearGPA(models.Model):
         return "%s %s" % (self.student, self.year)
 
 
+def enrolled_student_ids(**filters):
+    return list(CourseEnrollment.objects.filter(**filters).values_list('user', flat=True).distinct())
+
+# Fields that change the grades of every student taking a course
+SNAPSHOT_FIELDS = {
+    Course: ('credits', 'course_type'),
+    CourseType: ('weight', 'boost'),
+}
+
+@receiver(pre_save, sender=Course)
+@receiver(pre_save, sender=CourseType)
+def remember_snapshot_fields(sender, instance, raw=False, **kwargs):
+    """ Snapshots only need clearing when these fields change """
+    instance._snapshot_fields = None
+    if instance.pk and not raw:
+        instance._snapshot_fields = sender.objects.filter(
+            pk=instance.pk).values_list(*SNAPSHOT_FIELDS[sender]).first()
+
+@receiver(post_save, sender=Course)
+def clear_course_grade_snapshots(sender, instance, **kwargs):
+    old = getattr(instance, '_snapshot_fields', None)
+    if old is not None and old != (instance.credits, instance.course_type_id):
+        clear_grade_snapshots(student_ids=enrolled_student_ids(course_section__course=instance))
+
+@receiver(post_save, sender=CourseType)
+def clear_course_type_grade_snapshots(sender, instance, **kwargs):
+    old = getattr(instance, '_snapshot_fields', None)
+    if old is not None and old != (instance.weight, instance.boost):
+        clear_grade_snapshots(student_ids=enrolled_student_ids(course_section__course__course_type=instance))
+
+@receiver(m2m_changed, sender=CourseSection.marking_period.through)
+def clear_section_grade_snapshots(sender, instance, action, reverse, pk_set, **kwargs):
+    """ A course section's marking periods decide which dates its grades count on """
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        clear_grade_snapshots(student_ids=enrolled_student_ids(course_section=instance))
+    elif pk_set is not None:
+        clear_grade_snapshots(student_ids=enrolled_student_ids(course_section__in=pk_set))
+    else:
+        # The marking period's course sections are already gone
+        clear_grade_snapshots()
+
+@receiver(post_save, sender=OmitCourseGPA)
+@receiver(post_delete, sender=OmitCourseGPA)
+@receiver(post_save, sender=OmitYearGPA)
+@receiver(post_delete, sender=OmitYearGPA)
+def clear_omitted_grade_snapshots(sender, instance, **kwargs):
+    clear_grade_snapshots(student_ids=[instance.student_id])
+
+
 class Award(models.Model):
     name = models.CharField(max_length=255)
     def __unicode__(self):
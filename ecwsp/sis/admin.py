@@ -15,7 +15,8 @@ from reversion.admin import VersionAdmin
 from ecwsp.sis.models import (Student, StudentNumber, EmergencyContactNumber, TranscriptNote,
         StudentFile, ClassYear, EmergencyContact, StudentHealthRecord, Faculty, GradeLevel,
         LanguageChoice, Cohort, PerCourseSectionCohort, ReasonLeft, TranscriptNoteChoices,
-        SchoolYear, GradeScale, GradeScaleRule, MessageToStudent, FamilyAccessUser)
+        SchoolYear, GradeScale, GradeScaleRule, MessageToStudent, FamilyAccessUser,
+        PerformanceRecord, ReportJob)
 from ecwsp.schedule.models import AwardStudent, MarkingPeriod, CourseEnrollment, CourseSection
 from custom_field.custom_field import CustomFieldAdmin
 import autocomplete_light
@@ -326,6 +327,21 @@ admin.site.register(GradeScale, GradeScaleAdmin)
 
 admin.site.register(MessageToStudent)
 
+
+class PerformanceRecordAdmin(admin.ModelAdmin):
+    list_display = ['name', 'kind', 'tenant', 'date', 'duration', 'queries', 'query_time', 'peak_memory']
+    list_filter = ['kind', 'tenant']
+    search_fields = ['name']
+    readonly_fields = list_display
+admin.site.register(PerformanceRecord, PerformanceRecordAdmin)
+
+class ReportJobAdmin(admin.ModelAdmin):
+    list_display = ['report', 'download_type', 'user', 'status', 'created', 'finished', 'expires']
+    list_filter = ['status', 'report']
+    readonly_fields = ['key', 'report', 'download_type', 'post_data', 'user', 'file', 'file_name',
+                       'content_type', 'error', 'created', 'finished']
+admin.site.register(ReportJob, ReportJobAdmin)
+
 from django.contrib.auth.admin import UserAdmin
 class FamilyAccessUserAdmin(UserAdmin,admin.ModelAdmin):
     fields = ('is_active','username','first_name','last_name','password')
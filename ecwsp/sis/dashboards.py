@@ -9,6 +9,7 @@ import datetime
 from django.core.urlresolvers import reverse
 from responsive_dashboard.dashboard import AdminListDashlet, LinksListDashlet, dashboards
 from ecwsp.sis.models import Student, UserPreference, Faculty
+from ecwsp.sis.performance import top_offenders
 
 
 class ViewStudentDashlet(Dashlet):
@@ -154,6 +155,17 @@ class AttendanceReportBuilderDashlet(ReportBuilderDashlet):
         return super(ReportBuilderDashlet, self).get_context_data(**kwargs)
 
 
+class PerformanceDashlet(Dashlet):
+    """ Views and tasks that took the most time this week """
+    template_name = 'sis/performance_dashlet.html'
+    require_permissions = ('sis.change_performancerecord',)
+
+    def get_context_data(self, **kwargs):
+        context = super(PerformanceDashlet, self).get_context_data(**kwargs)
+        context['offenders'] = top_offenders()
+        return context
+
+
 class AttendanceAdminListDashlet(AdminListDashlet):
     require_permissions = ('attendance.change_studentattendance',)
 
@@ -170,6 +182,7 @@ class SisDashboard(Dashboard):
         AttendanceReportBuilderDashlet(title="Attendance Reports",),
         AttendanceAdminListDashlet(title="Attendance", app_label="attendance"),
         AdminListDashlet(title="School Information", app_label="sis"),
+        PerformanceDashlet(title="Slowest Pages and Tasks"),
     ]
 
 
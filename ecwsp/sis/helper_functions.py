@@ -1,12 +1,17 @@
 from django.db.models import AutoField
-from django.db import models, connection
+from django.db import models, connection, transaction
 from django.core.exceptions import PermissionDenied
 from django.contrib import admin
 from django.conf import settings
+from django.core.cache import cache
+from django.core import checks
 from django.utils.encoding import smart_unicode
 from functools import wraps
+import time
 import unicodedata
+import uuid
 from decimal import Decimal, ROUND_HALF_UP, getcontext
+from ecwsp.sis.performance import measure
 if settings.MULTI_TENANT:
     from tenant_schemas.utils import get_tenant_model, tenant_context
 
@@ -32,9 +37,11 @@ def all_tenants(f):
     @wraps(f)
     def wrapper(*args, **kwargs):
         if settings.MULTI_TENANT:
+            name = '{0}.{1}'.format(f.__module__, f.__name__)
             for tenant in get_tenant_model().objects.exclude(schema_name="public"):
                 with tenant_context(tenant):
-                    f(*args, **kwargs)
+                    with measure('task', name):
+                        f(*args, **kwargs)
         else:
             f(*args, **kwargs)
     return wrapper
@@ -129,3 +136,123 @@ class CharNullField(models.CharField):
             return None
        else:
             return super(CharNullField, self).get_db_prep_value(value, *args, **kwargs)
+
+
+class ProcessCache(object):
+    """ Values kept in memory by every process, per tenant schema
+    clear() stores a new version in the django cache, so the other
+    processes drop their values too. The version is checked at most every
+    check_interval seconds so lookups stay in memory.
+    This needs a cache shared by all processes (redis or memcached). A
+    process local cache like LocMemCache only reaches the process that
+    cleared it, see check_shared_cache. """
+    check_interval = 1
+
+    def __init__(self, name):
+        self.name = name
+        self.values = {}
+        self.versions = {}
+        self.checked = {}
+
+    def version_key(self, schema):
+        return 'process_cache_version:{}:{}'.format(self.name, schema)
+
+    def get_values(self):
+        """ dict of cached values for the current schema """
+        schema = getattr(connection, 'schema_name', None)
+        now = time.time()
+        if now - self.checked.get(schema, 0) >= self.check_interval:
+            self.checked[schema] = now
+            key = self.version_key(schema)
+            version = cache.get(key)
+            if version is None:
+                cache.add(key, uuid.uuid4().hex, None)
+                version = cache.get(key)
+            if version != self.versions.get(schema):
+                self.versions[schema] = version
+                self.values[schema] = {}
+        return self.values.setdefault(schema, {})
+
+    def clear(self):
+        schema = getattr(connection, 'schema_name', None)
+        cache.set(self.version_key(schema), uuid.uuid4().hex, None)
+        self.values.pop(schema, None)
+        self.versions.pop(schema, None)
+        self.checked.pop(schema, None)
+
+
+PROCESS_LOCAL_CACHE_BACKENDS = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+@checks.register()
+def check_shared_cache(app_configs, **kwargs):
+    """ ProcessCache versions must be visible to every process. A process
+    local cache is only allowed with DEBUG, where a single runserver
+    process is expected. """
+    backend = settings.CACHES.get('default', {}).get('BACKEND')
+    if backend in PROCESS_LOCAL_CACHE_BACKENDS and not settings.DEBUG:
+        return [checks.Error(
+            "The default cache backend %s is not shared between processes" % backend,
+            hint="Set REDIS_URL or configure a memcached CACHES backend",
+            obj='CACHES',
+            id='sis.E001',
+        )]
+    return []
+
+
+def chunks(items, size=500):
+    """ Yield successive lists of at most size items
+    Useful to keep IN (...) clauses under database parameter limits """
+    items = list(items)
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
+
+
+def bulk_update(model, values, batch_size=None):
+    """ Update many rows with different values in a few UPDATE statements
+    model: Django model class
+    values: dict of pk -> dict of field name -> value
+    Fields that hold the same value on every row are set directly, the rest
+    use a CASE on the primary key. Values are prepared exactly like
+    QuerySet.update() would prepare them.
+    """
+    if not values:
+        return
+    qn = connection.ops.quote_name
+    pk_column = model._meta.pk.column
+    field_names = values.itervalues().next().keys()
+    fields = [model._meta.get_field(name) for name in field_names]
+    constant_fields = []
+    case_fields = []
+    for field in fields:
+        distinct_values = set(row[field.name] for row in values.itervalues())
+        if len(distinct_values) == 1:
+            constant_fields.append(field)
+        else:
+            case_fields.append(field)
+    if batch_size is None:
+        # Stay under sqlite's limit of 999 parameters per statement
+        batch_size = max(1, 900 // (2 * len(case_fields) + 1))
+    with transaction.atomic():
+        for pks in chunks(sorted(values.keys()), batch_size):
+            set_sql = []
+            params = []
+            for field in constant_fields:
+                set_sql.append('{} = %s'.format(qn(field.column)))
+                params.append(field.get_db_prep_save(values[pks[0]][field.name], connection=connection))
+            for field in case_fields:
+                cast = 'CAST(%s AS {})'.format(field.db_type(connection))
+                whens = []
+                for pk in pks:
+                    whens.append('WHEN %s THEN ' + cast)
+                    params += [pk, field.get_db_prep_save(values[pk][field.name], connection=connection)]
+                set_sql.append('{} = CASE {} {} END'.format(qn(field.column), qn(pk_column), ' '.join(whens)))
+            sql = 'UPDATE {} SET {} WHERE {} IN ({})'.format(
+                qn(model._meta.db_table),
+                ', '.join(set_sql),
+                qn(pk_column),
+                ', '.join(['%s'] * len(pks)))
+            params += pks
+            connection.cursor().execute(sql, params)
@@ -7,6 +7,7 @@ from django.conf import settings
 from ecwsp.admissions.models import *
 from ecwsp.sis.models import *
 from ecwsp.schedule.models import *
+from ecwsp.grades.models import deferred_invalidation
 from ecwsp.sis.xl_report import XlReport
 from ecwsp.sis.uno_report import *
 from ecwsp.attendance.models import *
@@ -722,6 +723,7 @@ class Importer:
             x += 1
         return inserted, updated
     
+    @deferred_invalidation()
     def import_grades_admin(self, sheet):
         x, header, inserted, updated = self.import_prep(sheet)
         while x < sheet.nrows:
@@ -779,6 +781,7 @@ class Importer:
     
     
     @transaction.commit_on_success
+    @deferred_invalidation()
     def import_grades(self, course_section, marking_period):
         """ Special import for teachers to upload grades
         Returns Error Message """ 
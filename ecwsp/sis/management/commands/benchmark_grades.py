@@ -0,0 +1,128 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from optparse import make_option
+import datetime
+import json
+import time
+
+
+class Command(BaseCommand):
+    """ Times the grade calculation hot paths against synthetic schools.
+    Each school is built inside a transaction that is rolled back, so this
+    can run against any database. Results are written as JSON so runs can be
+    compared over time. """
+    help = 'Benchmark grade calculations on synthetic schools and print JSON'
+    option_list = BaseCommand.option_list + (
+        make_option('--students', default='500,2000,10000',
+            help='Comma separated school sizes to benchmark'),
+        make_option('--courses', type='int', default=8,
+            help='Courses every student takes'),
+        make_option('--marking-periods', type='int', default=4),
+        make_option('--sample', type='int', default=100,
+            help='Objects to time per object code paths on'),
+        make_option('--repeat', type='int', default=3,
+            help='Runs per code path, the fastest is reported'),
+        make_option('--per-object-cache', action='store_true', default=False,
+            help='Also time build_grade_cache(bulk=False), slow on large schools'),
+        make_option('--output', default=None,
+            help='Write JSON here instead of stdout'),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options['students'].split(',')]
+        except ValueError:
+            raise CommandError('--students must be a comma separated list of numbers')
+        results = {
+            'date': datetime.datetime.now().isoformat(),
+            'database': connection.vendor,
+            'courses': options['courses'],
+            'marking_periods': options['marking_periods'],
+            'schools': [],
+        }
+        for students in sizes:
+            self.stderr.write('Benchmarking {0} students...'.format(students))
+            results['schools'].append(self.benchmark_school(students, options))
+        output = json.dumps(results, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
+
+    def measure(self, function, repeat, calls=1):
+        """ Fastest of repeat runs of function, with its query count """
+        best = None
+        for i in range(repeat):
+            with CaptureQueriesContext(connection) as queries:
+                start = time.time()
+                function()
+                seconds = time.time() - start
+            if best is None or seconds < best['seconds']:
+                best = {'seconds': seconds, 'queries': len(queries), 'calls': calls}
+        best['seconds_per_call'] = best['seconds'] / (calls or 1)
+        return best
+
+    def benchmark_school(self, students, options):
+        from ecwsp.sis.sample_data import SisData
+        from ecwsp.sis.models import Student, clear_grade_scale_indexes
+        from ecwsp.schedule.models import CourseEnrollment, clear_marking_period_caches
+        from ecwsp.grades.models import StudentYearGrade
+        from ecwsp.grades.tasks import build_grade_cache
+        from ecwsp.grades.gpa import calculate_gpas
+
+        repeat = options['repeat']
+        sample = options['sample']
+        timings = {}
+        with transaction.atomic():
+            start = time.time()
+            data = SisData()
+            data.create_required()
+            data.create_synthetic_school(
+                students=students,
+                courses=options['courses'],
+                marking_periods=options['marking_periods'])
+            setup_seconds = time.time() - start
+
+            timings['build_grade_cache'] = self.measure(build_grade_cache, 1)
+            if options['per_object_cache']:
+                timings['build_grade_cache_per_object'] = self.measure(
+                    lambda: build_grade_cache(bulk=False), 1)
+
+            student_ids = [student.id for student in data.students]
+            enrollments = list(CourseEnrollment.objects.filter(user__in=student_ids[:sample]))
+            year_grades = list(StudentYearGrade.objects.filter(student__in=student_ids[:sample]))
+            sample_students = list(Student.objects.filter(id__in=student_ids[:sample]))
+            marking_period_ids = [int(marking_period.id) for marking_period in data.marking_periods]
+            half = marking_period_ids[:len(marking_period_ids) // 2 or 1]
+
+            timings['calculate_grade_real'] = self.measure(
+                lambda: [enrollment.calculate_grade_real() for enrollment in enrollments],
+                repeat, len(enrollments))
+            timings['calculate_grades_real'] = self.measure(
+                lambda: CourseEnrollment.calculate_grades_real(enrollments),
+                repeat, len(enrollments))
+            timings['get_average_for_marking_periods'] = self.measure(
+                lambda: [enrollment.get_average_for_marking_periods(half) for enrollment in enrollments],
+                repeat, len(enrollments))
+            timings['calculate_grade_and_credits'] = self.measure(
+                lambda: [year_grade.calculate_grade_and_credits() for year_grade in year_grades],
+                repeat, len(year_grades))
+            timings['calculate_gpa_real'] = self.measure(
+                lambda: [student.calculate_gpa_real() for student in sample_students],
+                repeat, len(sample_students))
+            timings['calculate_gpas'] = self.measure(
+                lambda: calculate_gpas(student_ids), repeat, len(student_ids))
+            timings['calculate_gpas_date_report'] = self.measure(
+                lambda: calculate_gpas(student_ids, date_report=data.marking_periods[0].end_date),
+                repeat, len(student_ids))
+            transaction.set_rollback(True)
+        # Rolled back rows never send delete signals
+        clear_grade_scale_indexes(sender=None)
+        clear_marking_period_caches(sender=None)
+        return {
+            'students': students,
+            'setup_seconds': setup_seconds,
+            'timings': timings,
+        }
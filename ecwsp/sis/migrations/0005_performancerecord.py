@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import datetime
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sis', '0004_auto_20150126_1540'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PerformanceRecord',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('kind', models.CharField(max_length=10, choices=[('view', 'View'), ('task', 'Task'), ('code', 'Code')])),
+                ('name', models.CharField(max_length=255, db_index=True)),
+                ('tenant', models.CharField(max_length=100, blank=True)),
+                ('date', models.DateTimeField(default=datetime.datetime.now, db_index=True)),
+                ('duration', models.FloatField(help_text='Wall time in seconds')),
+                ('queries', models.IntegerField()),
+                ('query_time', models.FloatField(help_text='Database time in seconds')),
+                ('peak_memory', models.IntegerField(help_text='Peak memory of the process in KB')),
+            ],
+            options={
+                'ordering': ('-date',),
+            },
+            bases=(models.Model,),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import datetime
+import django.db.models.deletion
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('sis', '0005_performancerecord'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReportJob',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('key', models.CharField(help_text='Hash of the report, download type, filters and tenant', max_length=40, db_index=True)),
+                ('report', models.CharField(max_length=100)),
+                ('download_type', models.CharField(max_length=100)),
+                ('post_data', models.TextField(blank=True)),
+                ('status', models.CharField(default='pending', max_length=10, choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')])),
+                ('file', models.FileField(upload_to='report_jobs', blank=True)),
+                ('file_name', models.CharField(max_length=255, blank=True)),
+                ('content_type', models.CharField(max_length=255, blank=True)),
+                ('error', models.TextField(blank=True)),
+                ('created', models.DateTimeField(default=datetime.datetime.now)),
+                ('finished', models.DateTimeField(null=True, blank=True)),
+                ('expires', models.DateTimeField(db_index=True, null=True, blank=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.SET_NULL, blank=True, to=settings.AUTH_USER_MODEL, null=True)),
+            ],
+            options={
+                'ordering': ('-created',),
+            },
+            bases=(models.Model,),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sis', '0007_reportjob_started'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reportjob',
+            name='slot',
+            field=models.PositiveSmallIntegerField(help_text='Concurrency slot held while running', unique=True, null=True, editable=False, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AlterField(
+            model_name='reportjob',
+            name='key',
+            field=models.CharField(help_text='Hash of the user, report, download type, filters and tenant', max_length=40, db_index=True),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sis', '0008_reportjob_slot'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='performancerecord',
+            name='peak_memory',
+            field=models.IntegerField(help_text='Increase of the process peak memory during the run in KB'),
+            preserve_default=True,
+        ),
+    ]
@@ -2,7 +2,7 @@ from django.core.exceptions import ValidationError
 from django.db import models
 from django.db.models import Sum
 from django.db import connection
-from django.db.models.signals import post_save, m2m_changed
+from django.db.models.signals import post_save, post_delete, m2m_changed
 from django.dispatch import receiver
 from localflavor.us.models import USStateField, PhoneNumberField  #, USSocialSecurityNumberField
 from django.contrib.auth.models import User, Group
@@ -11,14 +11,15 @@ from constance import config
 
 import logging
 from thumbs import ImageWithThumbsField
-from datetime import date
+from datetime import date, datetime
 from ecwsp.administration.models import Configuration
 from custom_field.custom_field import CustomFieldModel
 import sys
+import bisect
 from ckeditor.fields import RichTextField
 from django_cached_field import CachedDecimalField
 from decimal import Decimal
-from ecwsp.sis.helper_functions import round_as_decimal
+from ecwsp.sis.helper_functions import round_as_decimal, ProcessCache
 
 logger = logging.getLogger(__name__)
 
@@ -391,6 +392,16 @@ class Student(User, CustomFieldModel):
         return gpa
 
     def calculate_gpa(self, date_report=None, rounding=2, prescale=False, boost=True):
+        """ Use StudentYearGrade calculation
+        Past dates with default options come from StudentGpaSnapshot
+        """
+        if date_report and rounding == 2 and not prescale and boost:
+            from ecwsp.grades.models import StudentGpaSnapshot
+            return StudentGpaSnapshot.lookup(self, date_report)
+        return self.calculate_gpa_real(
+            date_report=date_report, rounding=rounding, prescale=prescale, boost=boost)
+
+    def calculate_gpa_real(self, date_report=None, rounding=2, prescale=False, boost=True):
         """ Use StudentYearGrade calculation
         No further weighting needed.
         """
@@ -703,7 +714,7 @@ class GradeScale(models.Model):
 
     def get_rule(self, grade):
         if grade is not None:
-            return self.gradescalerule_set.filter(min_grade__lte=grade, max_grade__gte=grade).first()
+            return get_grade_scale_index(self.id).get_rule(grade)
 
     def to_letter(self, grade):
         rule = self.get_rule(grade)
@@ -731,6 +742,69 @@ class GradeScaleRule(models.Model):
         return '{}-{} {} {}'.format(self.min_grade, self.max_grade, self.letter_grade, self.numeric_scale)
 
 
+class GradeScaleIndex(object):
+    """ Every rule of a grade scale in memory, looked up with bisect
+    Rules may overlap, so the boundaries are split into single points and the
+    open gaps between them. Each keeps the rule with the lowest id, the same
+    one gradescalerule_set.filter(...).first() would return.
+    """
+    def __init__(self, rules):
+        rules = sorted(rules, key=lambda rule: rule.id)
+        self.bounds = sorted(set(
+            [rule.min_grade for rule in rules] + [rule.max_grade for rule in rules]))
+        self.point_rules = [self._find(rules, bound) for bound in self.bounds]
+        # gap_rules[i] covers the grades between bounds[i - 1] and bounds[i]
+        self.gap_rules = [None] + [
+            self._find(rules, (low + high) / 2)
+            for low, high in zip(self.bounds, self.bounds[1:])] + [None]
+
+    @staticmethod
+    def _find(rules, grade):
+        for rule in rules:
+            if rule.min_grade <= grade <= rule.max_grade:
+                return rule
+
+    def get_rule(self, grade):
+        if grade is None:
+            return None
+        grade = Decimal(str(grade))
+        i = bisect.bisect_left(self.bounds, grade)
+        if i < len(self.bounds) and self.bounds[i] == grade:
+            return self.point_rules[i]
+        return self.gap_rules[i]
+
+    def get_rules(self, grades):
+        """ get_rule for a whole list of grades, returns a list of rules """
+        return [self.get_rule(grade) for grade in grades]
+
+    def to_letter(self, grades):
+        return [rule.letter_grade if rule else None for rule in self.get_rules(grades)]
+
+    def to_numeric(self, grades):
+        return [rule.numeric_scale if rule else None for rule in self.get_rules(grades)]
+
+
+_grade_scale_indexes = ProcessCache('grade_scale_indexes')
+
+def get_grade_scale_index(grade_scale_id=None):
+    """ Process wide GradeScaleIndex for grade_scale_id
+    None indexes the rules of every grade scale together """
+    indexes = _grade_scale_indexes.get_values()
+    index = indexes.get(grade_scale_id)
+    if index is None:
+        rules = GradeScaleRule.objects.all()
+        if grade_scale_id is not None:
+            rules = rules.filter(grade_scale=grade_scale_id)
+        index = indexes[grade_scale_id] = GradeScaleIndex(rules)
+    return index
+
+@receiver(post_save, sender=GradeScaleRule)
+@receiver(post_delete, sender=GradeScaleRule)
+@receiver(post_delete, sender=GradeScale)
+def clear_grade_scale_indexes(sender, **kwargs):
+    _grade_scale_indexes.clear()
+
+
 def get_default_benchmark_grade():
     return str(Configuration.get_or_default("Benchmark-based grading", "False").value).lower() == "true"
 
@@ -791,3 +865,57 @@ class FamilyAccessUser(User):
     def save(self, *args, **kwargs):
         super(FamilyAccessUser, self).save(*args, **kwargs)
         self.groups.add(Group.objects.get_or_create(name='family')[0])
+
+
+class PerformanceRecord(models.Model):
+    """ Wall time, queries and memory of one view or celery task run.
+    Written by ecwsp.sis.performance when PERFORMANCE_LOGGING is on and
+    pruned after PERFORMANCE_LOG_DAYS days """
+    kind = models.CharField(max_length=10, choices=(('view', 'View'), ('task', 'Task'), ('code', 'Code')))
+    name = models.CharField(max_length=255, db_index=True)
+    tenant = models.CharField(max_length=100, blank=True)
+    date = models.DateTimeField(default=datetime.now, db_index=True)
+    duration = models.FloatField(help_text="Wall time in seconds")
+    queries = models.IntegerField()
+    query_time = models.FloatField(help_text="Database time in seconds")
+    peak_memory = models.IntegerField(help_text="Increase of the process peak memory during the run in KB")
+
+    class Meta:
+        ordering = ('-date',)
+
+    def __unicode__(self):
+        return u"{0} {1}s".format(self.name, self.duration)
+
+
+class ReportJob(models.Model):
+    """ A report generated in the background by ecwsp.sis.report_jobs.
+    Identical requests share one job while it runs and until it expires """
+    STATUS_CHOICES = (
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    )
+    key = models.CharField(max_length=40, db_index=True,
+        help_text="Hash of the user, report, download type, filters and tenant")
+    report = models.CharField(max_length=100)
+    download_type = models.CharField(max_length=100)
+    post_data = models.TextField(blank=True)
+    user = models.ForeignKey(User, blank=True, null=True, on_delete=models.SET_NULL)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    file = models.FileField(upload_to='report_jobs', blank=True)
+    file_name = models.CharField(max_length=255, blank=True)
+    content_type = models.CharField(max_length=255, blank=True)
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(default=datetime.now)
+    started = models.DateTimeField(blank=True, null=True)
+    slot = models.PositiveSmallIntegerField(blank=True, null=True, unique=True, editable=False,
+        help_text="Concurrency slot held while running")
+    finished = models.DateTimeField(blank=True, null=True)
+    expires = models.DateTimeField(blank=True, null=True, db_index=True)
+
+    class Meta:
+        ordering = ('-created',)
+
+    def __unicode__(self):
+        return u"{0} {1} {2}".format(self.report, self.download_type, self.status)
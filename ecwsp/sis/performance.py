@@ -0,0 +1,184 @@
+""" Wall time, query and memory measurements for views and celery tasks
+
+Turn on with the PERFORMANCE_LOGGING setting. Every measurement is logged to
+the ecwsp.performance logger as json and, when a tenant schema is active,
+saved as a PerformanceRecord so the slowest views and tasks show up on the
+sis dashboard.
+"""
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection, DatabaseError
+from django.db.transaction import TransactionManagementError
+from functools import wraps
+import datetime
+import json
+import logging
+import resource
+import threading
+import time
+
+logger = logging.getLogger('ecwsp.performance')
+_measurements = threading.local()
+
+
+def is_enabled():
+    return bool(getattr(settings, 'PERFORMANCE_LOGGING', False))
+
+
+def peak_memory():
+    """ Peak resident memory of this process in KB """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def save_record(kind, name, duration, queries, query_time, memory):
+    tenant = getattr(connection, 'schema_name', '') or ''
+    logger.info(json.dumps({
+        'kind': kind,
+        'name': name,
+        'tenant': tenant,
+        'duration': round(duration, 4),
+        'queries': queries,
+        'query_time': round(query_time, 4),
+        'peak_memory': memory,
+    }))
+    if tenant == 'public':
+        # PerformanceRecord lives in the tenant schemas
+        return
+    if connection.in_atomic_block and connection.needs_rollback:
+        return
+    from ecwsp.sis.models import PerformanceRecord
+    try:
+        PerformanceRecord.objects.create(
+            kind=kind,
+            name=name[:255],
+            tenant=tenant,
+            duration=duration,
+            queries=queries,
+            query_time=query_time,
+            peak_memory=memory,
+        )
+    except (DatabaseError, TransactionManagementError):
+        logger.warning('Could not save performance record for %s', name, exc_info=True)
+
+
+class measure(object):
+    """ Context manager and decorator that records how long some code took
+    and which queries it ran. Does nothing unless PERFORMANCE_LOGGING is on.
+
+        with measure('code', 'report card'):
+            make_report_cards()
+    """
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+        self.started = False
+
+    def __enter__(self):
+        if not is_enabled():
+            return self
+        stack = getattr(_measurements, 'stack', None)
+        if stack is None:
+            stack = _measurements.stack = []
+        if not stack:
+            # Queries are only kept while the debug cursor is on
+            self.use_debug_cursor = connection.use_debug_cursor
+            connection.use_debug_cursor = True
+            # Saved when the outermost measurement ends, so saving them
+            # doesn't count as a query of the measurements around them
+            _measurements.records = []
+        stack.append(self)
+        self.first_query = len(connection.queries)
+        self.start_memory = peak_memory()
+        self.start_time = time.time()
+        self.started = True
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.started:
+            return
+        self.started = False
+        duration = time.time() - self.start_time
+        queries = connection.queries[self.first_query:]
+        query_time = sum(float(query.get('time') or 0) for query in queries)
+        stack = _measurements.stack
+        stack.remove(self)
+        # ru_maxrss only ever grows over the life of the process, so record
+        # how much this measurement raised it
+        memory = peak_memory() - self.start_memory
+        _measurements.records.append(
+            (self.kind, self.name, duration, len(queries), query_time, memory))
+        if not stack:
+            logged = self.use_debug_cursor or (self.use_debug_cursor is None and settings.DEBUG)
+            connection.use_debug_cursor = self.use_debug_cursor
+            if not logged:
+                # Long running workers would otherwise keep every query
+                del connection.queries[self.first_query:]
+            records = _measurements.records
+            _measurements.records = []
+            for record in records:
+                save_record(*record)
+
+    def __call__(self, func):
+        @wraps(func)
+        def inner(*args, **kwargs):
+            with measure(self.kind, self.name):
+                return func(*args, **kwargs)
+        return inner
+
+
+def view_name(view_func):
+    module = getattr(view_func, '__module__', '')
+    name = getattr(view_func, '__name__', view_func.__class__.__name__)
+    return '{0}.{1}'.format(module, name)
+
+
+class PerformanceMiddleware(object):
+    """ Records every view with measure """
+    def __init__(self):
+        if not is_enabled():
+            raise MiddlewareNotUsed
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request._performance_measure = measure('view', view_name(view_func))
+        request._performance_measure.__enter__()
+
+    def process_response(self, request, response):
+        performance_measure = getattr(request, '_performance_measure', None)
+        if performance_measure is not None:
+            del request._performance_measure
+            performance_measure.__exit__(None, None, None)
+        return response
+
+
+_task_measures = {}
+
+def task_prerun(task_id=None, task=None, **kwargs):
+    _task_measures[task_id] = measure('task', task.name)
+    _task_measures[task_id].__enter__()
+
+def task_postrun(task_id=None, **kwargs):
+    task_measure = _task_measures.pop(task_id, None)
+    if task_measure is not None:
+        task_measure.__exit__(None, None, None)
+
+def connect_celery_signals():
+    """ Record every celery task with measure """
+    from celery.signals import task_prerun as prerun, task_postrun as postrun
+    prerun.connect(task_prerun, weak=False)
+    postrun.connect(task_postrun, weak=False)
+
+
+def top_offenders(days=7, count=10):
+    """ Views and tasks that took the most total time in the last days """
+    from ecwsp.sis.models import PerformanceRecord
+    from django.db.models import Avg, Count, Max, Sum
+    since = datetime.datetime.now() - datetime.timedelta(days=days)
+    return PerformanceRecord.objects.filter(date__gte=since).values('kind', 'name').annotate(
+        runs=Count('id'),
+        total_duration=Sum('duration'),
+        average_duration=Avg('duration'),
+        max_duration=Max('duration'),
+        average_queries=Avg('queries'),
+        average_query_time=Avg('query_time'),
+        peak_memory=Max('peak_memory'),
+    ).order_by('-total_duration')[:count]
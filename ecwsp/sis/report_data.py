@@ -0,0 +1,529 @@
+""" Bulk loaders for report templates
+
+Report templates read grades, averages and attendance counts from attributes
+on each student. Filling those one student at a time costs dozens of queries
+per student. These loaders fetch the data for every student in a report with
+a fixed number of queries and then attach the same attributes in memory.
+"""
+from django.conf import settings
+from django.db.models import Sum
+from constance import config
+from ecwsp.administration.models import Configuration
+from ecwsp.sis.models import SchoolYear
+from ecwsp.sis.helper_functions import chunks, round_as_decimal
+from ecwsp.schedule.models import CourseEnrollment, CourseSection, Department, MarkingPeriod, OmitYearGPA
+from ecwsp.grades.models import Grade, StudentMarkingPeriodGrade, StudentYearGrade, StudentYearGradeSnapshot
+from ecwsp.grades.gpa import calculate_gpas
+from ecwsp.attendance.models import StudentAttendanceCount, ATTENDANCE_COUNT_FIELDS
+import copy
+import datetime
+
+# Report card templates expect absent1..absent6 and so on
+REPORT_MARKING_PERIODS = 6
+
+
+def strip_trailing_zeros(x):
+    x = str(x).strip()
+    # http://stackoverflow.com/a/2440786
+    return x.rstrip('0').rstrip('.')
+
+
+def hidden_grade(*args, **kwargs):
+    """ Stands in for get_grade when a transcript hides grades """
+    return ''
+
+
+class ReportList(list):
+    """ A list that can stand in for the querysets templates used to get """
+    def count(self, *args):
+        if args:
+            return super(ReportList, self).count(*args)
+        return len(self)
+
+    def all(self):
+        return self
+
+
+def department_order(department):
+    """ Department ordering (order_rank, name), no department last """
+    if department is None:
+        return (True, True, None, None)
+    return (False, department.order_rank is None, department.order_rank, department.name)
+
+
+class ReportLookups(object):
+    """ Lookups that are the same for every student in a report run, such as
+    marking periods, departments and configuration values. Each one is
+    computed the first time it's asked for and then kept for the rest of the
+    run, so a SisReport holds one as report.lookups.
+    """
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key, function, *args):
+        """ function(*args), called only the first time key is asked for """
+        if key not in self.values:
+            self.values[key] = function(*args)
+        return self.values[key]
+
+    def config(self, name):
+        """ Value of the Configuration called name """
+        return self.get(('config', name), lambda: Configuration.get_or_default(name).value)
+
+    def passing_grade(self):
+        return self.get('passing_grade', lambda: float(self.config('Passing Grade')))
+
+    def report_marking_periods(self, school_year):
+        """ school_year's marking periods shown on reports, by start date """
+        return self.get(('report_marking_periods', school_year.id), lambda: list(
+            MarkingPeriod.objects.filter(school_year=school_year, show_reports=True).order_by('start_date')))
+
+    def section_marking_periods(self, course_section):
+        """ Marking periods course_section meets in, by start date
+        Shared by every student, so copy them before setting attributes """
+        return self.get(('section_marking_periods', course_section.id), lambda: list(
+            course_section.marking_period.order_by('start_date')))
+
+    def departments(self):
+        return self.get('departments', lambda: list(Department.objects.all()))
+
+    def year_days(self, year):
+        """ year.get_number_days() """
+        return self.get(('year_days', year.id), year.get_number_days)
+
+
+def current_gpas(students):
+    """ student.gpa for each student, calculating stale cached gpas together
+    instead of once per student
+    returns {student_id: gpa} """
+    stale = calculate_gpas([student.id for student in students if student.gpa_recalculation_needed])
+    return dict((student.id, stale[student.id] if student.id in stale else student.gpa)
+                for student in students)
+
+
+def year_grades_by_student(student_ids):
+    """ {student_id: [StudentYearGrade ordered by year start]} """
+    year_grades = {}
+    for student_chunk in chunks(student_ids):
+        for year_grade in StudentYearGrade.objects.filter(
+                student__in=student_chunk).order_by('year__start_date'):
+            year_grades.setdefault(year_grade.student_id, []).append(year_grade)
+    return year_grades
+
+
+def failing_grades_by_student(student_ids, marking_periods, passing_grade):
+    """ {student_id: [Grade below passing_grade in marking_periods]} """
+    failing_grades = {}
+    for student_chunk in chunks(student_ids):
+        for grade in Grade.objects.filter(
+                student__in=student_chunk,
+                override_final=False,
+                grade__lt=passing_grade,
+                marking_period__in=marking_periods,
+        ).select_related('course_section__course', 'marking_period').distinct():
+            failing_grades.setdefault(grade.student_id, []).append(grade)
+    return failing_grades
+
+
+def sum_attendance_counts(student_ids, periods, fields=ATTENDANCE_COUNT_FIELDS):
+    """ Sum StudentAttendanceCount fields for every student in every period
+    periods are objects with an id, start_date and end_date
+    returns {(student_id, period_id): {field: total}} """
+    counts = {}
+    for period in periods:
+        for student_chunk in chunks(student_ids):
+            totals = StudentAttendanceCount.objects.filter(
+                student__in=student_chunk,
+                date__range=(period.start_date, period.end_date),
+            ).order_by().values('student').annotate(*[Sum(field) for field in fields])
+            for total in totals:
+                counts[(total['student'], period.id)] = dict(
+                    (field, total[field + '__sum']) for field in fields)
+    return counts
+
+
+def count_attendance(student_ids, marking_periods):
+    """ Attendance counts for every student in every marking period
+    returns {(student_id, marking_period_id): counts} where counts has the
+    keys absent, tardy, absent_unexcused, tardy_unexcused and dismissed """
+    return sum_attendance_counts(student_ids, marking_periods,
+        ('absent', 'tardy', 'absent_unexcused', 'tardy_unexcused', 'dismissed'))
+
+
+class ReportCardData(object):
+    """ Everything SisReport.get_student_report_card_data needs for a group
+    of students, loaded with a few queries regardless of how many students
+    there are.
+    """
+    def __init__(self, students, marking_periods, school_year):
+        self.student_ids = set(student.id for student in students)
+        self.marking_periods = list(marking_periods.order_by('start_date'))
+        marking_period_ids = [marking_period.id for marking_period in self.marking_periods]
+
+        sections = CourseSection.objects.filter(course__graded=True, marking_period__in=marking_period_ids)
+        self.enrollments = {}
+        self.grades = {}
+        self.mp_grades = {}
+        self.year_grades = {}
+        for student_chunk in chunks(self.student_ids):
+            enrollments = CourseEnrollment.objects.filter(
+                user__in=student_chunk,
+                course_section__in=sections,
+            ).select_related('course_section__course').order_by('course_section__course__department', 'course_section')
+            for enrollment in enrollments:
+                self.enrollments.setdefault(enrollment.user_id, []).append(enrollment)
+            grades = Grade.objects.filter(
+                student__in=student_chunk,
+                course_section__in=sections,
+                marking_period__in=marking_period_ids,
+            )
+            for grade in grades:
+                self.grades[(grade.student_id, grade.course_section_id, grade.marking_period_id)] = grade
+            for mp_grade in StudentMarkingPeriodGrade.objects.filter(
+                    student__in=student_chunk, marking_period__in=marking_period_ids):
+                self.mp_grades[(mp_grade.student_id, mp_grade.marking_period_id)] = mp_grade
+            for year_grade in StudentYearGrade.objects.filter(student__in=student_chunk, year=school_year):
+                self.year_grades[year_grade.student_id] = year_grade
+        self.attendance = count_attendance(self.student_ids, self.marking_periods)
+
+    def attach(self, student, blank_grade):
+        """ Set the report card attributes on student """
+        mp_grade = {}
+        student.mps = []
+        for marking_period in self.marking_periods:
+            # Each student gets their own copy to hold their average
+            marking_period = copy.copy(marking_period)
+            marking_period.smpg = self.mp_grades.get((student.id, marking_period.id))
+            # also save to a dict for alternative lookup
+            mp_grade[marking_period.name] = marking_period.smpg
+            student.mps.append(marking_period)
+        student.year_grade = self.year_grades.get(student.id)
+
+        # for example: student.mp_grade['1st'] or ...['S1X']
+        student.mp_grade = mp_grade
+
+        course_sections = []
+        for course_enrollment in self.enrollments.get(student.id, []):
+            course_section = course_enrollment.course_section
+            section_mp_grades = {}
+            for i, marking_period in enumerate(self.marking_periods):
+                grade = self.grades.get((student.id, course_section.id, marking_period.id), blank_grade)
+                # course_section.grade1, course_section.grade2, etc
+                setattr(course_section, "grade" + str(i + 1), grade)
+                # also save grade in a dict; fetched by MP name
+                # i.e. course_section.mp_grade['S1X']
+                section_mp_grades[marking_period.name] = grade
+            course_section.mp_grade = section_mp_grades
+            course_section.final = course_enrollment.grade
+            course_section.ce = course_enrollment
+            course_sections.append(course_section)
+        student.course_sections = ReportList(course_sections)
+        student.courses = student.course_sections  # Backwards compatibility
+
+        #Attendance for marking period
+        student.absent_total = 0
+        student.absent_unexcused_total = 0
+        student.tardy_total = 0
+        student.tardy_unexcused_total = 0
+        student.dismissed_total = 0
+        fields = ('absent', 'tardy', 'tardy_unexcused', 'absent_unexcused', 'dismissed')
+        for i in range(1, max(REPORT_MARKING_PERIODS, len(self.marking_periods)) + 1):
+            if i > len(self.marking_periods):
+                for field in fields:
+                    setattr(student, field + str(i), "")
+                continue
+            counts = self.attendance.get((student.id, self.marking_periods[i - 1].id), {})
+            for field in fields:
+                count = counts.get(field, 0)
+                setattr(student, field + str(i), count)
+                setattr(student, field + '_total', getattr(student, field + '_total') + count)
+
+
+class TranscriptData(object):
+    """ Everything SisReport.get_student_transcript_data needs for a group
+    of students' full history, loaded with a few queries regardless of how
+    many students there are.
+    report: the SisReport, for its date_end, report_context and is_passing
+    """
+    def __init__(self, students, report):
+        self.report = report
+        self.date_end = report.date_end
+        self.show_incomplete_without_grade = config.TRANSCRIPT_SHOW_INCOMPLETE_COURSES_WITHOUT_GRADE
+        self.student_ids = set(student.id for student in students)
+
+        self.enrollments = {}
+        for student_chunk in chunks(self.student_ids):
+            enrollments = CourseEnrollment.objects.filter(user__in=student_chunk).select_related(
+                'course_section__course__course_type', 'course_section__course__department')
+            for enrollment in enrollments:
+                self.enrollments.setdefault(enrollment.user_id, []).append(enrollment)
+        section_ids = set(enrollment.course_section_id
+                          for enrollments in self.enrollments.values() for enrollment in enrollments)
+        self.section_marking_periods = {}
+        for section_chunk in chunks(section_ids):
+            for section_id, marking_period_id in CourseSection.marking_period.through.objects.filter(
+                    coursesection__in=section_chunk).values_list('coursesection_id', 'markingperiod_id'):
+                self.section_marking_periods.setdefault(section_id, set()).add(marking_period_id)
+        marking_period_ids = set()
+        for section_marking_period_ids in self.section_marking_periods.values():
+            marking_period_ids |= section_marking_period_ids
+        self.marking_periods = dict(
+            (marking_period.id, marking_period) for marking_period in MarkingPeriod.objects.filter(id__in=marking_period_ids))
+        self.years = dict((year.id, year) for year in SchoolYear.objects.filter(
+            id__in=set(marking_period.school_year_id for marking_period in self.marking_periods.values())))
+
+        self.omitted_years = set()
+        self.grades = {}
+        self.mp_grades = {}
+        self.year_grades = {}
+        for student_chunk in chunks(self.student_ids):
+            self.omitted_years.update(OmitYearGPA.objects.filter(
+                student__in=student_chunk).values_list('student_id', 'year_id'))
+            for grade in Grade.objects.filter(
+                    student__in=student_chunk,
+                    marking_period__show_reports=True,
+                    marking_period__end_date__lte=self.date_end):
+                self.grades[(grade.student_id, grade.course_section_id, grade.marking_period_id)] = grade
+            for mp_grade in StudentMarkingPeriodGrade.objects.filter(student__in=student_chunk):
+                self.mp_grades[(mp_grade.student_id, mp_grade.marking_period_id)] = mp_grade
+            for year_grade in StudentYearGrade.objects.filter(student__in=student_chunk):
+                self.year_grades[(year_grade.student_id, year_grade.year_id)] = year_grade
+
+        # Final grades as of date_end for the courses transcripts show
+        graded = [
+            enrollment for enrollments in self.enrollments.values() for enrollment in enrollments
+            if enrollment.course_section.course.graded and self.report_marking_periods(enrollment)]
+        self.final_grades = CourseEnrollment.get_grades(graded, self.date_end)
+        today = datetime.date.today()
+        unfinished = [
+            year_grade for (student_id, year_id), year_grade in self.year_grades.iteritems()
+            if year_id in self.years and self.date_end < self.years[year_id].end_date
+            and self.date_end < today]
+        self.year_averages = StudentYearGradeSnapshot.lookup_many(unfinished, self.date_end)
+
+        self.attendance = self.count_year_attendance()
+        if 'ecwsp.standard_test' in settings.INSTALLED_APPS:
+            self.load_standard_tests()
+
+    def report_marking_periods(self, enrollment):
+        """ Marking periods shown on reports that enrollment's section meets in """
+        return [self.marking_periods[marking_period_id]
+                for marking_period_id in self.section_marking_periods.get(enrollment.course_section_id, ())
+                if self.marking_periods[marking_period_id].show_reports]
+
+    def count_year_attendance(self):
+        """ {(student_id, year_id): counts} for the transcript attendance """
+        return sum_attendance_counts(self.student_ids, self.years.values(),
+            ('nonmemb', 'absent', 'tardy', 'dismissed'))
+
+    def load_standard_tests(self):
+        from ecwsp.standard_test.models import StandardTestResult, StandardCategoryGrade
+        self.test_results = {}
+        self.category_grades = {}
+        for student_chunk in chunks(self.student_ids):
+            results = StandardTestResult.objects.filter(
+                student__in=student_chunk,
+                test__show_on_reports=True,
+                show_on_reports=True,
+            ).select_related('test').order_by('test', 'id')
+            for result in results:
+                self.test_results.setdefault(result.student_id, []).append(result)
+            category_grades = StandardCategoryGrade.objects.filter(
+                result__student__in=student_chunk,
+                result__test__show_on_reports=True,
+                result__show_on_reports=True,
+            ).select_related('category').order_by('id')
+            for category_grade in category_grades:
+                self.category_grades.setdefault(category_grade.result_id, []).append(category_grade)
+
+    def cherry_pick_total(self, test, results):
+        """ StandardTest.get_cherry_pick_total from the loaded results """
+        cherry = 0
+        if test.cherry_pick_final:
+            for result in results:
+                totals = [category_grade for category_grade in self.category_grades.get(result.id, [])
+                          if category_grade.category.is_total]
+                if totals and totals[0].grade > cherry:
+                    cherry = totals[0].grade
+        elif test.cherry_pick_categories:
+            highest = {}
+            for result in results:
+                for category_grade in self.category_grades.get(result.id, []):
+                    category_id = category_grade.category_id
+                    highest[category_id] = max(highest.get(category_id, category_grade.grade), category_grade.grade)
+            for grade in highest.values():
+                cherry += grade
+        return cherry
+
+    def get_year_average(self, year_grade):
+        """ year_grade.grade, or its get_grade(date_report=date_end) for
+        years that weren't over on date_end """
+        if year_grade is None:
+            return None
+        if year_grade.id in self.year_averages:
+            return round_as_decimal(self.year_averages[year_grade.id][0], 2)
+        return year_grade.grade
+
+    def attach(self, student):
+        """ Set the transcript attributes on student """
+        report = self.report
+        report_context = report.report_context
+        enrollments = self.enrollments.get(student.id, [])
+        year_ids = set()
+        for enrollment in enrollments:
+            year_ids.update(marking_period.school_year_id for marking_period in self.report_marking_periods(enrollment))
+        years = [self.years[year_id] for year_id in year_ids if (student.id, year_id) not in self.omitted_years]
+        if self.show_incomplete_without_grade is False:
+            # The school doesn't want to show all grades (default)
+            years = [year for year in years if year.start_date < self.date_end]
+        student.years = ReportList(copy.copy(year) for year in sorted(years, key=lambda year: year.start_date))
+        for year in student.years:
+            if self.show_incomplete_without_grade is True and year.start_date > self.date_end:
+                year.hide_grades = True
+            else:
+                year.hide_grades = False
+            year.credits = 0
+            year.possible_credits = 0
+            marking_periods = set()
+            for enrollment in enrollments:
+                marking_periods.update(marking_period for marking_period in self.report_marking_periods(enrollment)
+                                       if marking_period.school_year_id == year.id)
+            year.mps = ReportList(sorted(marking_periods, key=lambda marking_period: marking_period.start_date))
+            i = 1
+            for mp in year.mps:
+                setattr(year, "mp" + str(i), mp.shortname)
+                i += 1
+            while i <= 6:
+                setattr(year, "mp" + str(i), "")
+                i += 1
+
+            year_enrollments = []
+            for enrollment in enrollments:
+                section_mps = [marking_period for marking_period in self.report_marking_periods(enrollment)
+                               if marking_period.school_year_id == year.id]
+                if enrollment.course_section.course.graded and section_mps:
+                    year_enrollments.append((enrollment, section_mps))
+            sort_courses = report_context.get('sort_courses')
+            if sort_courses in ('marking_period, department', 'marking_period, fullname'):
+                def sort_key(item):
+                    enrollment, section_mps = item
+                    course = enrollment.course_section.course
+                    if sort_courses == 'marking_period, department':
+                        last = department_order(course.department)
+                    else:
+                        last = course.fullname
+                    return (-len(section_mps), max(marking_period.end_date for marking_period in section_mps), last)
+            else:
+                def sort_key(item):
+                    return department_order(item[0].course_section.course.department)
+            year_enrollments.sort(key=sort_key)
+
+            year.year_grade = self.year_grades.get((student.id, year.id))
+            if year.hide_grades is True and year.year_grade is not None:
+                year.year_grade.get_grade = hidden_grade
+            # course section grades
+            year.course_sections = ReportList()
+            for enrollment, section_mps in year_enrollments:
+                course_section = copy.copy(enrollment.course_section)
+                course_enrollment = enrollment
+                if year.hide_grades is True:
+                    # Hide the grades for the transcript.
+                    course_enrollment = copy.copy(enrollment)
+                    course_enrollment.get_grade = hidden_grade
+                course_section.ce = course_enrollment
+                i = 1
+                if year.hide_grades is False:
+                    for mp in year.mps:
+                        if mp not in section_mps:
+                            # Obey the registrar! Don't include grades from marking periods when the course section didn't meet.
+                            setattr(course_section, "grade" + str(i), "")
+                            i += 1
+                            continue
+                        grade = self.grades.get((student.id, course_section.id, mp.id))
+                        if grade is None:
+                            grade = ""
+                        else:
+                            grade = " " + str(grade.get_grade(number=report_context.get('omit_substitutions'))) + " "
+                        setattr(course_section, "grade" + str(i), grade)
+                        i += 1
+                while i <= 6:
+                    setattr(course_section, "grade" + str(i), "")
+                    i += 1
+                if year.hide_grades is True:
+                    course_section.final = ''
+                else:
+                    course_section.final = self.final_grades[enrollment.id]
+
+                if course_section.course.course_type.award_credits:
+                    if report.is_passing(course_section.final):
+                        year.credits += course_section.credits
+                    if course_section.credits:
+                        year.possible_credits += course_section.credits
+                year.course_sections.append(course_section)
+
+            year.courses = year.course_sections  # Backwards template compatibility
+
+            # Averages per marking period
+            i = 1
+            for mp in year.mps:
+                if mp.end_date <= self.date_end:
+                    mp_grade = self.mp_grades.get((student.id, mp.id))
+                    setattr(year, 'mp' + str(i) + 'ave', mp_grade.grade if mp_grade else "")
+                    i += 1
+            while i <= 6:
+                setattr(year, 'mp' + str(i) + 'ave', "")
+                i += 1
+
+            year.ave = self.get_year_average(year.year_grade)
+
+            # Attendance for year
+            year.total_days = report.lookups.year_days(year)
+            counts = self.attendance.get((student.id, year.id), {})
+            year.nonmemb = counts.get('nonmemb', 0)
+            year.absent = counts.get('absent', 0)
+            year.tardy = counts.get('tardy', 0)
+            year.dismissed = counts.get('dismissed', 0)
+
+        # credits per dept
+        departments = {}
+        for enrollment in enrollments:
+            course = enrollment.course_section.course
+            if course.department_id and course.course_type.award_credits:
+                departments.setdefault(course.department_id, copy.copy(course.department))
+        student.departments = ReportList(sorted(departments.values(), key=department_order))
+        student.departments_text = ""
+        for dept in student.departments:
+            c = 0
+            for enrollment in enrollments:
+                course_section = enrollment.course_section
+                course = course_section.course
+                if course.department_id != dept.id or not course.graded:
+                    continue
+                if not any(self.years[self.marking_periods[marking_period_id].school_year_id].end_date <= self.date_end
+                           for marking_period_id in self.section_marking_periods.get(course_section.id, ())):
+                    continue
+                if course.course_type.award_credits and course.credits and report.is_passing(enrollment.grade):
+                    c += course_section.credits
+            dept.credits = c
+            student.departments_text += "| %s: %s " % (dept, dept.credits)
+        student.departments_text += "|"
+
+        # Standardized tests
+        if 'ecwsp.standard_test' in settings.INSTALLED_APPS:
+            results = self.test_results.get(student.id, [])
+            student.tests = []
+            student.highest_tests = []
+            tests = {}
+            for test_result in results:
+                test_result.categories = ""
+                for cat in self.category_grades.get(test_result.id, []):
+                    if not cat.category.is_total:
+                        test_result.categories += '%s: %s | ' % (cat.category.name, strip_trailing_zeros(cat.grade))
+                test_result.categories = test_result.categories[:-3]
+                student.tests.append(test_result)
+                tests.setdefault(test_result.test_id, (test_result.test, []))[1].append(test_result)
+            for test_id in sorted(tests):
+                test, test_results = tests[test_id]
+                test = copy.copy(test)
+                test.total = strip_trailing_zeros(self.cherry_pick_total(test, test_results))
+                student.highest_tests.append(test)
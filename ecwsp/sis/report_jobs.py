@@ -0,0 +1,173 @@
+""" Generate scaffold reports in a celery task instead of the web request
+
+submit_report_job queues a ReportJob for a report download. A job for the
+same report, download type, filters and tenant is reused while it is pending
+or running and, once done, until it expires REPORT_JOB_TTL hours later. The
+browser polls report_job_status and fetches the file from report_job_download.
+Jobs are per user, so nobody gets a report rendered with another user's
+permissions. A running job holds one of REPORT_JOB_CONCURRENCY slots; a job
+still running REPORT_JOB_TIMEOUT minutes after it started is assumed to have
+died with its worker.
+"""
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.files.base import ContentFile
+from django.db import connection, transaction, IntegrityError
+from django.db.models import Q
+from django.http import HttpRequest, QueryDict
+from .models import ReportJob
+import datetime
+import hashlib
+import json
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+
+def job_key(report, download_type, post_data, user):
+    key = json.dumps([
+        getattr(connection, 'schema_name', ''),
+        user.pk if user.is_authenticated() else None,
+        report,
+        download_type,
+        json.loads(post_data) if post_data else None,
+    ], sort_keys=True)
+    return hashlib.sha1(key).hexdigest()
+
+
+def timed_out_before():
+    """ Running jobs started before this have timed out """
+    return datetime.datetime.now() - datetime.timedelta(minutes=settings.REPORT_JOB_TIMEOUT)
+
+
+def find_report_job(key):
+    """ A job with key that is still in progress or has an unexpired file """
+    now = datetime.datetime.now()
+    return ReportJob.objects.filter(key=key).filter(
+        Q(status='pending') |
+        Q(status='running', started__gt=timed_out_before()) |
+        Q(status='done', expires__gt=now)
+    ).first()
+
+
+def submit_report_job(report, download_type, post_data, user):
+    """ Queue the report download unless an identical one is already queued
+    or done. post_data is the json data posted by the report page.
+    Returns the ReportJob """
+    from .tasks import run_report_job_task
+    key = job_key(report, download_type, post_data, user)
+    job = find_report_job(key)
+    if job is not None:
+        return job
+    job = ReportJob.objects.create(
+        key=key,
+        report=report,
+        download_type=download_type,
+        post_data=post_data or '',
+        user=user if user.is_authenticated() else None,
+    )
+    run_report_job_task.apply_async((job.id,))
+    return job
+
+
+def running_report_jobs():
+    return ReportJob.objects.filter(status='running', started__gt=timed_out_before()).count()
+
+
+def fail_report_jobs(jobs, error):
+    """ Mark jobs failed, they expire like finished jobs """
+    now = datetime.datetime.now()
+    return jobs.update(
+        status='failed',
+        slot=None,
+        error=error,
+        finished=now,
+        expires=now + datetime.timedelta(hours=settings.REPORT_JOB_TTL),
+    )
+
+
+def claim_report_job(job):
+    """ Start a pending job in a free slot. Slots are unique, so checking for
+    a free slot and claiming the job is one conditional update that only one
+    worker can win. Returns whether the job was claimed. """
+    fail_report_jobs(
+        ReportJob.objects.filter(status='running', started__lte=timed_out_before()), 'Timed out')
+    started = datetime.datetime.now()
+    for slot in range(settings.REPORT_JOB_CONCURRENCY):
+        try:
+            with transaction.atomic():
+                claimed = ReportJob.objects.filter(pk=job.pk, status='pending').update(
+                    status='running', started=started, slot=slot)
+        except IntegrityError:
+            # Another job holds this slot
+            continue
+        if claimed:
+            job.status = 'running'
+            job.started = started
+            job.slot = slot
+        return bool(claimed)
+    return False
+
+
+def run_report_job(job):
+    """ Render the job's report with ChunkedDownloadReportView and save the
+    response to the job's file. Returns None without doing anything when the
+    job is not pending or every slot is taken. """
+    from .report_render import ChunkedDownloadReportView
+    if not claim_report_job(job):
+        return None
+    request = HttpRequest()
+    request.method = 'POST'
+    request.user = job.user or AnonymousUser()
+    request.GET = QueryDict('', mutable=True)
+    request.GET['type'] = job.download_type
+    request.POST = QueryDict('', mutable=True)
+    if job.post_data:
+        request.POST['data'] = job.post_data
+    try:
+        response = ChunkedDownloadReportView.as_view()(request, name=job.report)
+        if response.status_code != 200:
+            raise ValueError('Report returned status {0}'.format(response.status_code))
+        disposition = re.search(r'filename="?([^";]+)', response.get('Content-Disposition', ''))
+        job.file_name = disposition.group(1) if disposition else job.report
+        job.content_type = response['Content-Type']
+        if response.streaming:
+            content = b''.join(response.streaming_content)
+        else:
+            content = response.content
+        job.file.save(job.file_name, ContentFile(content), save=False)
+        job.status = 'done'
+    except Exception as e:
+        logger.error('Report job %s failed', job.id, exc_info=True)
+        job.status = 'failed'
+        job.error = unicode(e)
+    job.slot = None
+    job.finished = datetime.datetime.now()
+    job.expires = job.finished + datetime.timedelta(hours=settings.REPORT_JOB_TTL)
+    job.save()
+    return job
+
+
+def delete_expired_report_jobs():
+    """ Fail timed out jobs, delete finished jobs past their TTL and their files """
+    fail_report_jobs(
+        ReportJob.objects.filter(status='running', started__lte=timed_out_before()), 'Timed out')
+    for job in ReportJob.objects.filter(expires__lt=datetime.datetime.now()):
+        if job.file:
+            job.file.delete(save=False)
+        job.delete()
+
+
+def report_job_data(job):
+    """ What report_job_status returns for job """
+    data = {
+        'id': job.id,
+        'status': job.status,
+        'error': job.error,
+        'download_url': None,
+    }
+    if job.status == 'done':
+        from django.core.urlresolvers import reverse
+        data['download_url'] = reverse('report-job-download', args=(job.id,))
+    return data
@@ -0,0 +1,227 @@
+""" Render appy reports for many students in chunks
+
+Building the context and rendering one appy document for a whole school can
+take longer than a web request is allowed. render_report splits the students
+in chunks of REPORT_CHUNK_SIZE, builds and renders each chunk in a pool of
+REPORT_RENDER_WORKERS processes and concatenates the resulting odt files.
+Progress is kept in the cache so the browser can poll report_progress.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.core.servers.basehttp import FileWrapper
+from django.db import connection
+from django.http import HttpResponse
+from scaffold_report.report import scaffold_reports
+from scaffold_report.views import DownloadReportView
+import json
+import mimetypes
+import multiprocessing
+import os
+import re
+import tempfile
+import time
+import zipfile
+
+ODT_CONTENT_TYPE = 'application/vnd.oasis.opendocument.text'
+
+
+def progress_key(progress_id):
+    return 'report_progress_{0}_{1}'.format(
+        getattr(connection, 'schema_name', ''), progress_id)
+
+
+def set_progress(progress_id, done, total, report=None):
+    if progress_id:
+        cache.set(progress_key(progress_id), {'done': done, 'total': total, 'report': report}, 60 * 60)
+
+
+def get_progress(progress_id):
+    """ {'done': chunks rendered, 'total': chunks, 'report': report name}
+    or None """
+    return cache.get(progress_key(progress_id))
+
+
+def temp_file_name(ext='.odt'):
+    return os.path.join(tempfile.gettempdir(), 'appy{0}{1}{2}'.format(
+        time.time(), os.getpid(), ext))
+
+
+def render_appy(template, context, ext='.odt'):
+    """ Render an appy template to a temporary file and return its name """
+    from appy.pod.renderer import Renderer
+    outfile_name = temp_file_name(ext)
+    renderer = Renderer(template, context, outfile_name)
+    renderer.run()
+    return outfile_name
+
+
+def render_chunk(job):
+    """ Build the context for some students and render it
+    Runs in the pool workers, so the report is rebuilt from its name.
+    lookups is the report's ReportLookups, shared by every chunk """
+    report_name, post_data, report_context, lookups, student_ids = job
+    from ecwsp.sis.models import Student
+    report = scaffold_reports.get_report(report_name)()
+    if post_data:
+        report.handle_post_data(post_data)
+    report.report_context = dict(report_context)
+    if lookups is not None:
+        report._lookups = lookups
+    students = Student.objects.in_bulk(student_ids)
+    report.student_queryset = [students[i] for i in student_ids if i in students]
+    return render_appy(report.get_appy_template(), report.get_appy_context())
+
+
+def use_pool(workers):
+    # Daemonic processes, such as celery workers, can't have children and
+    # other processes can't see rows from an uncommitted transaction.
+    return (workers > 1 and not connection.in_atomic_block and
+            not multiprocessing.current_process().daemon)
+
+
+def render_report(report, post_data=None, progress_id=None):
+    """ Render a SisReport appy report and return the odt file name
+    report must already have handled post_data """
+    if hasattr(report, 'student_queryset'):
+        students = report.student_queryset
+    else:
+        students = report.get_queryset()
+    student_ids = [student.id for student in students]
+    chunk_size = max(getattr(settings, 'REPORT_CHUNK_SIZE', 100), 1)
+    workers = getattr(settings, 'REPORT_RENDER_WORKERS', 1)
+    if len(student_ids) <= chunk_size:
+        set_progress(progress_id, 0, 1, report.slug)
+        if not hasattr(report, 'student_queryset'):
+            report.student_queryset = students
+        file_name = render_appy(report.get_appy_template(), report.get_appy_context())
+        set_progress(progress_id, 1, 1, report.slug)
+        return file_name
+
+    lookups = getattr(report, 'lookups', None)
+    jobs = [(report.slug, post_data, report.report_context, lookups, student_ids[i:i + chunk_size])
+            for i in range(0, len(student_ids), chunk_size)]
+    set_progress(progress_id, 0, len(jobs), report.slug)
+    file_names = []
+    if use_pool(workers):
+        # Forked workers must not share the open database connection
+        connection.close()
+        pool = multiprocessing.Pool(min(workers, len(jobs)))
+        try:
+            for file_name in pool.imap(render_chunk, jobs):
+                file_names.append(file_name)
+                set_progress(progress_id, len(file_names), len(jobs), report.slug)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        for job in jobs:
+            file_names.append(render_chunk(job))
+            set_progress(progress_id, len(file_names), len(jobs), report.slug)
+    outfile_name = temp_file_name()
+    concatenate_odt(file_names, outfile_name)
+    for file_name in file_names:
+        try: os.remove(file_name)
+        except OSError: pass
+    return outfile_name
+
+
+OFFICE_TEXT = re.compile(r'(<office:text\b[^>]*>)(.*)(</office:text>)', re.S)
+AUTOMATIC_STYLES = re.compile(r'<office:automatic-styles\s*/>|<office:automatic-styles>(.*?)</office:automatic-styles>', re.S)
+AUTOMATIC_STYLE = re.compile(r'<(style:style|text:list-style)\b[^>]*?style:name="([^"]+)"[^>]*?(?:/>|>.*?</\1>)', re.S)
+BODY_DECLARATIONS = re.compile(r'<text:sequence-decls>.*?</text:sequence-decls>|<text:sequence-decls\s*/>|<office:forms\b[^>]*?(?:/>|>.*?</office:forms>)', re.S)
+
+
+def rename_style(xml, name, new_name):
+    return re.sub(r'(style-name|style:name)="{0}"'.format(re.escape(name)),
+                  r'\1="{0}"'.format(new_name), xml)
+
+
+def concatenate_odt(file_names, outfile_name):
+    """ Append the body of every odt in file_names to the first one
+    The files should be rendered from the same template, so only automatic
+    styles and pictures are copied from the later files. """
+    base = zipfile.ZipFile(file_names[0])
+    content = base.read('content.xml')
+    manifest = base.read('META-INF/manifest.xml')
+    entries = dict((name, base.read(name)) for name in base.namelist())
+    base.close()
+
+    match = AUTOMATIC_STYLES.search(content)
+    styles = dict((m.group(2), m.group(0)) for m in AUTOMATIC_STYLE.finditer(match.group(1) or ''))
+    new_styles = []
+    bodies = []
+    for i, file_name in enumerate(file_names[1:], 1):
+        part = zipfile.ZipFile(file_name)
+        part_content = part.read('content.xml')
+        for name in part.namelist():
+            if not name.startswith('Pictures/'):
+                continue
+            new_name = name
+            if name in entries:
+                if entries[name] == part.read(name):
+                    continue
+                new_name = 'Pictures/part{0}_{1}'.format(i, name[len('Pictures/'):])
+                part_content = part_content.replace('"{0}"'.format(name), '"{0}"'.format(new_name))
+            entries[new_name] = part.read(name)
+            media_type = mimetypes.guess_type(new_name)[0] or ''
+            manifest = manifest.replace('</manifest:manifest>',
+                ' <manifest:file-entry manifest:full-path="{0}" manifest:media-type="{1}"/>\n'
+                '</manifest:manifest>'.format(new_name, media_type))
+        part.close()
+
+        part_styles = AUTOMATIC_STYLES.search(part_content).group(1) or ''
+        for style in AUTOMATIC_STYLE.finditer(part_styles):
+            name, definition = style.group(2), style.group(0)
+            if styles.get(name) == definition:
+                continue
+            if name in styles:
+                new_name = '{0}_part{1}'.format(name, i)
+                definition = rename_style(definition, name, new_name)
+                part_content = rename_style(part_content, name, new_name)
+                name = new_name
+            styles[name] = definition
+            new_styles.append(definition)
+        bodies.append(BODY_DECLARATIONS.sub('', OFFICE_TEXT.search(part_content).group(2)))
+
+    content = OFFICE_TEXT.sub(
+        lambda m: m.group(1) + m.group(2) + ''.join(bodies) + m.group(3), content, count=1)
+    if new_styles:
+        content = AUTOMATIC_STYLES.sub(
+            lambda m: '<office:automatic-styles>{0}{1}</office:automatic-styles>'.format(
+                m.group(1) or '', ''.join(new_styles)), content, count=1)
+    entries['content.xml'] = content
+    entries['META-INF/manifest.xml'] = manifest
+
+    out = zipfile.ZipFile(outfile_name, 'w', zipfile.ZIP_DEFLATED)
+    # The mimetype must be the first entry and not compressed
+    out.writestr(zipfile.ZipInfo('mimetype'), entries.pop('mimetype', ODT_CONTENT_TYPE))
+    for name, data in sorted(entries.items()):
+        out.writestr(name, data)
+    out.close()
+
+
+class ChunkedDownloadReportView(DownloadReportView):
+    """ DownloadReportView that renders appy reports with render_report
+    Pass progress_id in the query string to poll report_progress, or async
+    to queue a ReportJob and get its status as json. """
+    def post(self, request, **kwargs):
+        download_type = request.GET.get('type')
+        if request.GET.get('async') and download_type != 'preview':
+            from .report_jobs import submit_report_job, report_job_data
+            job = submit_report_job(
+                kwargs['name'], download_type, request.POST.get('data'), request.user)
+            return HttpResponse(json.dumps(report_job_data(job)), content_type="application/json")
+        if download_type != 'appy':
+            return super(ChunkedDownloadReportView, self).post(request, **kwargs)
+        self.get_context_data(**kwargs)
+        post_data = None
+        if request.POST.get('data', None):
+            post_data = json.loads(request.POST['data'])
+            self.report.handle_post_data(post_data)
+        file_name = render_report(self.report, post_data, request.GET.get('progress_id'))
+        wrapper = FileWrapper(file(file_name))
+        response = HttpResponse(wrapper, content_type=ODT_CONTENT_TYPE)
+        response['Content-Length'] = os.path.getsize(file_name)
+        response['Content-Disposition'] = 'attachment; filename=report.odt'
+        return response
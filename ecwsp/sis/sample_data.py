@@ -10,6 +10,7 @@ import random
 import string
 import logging
 import datetime
+from decimal import Decimal
 
 class SisData(object):
     """ Put data creation code here. sample data code not here is punishible by death .
@@ -323,3 +324,62 @@ class SisData(object):
                 grade.save()
 
 
+    def create_synthetic_school(self, students=500, courses=8, marking_periods=4, section_size=30, seed=0):
+        """ A school of any size with random grades, used for benchmarks
+        Every student takes every course and has a grade in each marking period.
+        Rows are bulk created, so no grade cache is built.
+        Depends on create_required
+        """
+        rand = random.Random(seed)
+        self.year = SchoolYear.objects.create(
+            name="synthetic year", start_date=datetime.date(2014,7,1),
+            end_date=datetime.date(2015,6,30), active_year=True)
+        self.create_grade_scale_rules()
+        days = (self.year.end_date - self.year.start_date).days // marking_periods
+        self.marking_periods = []
+        for i in range(marking_periods):
+            start_date = self.year.start_date + datetime.timedelta(days=days * i)
+            end_date = start_date + datetime.timedelta(days=days - 1)
+            if i == marking_periods - 1:
+                end_date = self.year.end_date
+            self.marking_periods.append(MarkingPeriod.objects.create(
+                name="Synthetic MP {0}".format(i + 1), shortname="MP{0}".format(i + 1),
+                start_date=start_date, end_date=end_date, school_year=self.year))
+
+        self.students = [
+            Student.objects.create(
+                first_name="Student", last_name=str(i), username="synthetic{0}".format(i))
+            for i in range(students)]
+
+        Course.objects.bulk_create([
+            Course(fullname="Synthetic Course {0}".format(i), shortname="Course {0}".format(i),
+                   credits=1, course_type=self.normal_type, graded=True)
+            for i in range(courses)])
+        sections_per_course = (students + section_size - 1) // section_size
+        CourseSection.objects.bulk_create([
+            CourseSection(course=course, name="{0} - {1}".format(course.shortname, i))
+            for course in Course.objects.filter(fullname__startswith="Synthetic Course ")
+            for i in range(sections_per_course)])
+        sections = list(CourseSection.objects.filter(
+            course__fullname__startswith="Synthetic Course ").order_by('course', 'id'))
+        CourseSection.marking_period.through.objects.bulk_create([
+            CourseSection.marking_period.through(coursesection=section, markingperiod=marking_period)
+            for section in sections
+            for marking_period in self.marking_periods])
+
+        CourseEnrollment.objects.bulk_create([
+            CourseEnrollment(
+                user=student,
+                course_section=sections[course * sections_per_course + i // section_size])
+            for course in range(courses)
+            for i, student in enumerate(self.students)])
+        grades = []
+        for enrollment in CourseEnrollment.objects.filter(course_section__in=sections):
+            for marking_period in self.marking_periods:
+                grades.append(Grade(
+                    student_id=enrollment.user_id,
+                    course_section_id=enrollment.course_section_id,
+                    enrollment=enrollment,
+                    marking_period=marking_period,
+                    grade=Decimal(rand.randint(5500, 10000)) / 100))
+        Grade.objects.bulk_create(grades, batch_size=500)
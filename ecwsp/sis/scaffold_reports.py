@@ -8,20 +8,25 @@ from django.core.exceptions import ObjectDoesNotExist
 from django.db import models
 from django.db.utils import ProgrammingError
 from django.conf import settings
-from django.db.models import Count, Q, DateField, Max
+from django.db.models import Count, Q, DateField
 from constance import config
-from ecwsp.administration.models import Template, Configuration
+from ecwsp.administration.models import Template
 from ecwsp.sis.models import Student, SchoolYear, GradeLevel, Faculty, Cohort
 from ecwsp.attendance.models import CourseSectionAttendance, StudentAttendance, AttendanceStatus
 from ecwsp.schedule.calendar import Calendar
 from ecwsp.schedule.models import MarkingPeriod, Department, CourseMeet, Period, CourseSection, Course, CourseSectionTeacher, CourseEnrollment
 from ecwsp.grades.models import Grade
 from ecwsp.discipline.models import DisciplineAction, DisciplineActionInstance
+from ecwsp.sis.performance import measure
+from ecwsp.sis.report_data import ReportCardData, TranscriptData, ReportList, ReportLookups
+from ecwsp.sis.report_data import current_gpas, year_grades_by_student, failing_grades_by_student
 import autocomplete_light
 import datetime
-from decimal import Decimal
+import operator
+from decimal import Decimal, ROUND_HALF_UP
 from openpyxl.cell import get_column_letter
 from django.core.exceptions import ValidationError
+import numpy as np
 
 def reverse_compare(compare):
     """ Get the opposite comparison
@@ -96,9 +101,10 @@ def django_to_sql_compare(compare):
     return compare_sql
 
 
-class TardyFilter(IntCompareFilter):
-    compare_field_string = "tardy_count"
-    add_fields = ['tardy_count']
+class AttendanceCountFilter(IntCompareFilter):
+    """ Compare the sum of a StudentAttendanceCount field between
+    date_begin and date_end """
+    count_field = None
 
     def queryset_filter(self, queryset, report_context=None, **kwargs):
         date_begin = report_context['date_begin']
@@ -107,45 +113,42 @@ class TardyFilter(IntCompareFilter):
         value = self.cleaned_data['field_1']
 
         compare_sql = django_to_sql_compare(compare)
-
-        sql = """select coalesce(count(*), 0) from attendance_studentattendance
-                    left join attendance_attendancestatus
-                    on attendance_attendancestatus.id = attendance_studentattendance.status_id
-                    where attendance_attendancestatus.tardy = True
-                    and attendance_studentattendance.student_id = sis_student.user_ptr_id
-                    and attendance_studentattendance.date between %s and %s"""
+        compare_function = {
+            '<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge,
+        }.get(compare_sql, operator.eq)
+
+        count_sql = """select coalesce(sum({0}), 0) from attendance_studentattendancecount
+                    where attendance_studentattendancecount.student_id = sis_student.user_ptr_id
+                    and attendance_studentattendancecount.date between %s and %s""".format(self.count_field)
+        # Students are grouped once rather than counted row by row
+        students_sql = """select student_id from attendance_studentattendancecount
+                    where date between %s and %s group by student_id
+                    having {0}(sum({1}) {2} %s)"""
+        if compare_function(0, value):
+            # Students without attendance match too
+            where = 'sis_student.user_ptr_id not in (' + students_sql.format(
+                'not ', self.count_field, compare_sql) + ')'
+        else:
+            where = 'sis_student.user_ptr_id in (' + students_sql.format(
+                '', self.count_field, compare_sql) + ')'
         queryset = queryset.extra(
-                select = {'tardy_count': sql },
+                select = {self.compare_field_string: count_sql},
                 select_params = (date_begin, date_end,),
-                where = ['(' + sql + ') ' + compare_sql + ' %s'],
+                where = [where],
                 params = (date_begin, date_end, value))
         return queryset
 
 
-class AbsenceFilter(IntCompareFilter):
-    compare_field_string = "absence_count"
-    add_fields = ['absence_count']
-
-    def queryset_filter(self, queryset, report_context=None, **kwargs):
-        date_begin = report_context['date_begin']
-        date_end = report_context['date_end']
-        compare = self.cleaned_data['field_0']
-        value = self.cleaned_data['field_1']
+class TardyFilter(AttendanceCountFilter):
+    compare_field_string = "tardy_count"
+    add_fields = ['tardy_count']
+    count_field = "tardy"
 
-        compare_sql = django_to_sql_compare(compare)
 
-        sql = """select coalesce(count(*), 0) from attendance_studentattendance
-                    left join attendance_attendancestatus
-                    on attendance_attendancestatus.id = attendance_studentattendance.status_id
-                    where attendance_attendancestatus.absent = True
-                    and attendance_studentattendance.student_id = sis_student.user_ptr_id
-                    and attendance_studentattendance.date between %s and %s"""
-        queryset = queryset.extra(
-                select = {'absence_count': sql },
-                select_params = (date_begin, date_end,),
-                where = ['(' + sql + ') ' + compare_sql + ' %s'],
-                params = (date_begin, date_end, value))
-        return queryset
+class AbsenceFilter(AttendanceCountFilter):
+    compare_field_string = "absence_count"
+    add_fields = ['absence_count']
+    count_field = "absent"
 
 
 class CourseSectionsFilter(ModelMultipleChoiceFilter):
@@ -422,32 +425,23 @@ class GPAReportButton(ReportButton):
     name_verbose = "GPA per year"
 
     def get_report(self, report_view, context):
-        students = report_view.report.get_queryset()
+        students = list(report_view.report.get_queryset())
         titles = ["Student", "9th", "10th", "11th","12th", "Current"]
         data = []
         current_year = SchoolYear.objects.get(active_year = True)
-        two_years_ago = (current_year.end_date + datetime.timedelta(weeks=-(2*52))).year
-        three_years_ago = (current_year.end_date + datetime.timedelta(weeks=-(3*52))).year
-        four_years_ago = (current_year.end_date + datetime.timedelta(weeks=-(4*52))).year
+        year_grades = year_grades_by_student([student.id for student in students])
+        gpas = current_gpas(students)
         for student in students:
             row = [str(student)]
-            i = 0
-            for year_grade in student.studentyeargrade_set.order_by('year__start_date'):
-                if year_grade.year == current_year:
-                    row.append(year_grade.grade)
-                elif year_grade.year == two_years_ago:
-                    row.append(year_grade.grade)
-                elif year_grade.year == three_years_ago:
-                    row.append(year_grade.grade)
-                elif year_grade.year == four_years_ago:
+            # Only the active year's grade is filled in
+            for year_grade in year_grades.get(student.id, []):
+                if year_grade.year_id == current_year.id:
                     row.append(year_grade.grade)
                 else:
                     row.append('')
-                i += 1
-            while i < 4:
+            while len(row) < 5:
                 row.append('')
-                i += 1
-            row.append(student.gpa)
+            row.append(gpas[student.id])
             data.append(row)
         return report_view.list_to_xlsx_response(data, 'gpas_by_year', header=titles)
 
@@ -471,24 +465,18 @@ class FailReportButton(ReportButton):
             titles += [str(department)]
         titles += ['Total', '', 'Username', 'Year','GPA', '', 'Failed course sections']
 
-        passing_grade = float(Configuration.get_or_default('Passing Grade','70').value)
+        passing_grade = report_view.report.lookups.passing_grade()
+        students = list(students)
+        student_ids = [student.id for student in students]
+        failed_grades = failing_grades_by_student(student_ids, marking_periods, passing_grade)
+        gpas = current_gpas(students)
 
         data = []
         iy=2
         for student in students:
             row = [str(student)]
             ix = 1 # letter A
-            # query the database once per student, not once per student per department
-            # anticipate calling str() on grade.course_section and grade.marking_period
-            student.failed_grades = student.grade_set.select_related(
-                'course_section__course__department_id',
-                'course_section__name',
-                'marking_period__name',
-            ).filter(
-                override_final=False,
-                grade__lt=passing_grade,
-                marking_period__in=marking_periods
-            ).distinct()
+            student.failed_grades = failed_grades.get(student.id, [])
             department_counts = {}
             end_of_row = []
             for grade in student.failed_grades:
@@ -509,7 +497,7 @@ class FailReportButton(ReportButton):
                 '',
                 student.username,
                 str(student.year),
-                student.gpa,
+                gpas[student.id],
                 '',
                 ]
             row += end_of_row
@@ -523,106 +511,99 @@ class AggregateGradeButton(ReportButton):
     name = "aggregate_grade_report"
     name_verbose = "Aggregated teacher grades"
 
+    ranges = [['100', '90'], ['89.99', '80'], ['79.99', '70'], ['69.99', '60'], ['59.99', '50'], ['49.99', '0']]
+    letter_ranges = ['P', 'F']
+
+    @staticmethod
+    def percent(count, total):
+        percent = float(count) / float(total)
+        return ('%.2f' % (percent * 100,)).rstrip('0').rstrip('.')
+
+    def count_teacher_grades(self, mps, teacher_ids):
+        """ Count each teacher's grades by range or letter and grade level
+        returns counts {(teacher_id, range or letter, level_id): count}
+        where range, level or both may be None for totals. Students without a
+        grade level only count in the totals. """
+        rows = set(Grade.objects.filter(
+            marking_period__in=mps,
+            course_section__teachers__in=teacher_ids,
+            student__is_active=True,
+            override_final=False,
+        ).filter(
+            Q(grade__isnull=False) |
+            Q(letter_grade__isnull=False)
+        ).values_list('id', 'course_section__teachers', 'grade', 'letter_grade', 'student__year'))
+        ranges = [(Decimal(low), Decimal(high), high) for high, low in self.ranges]
+        counts = {}
+        for grade_id, teacher_id, grade, letter_grade, level_id in rows:
+            buckets = [None]
+            if grade is not None:
+                buckets += [high for low_bound, high_bound, high in ranges
+                            if low_bound <= grade <= high_bound]
+            if letter_grade in self.letter_ranges:
+                buckets.append(letter_grade)
+            levels = (None,) if level_id is None else (None, level_id)
+            for bucket in buckets:
+                for level in levels:
+                    key = (teacher_id, bucket, level)
+                    counts[key] = counts.get(key, 0) + 1
+        return counts
+
     def get_report(self, report_view, context):
         mps = report_view.report.report_context['marking_periods']
+        levels = list(GradeLevel.objects.all())
         titles = ["Teacher", "Range", "No. Students", ""]
-        for level in GradeLevel.objects.all():
+        for level in levels:
             titles += [str(level), ""]
         data = [titles]
-        ranges = [['100', '90'], ['89.99', '80'], ['79.99', '70'], ['69.99', '60'], ['59.99', '50'], ['49.99', '0']]
-        letter_ranges = ['P', 'F']
-        for teacher in Faculty.objects.filter(coursesection__marking_period__in=mps, is_active=True).distinct():
+        teachers = Faculty.objects.filter(coursesection__marking_period__in=mps, is_active=True).distinct()
+        teachers = list(teachers)
+        counts = self.count_teacher_grades(mps, [teacher.id for teacher in teachers])
+        buckets = [(range[0], str(range[1]) + " to " + str(range[0])) for range in self.ranges]
+        buckets += [(range, str(range)) for range in self.letter_ranges]
+        for teacher in teachers:
             data.append([str(teacher)])
-            grades = Grade.objects.filter(
-                marking_period__in=mps,
-                course_section__teachers=teacher,
-                student__is_active=True,
-                override_final=False,
-            ).filter(
-                Q(grade__isnull=False) |
-                Q(letter_grade__isnull=False)
-            )
-            teacher_students_no = grades.distinct().count()
+            teacher_students_no = counts.get((teacher.id, None, None), 0)
             if teacher_students_no:
-                for range in ranges:
-                    no_students = grades.filter(
-                            grade__range=(range[1],range[0]),
-                        ).distinct().count()
-                    percent = float(no_students) / float(teacher_students_no)
-                    percent = ('%.2f' % (percent * 100,)).rstrip('0').rstrip('.') + "%"
-                    row = ["", str(range[1]) + " to " + str(range[0]), no_students, percent]
-                    for level in GradeLevel.objects.all():
-                        no_students = grades.filter(
-                                grade__range=(range[1],range[0]),
-                                student__year__in=[level],
-                            ).distinct().count()
-                        level_students_no = grades.filter(
-                                student__year__in=[level],
-                            ).distinct().count()
+                for bucket, label in buckets:
+                    no_students = counts.get((teacher.id, bucket, None), 0)
+                    row = ["", label, no_students, self.percent(no_students, teacher_students_no) + "%"]
+                    for level in levels:
+                        no_students = counts.get((teacher.id, bucket, level.id), 0)
+                        level_students_no = counts.get((teacher.id, None, level.id), 0)
                         percent = ""
                         if level_students_no:
-                            percent = float(no_students) / float(level_students_no)
-                            percent = ('%.2f' % (percent * 100,)).rstrip('0').rstrip('.') + "%"
-                        row += [no_students, percent]
-                    data.append(row)
-                for range in letter_ranges:
-                    no_students = grades.filter(
-                            letter_grade=range,
-                        ).distinct().count()
-                    if teacher_students_no:
-                        percent = float(no_students) / float(teacher_students_no)
-                        percent = ('%.2f' % (percent * 100,)).rstrip('0').rstrip('.') + "%"
-                    else:
-                        percent = ""
-                    row = ["", str(range), no_students, percent]
-                    for level in GradeLevel.objects.all():
-                        no_students = grades.filter(
-                                letter_grade=range,
-                                student__year__in=[level],
-                            ).distinct().count()
-                        level_students_no = grades.filter(
-                                student__year__in=[level],
-                            ).distinct().count()
-                        if level_students_no:
-                            percent = float(no_students) / float(level_students_no)
-                            percent = ('%.2f' % (percent * 100,)).rstrip('0').rstrip('.') + "%"
-                        else:
-                            percent = ""
+                            percent = self.percent(no_students, level_students_no) + "%"
                         row += [no_students, percent]
                     data.append(row)
 
         report_data = {'teacher_aggregate': data}
 
         passing = 70
+        departments = report_view.report.lookups.departments()
         titles = ['Grade']
-        for dept in Department.objects.all():
+        for dept in departments:
             titles.append(str(dept))
             titles.append('')
         dept_data = [titles]
-        for level in GradeLevel.objects.all():
+        grades = Grade.objects.filter(
+            marking_period__in=mps,
+            student__is_active=True,
+            override_final=False,
+        ).order_by().values('student__year', 'course_section__course__department').annotate(count=Count('id'))
+        totals = dict(((row['student__year'], row['course_section__course__department']), row['count'])
+                      for row in grades)
+        fails = dict(((row['student__year'], row['course_section__course__department']), row['count'])
+                     for row in grades.filter(grade__lt=passing))
+        for level in levels:
             row = [str(level)]
-            for dept in Department.objects.all():
-                fails = Grade.objects.filter(
-                    marking_period__in=mps,
-                    course_section__course__department=dept,
-                    student__is_active=True,
-                    student__year__in=[level],   # Shouldn't need __in. Makes no sense at all.
-                    grade__lt=passing,
-                    override_final=False,
-                ).count()
-                total = Grade.objects.filter(
-                    marking_period__in=mps,
-                    course_section__course__department=dept,
-                    student__is_active=True,
-                    student__year__in=[level],
-                    override_final=False,
-                ).count()
+            for dept in departments:
+                total = totals.get((level.id, dept.id), 0)
+                percent = 0
                 if total:
-                    percent = float(fails) / float(total)
-                else:
-                    percent = 0
+                    percent = float(fails.get((level.id, dept.id), 0)) / float(total)
                 percent = ('%.2f' % (percent * 100,)).rstrip('0').rstrip('.')
-                row.append(fails)
+                row.append(fails.get((level.id, dept.id), 0))
                 row.append(percent)
             dept_data.append(row)
 
@@ -632,7 +613,6 @@ class AggregateGradeButton(ReportButton):
 class GradeDistributionByTeacherButton(ReportButton):
     name = "grade_distribution_report"
     name_verbose = "Grade Distribution By Teacher"
-    report_data = {'sheet_1': []}
     column_headers = [
         "Teacher name",
         "Course",
@@ -642,49 +622,125 @@ class GradeDistributionByTeacherButton(ReportButton):
         "Average for all students in course (all teachers)",
         "Average for all students taught by teacher (all cohorts and courses)"
         ]
-    
+
     def get_report(self, report_view, context):
-        
+        self.load_grades()
+        report_data = {'sheet_1': []}
         for teacher in Faculty.objects.all():
             teacher_data = self.get_teacher_data(teacher)
-            self.add_teacher_data_to_report_sheet(teacher_data, "sheet_1")
+            self.add_teacher_data_to_report_sheet(report_data, teacher_data, "sheet_1")
             if teacher_data['sections']:
                 # add blank row only for teachers with data, otherwise we'll
                 # have a bunch of blank rows on top of each other!
-                self.add_blank_row_to_report_sheet("sheet_1")
-            
-        return report_view.list_to_xlsx_response(self.report_data, "grade_distribution_report", header=self.column_headers)
-        
+                report_data["sheet_1"].append([""])
+
+        return report_view.list_to_xlsx_response(report_data, "grade_distribution_report", header=self.column_headers)
+
+    def load_grades(self):
+        """ Load every enrollment's numeric grade once and total them by
+        section and course. Grades are summed as whole hundredths so the
+        averages match adding up the Decimal grades. """
+        rows = list(CourseEnrollment.objects.values_list(
+            'id', 'user_id', 'course_section_id', 'cached_numeric_grade', 'numeric_grade_recalculation_needed'))
+        stale = [CourseEnrollment(id=row[0], user_id=row[1], course_section_id=row[2])
+                 for row in rows if row[4]]
+        recalculated = CourseEnrollment.calculate_grades_real(stale) if stale else {}
+        # {section id: {student id: [grade in hundredths]}} for cohort averages
+        self.section_grades = {}
+        for enrollment_id, student_id, section_id, numeric_grade, recalculation_needed in rows:
+            if recalculation_needed:
+                numeric_grade = recalculated.get(enrollment_id)
+                if not isinstance(numeric_grade, Decimal):
+                    continue
+                numeric_grade = numeric_grade.quantize(Decimal(".01"), rounding=ROUND_HALF_UP)
+            if numeric_grade is not None:
+                self.section_grades.setdefault(section_id, {}).setdefault(student_id, []).append(
+                    int(numeric_grade * 100))
+
+        sections = list(CourseSection.objects.order_by('id').values_list('id', 'course_id'))
+        section_index = dict((section_id, i) for i, (section_id, course_id) in enumerate(sections))
+        courses, course_index = np.unique(
+            np.array([course_id for section_id, course_id in sections], dtype=int), return_inverse=True)
+        grade_sections = []
+        grades = []
+        for section_id, students in self.section_grades.iteritems():
+            for student_grades in students.values():
+                grade_sections += [section_index[section_id]] * len(student_grades)
+                grades += student_grades
+        grade_sections = np.array(grade_sections, dtype=int)
+        grades = np.array(grades, dtype=float)
+        grade_courses = course_index[grade_sections]
+        # numpy before 1.10 rejects minlength=0
+        section_sums = np.bincount(grade_sections, grades, minlength=max(len(sections), 1))
+        section_counts = np.bincount(grade_sections, minlength=max(len(sections), 1))
+        course_sums = np.bincount(grade_courses, grades, minlength=max(len(courses), 1))
+        course_counts = np.bincount(grade_courses, minlength=max(len(courses), 1))
+        self.section_totals = dict(
+            (section_id, (section_sums[i], section_counts[i])) for section_id, i in section_index.iteritems())
+        self.course_totals = dict(
+            (course_id, (course_sums[i], course_counts[i])) for i, course_id in enumerate(courses))
+
+        self.teacher_sections = {}
+        for teacher_id, section_id in CourseSectionTeacher.objects.values_list('teacher_id', 'course_section_id'):
+            self.teacher_sections.setdefault(teacher_id, set()).add(section_id)
+        self.active_sections = list(CourseSection.objects.filter(is_active=True).order_by('id'))
+        self.section_cohorts = {}
+        for section_id, cohort_id in CourseSection.cohorts.through.objects.values_list(
+                'coursesection_id', 'cohort_id'):
+            self.section_cohorts.setdefault(section_id, []).append(cohort_id)
+        self.cohorts = Cohort.objects.in_bulk(
+            set(cohort_id for cohort_ids in self.section_cohorts.values() for cohort_id in cohort_ids))
+        self.cohort_students = {}
+        for cohort_id, student_id in Cohort.students.through.objects.filter(
+                cohort__in=self.cohorts.keys()).values_list('cohort_id', 'student_id'):
+            self.cohort_students.setdefault(cohort_id, set()).add(student_id)
+
+    @staticmethod
+    def average(total, count):
+        """ Average of grades in hundredths, rounded like the Decimal sum """
+        if count > 0:
+            average = (Decimal(int(total)) / 100) / int(count)
+            return round(average, 1)
+        return None
+
     def get_teacher_data(self, teacher):
+        section_ids = self.teacher_sections.get(teacher.id, set())
+        totals = [self.section_totals.get(section_id, (0, 0)) for section_id in section_ids]
         teacher_data = {
             'teacher_name' : "%s, %s" % (teacher.last_name, teacher.first_name),
-            'teacher_avg' : self.get_teacher_average(teacher),
+            'teacher_avg' : self.average(sum(total for total, count in totals), sum(count for total, count in totals)),
             'sections' : self.get_all_sections_for_teacher(teacher)
         }
         return teacher_data
-        
+
     def get_all_sections_for_teacher(self, teacher):
+        section_ids = self.teacher_sections.get(teacher.id, set())
         all_sections = []
-        for section in CourseSection.objects.filter(teachers__in = [teacher], is_active=True):
-            all_sections.append(self.get_individual_section_data(section))
+        for section in self.active_sections:
+            if section.id in section_ids:
+                all_sections.append(self.get_individual_section_data(section))
         return all_sections
-            
+
     def get_individual_section_data(self, section):
         individual_section_data = {
-            'section_avg' : self.get_section_average(section),
-            'course_avg' : self.get_course_average(section.course),
+            'section_avg' : self.average(*self.section_totals.get(section.id, (0, 0))),
+            'course_avg' : self.average(*self.course_totals.get(section.course_id, (0, 0))),
             'section_name' : section.name,
             'cohorts' : self.get_cohort_data_for_section(section)
         }
         return individual_section_data
-        
+
     def get_cohort_data_for_section(self, section):
-        cohorts = section.cohorts.all()
+        cohorts = sorted((self.cohorts[cohort_id] for cohort_id in self.section_cohorts.get(section.id, [])),
+                         key=lambda cohort: cohort.name)
+        section_grades = self.section_grades.get(section.id, {})
         cohort_data = []
         for cohort in cohorts:
+            grades = [grade for student_id in self.cohort_students.get(cohort.id, ())
+                      for grade in section_grades.get(student_id, [])]
             cohort_data.append({
                 'cohort_name' : cohort.name,
-                'cohort_avg' : self.get_cohort_section_average(cohort, section)
+                'cohort_avg' : self.average(sum(grades), len(grades))
             })
         if not cohorts:
             cohort_data.append({
@@ -692,56 +748,21 @@ class GradeDistributionByTeacherButton(ReportButton):
                 'cohort_avg' : ""
             })
         return cohort_data
-        
-    def add_teacher_data_to_report_sheet(self, teacher_data, sheet_name):
+
+    def add_teacher_data_to_report_sheet(self, report_data, teacher_data, sheet_name):
         for section in teacher_data['sections']:
             for cohort in section['cohorts']:
                 new_row = [
-                    teacher_data['teacher_name'], 
-                    section['section_name'], 
+                    teacher_data['teacher_name'],
+                    section['section_name'],
                     cohort['cohort_name'],
-                    cohort['cohort_avg'], 
-                    section['section_avg'], 
-                    section['course_avg'], 
+                    cohort['cohort_avg'],
+                    section['section_avg'],
+                    section['course_avg'],
                     teacher_data['teacher_avg']
                 ]
-                self.report_data[sheet_name].append(new_row)
-                
-    def add_blank_row_to_report_sheet(self, sheet_name):
-        self.report_data[sheet_name].append([""])
-            
-    def get_cohort_section_average(self, cohort, section):
-        section_enrollments = CourseEnrollment.objects.filter(course_section=section, user__in=cohort.students.all())
-        return self.get_average_grade_from_enrollment_set(section_enrollments)
-            
-    def get_section_average(self, section):
-        section_enrollments = CourseEnrollment.objects.filter(course_section=section)
-        return self.get_average_grade_from_enrollment_set(section_enrollments)
-    
-    def get_course_average(self, course):
-        all_sections = CourseSection.objects.filter(course=course)
-        all_sections_enrollments = CourseEnrollment.objects.filter(course_section__in=all_sections)
-        return self.get_average_grade_from_enrollment_set(all_sections_enrollments)
-    
-    def get_teacher_average(self, teacher):
-        all_sections = CourseSection.objects.filter(teachers__in=[teacher])
-        all_sections_enrollments = CourseEnrollment.objects.filter(course_section__in=all_sections)
-        return self.get_average_grade_from_enrollment_set(all_sections_enrollments)
-        
-    def get_average_grade_from_enrollment_set(self, enrollments):
-        """ return the average grade for a given set of student enrollments """
-        non_null_grade_count = 0
-        sum_of_all_grades = Decimal('0.00')
-        for enrollment in enrollments:
-            if enrollment.numeric_grade is not None:
-                non_null_grade_count += 1
-                sum_of_all_grades += enrollment.numeric_grade
-        if non_null_grade_count > 0:
-            average = sum_of_all_grades / non_null_grade_count
-            return round(average, 1)
-        else:
-            return None
-            
+                report_data[sheet_name].append(new_row)
+
 class AspReportButton(ReportButton):
     name = "asp_report"
     name_verbose = "ASP Report"
@@ -914,12 +935,6 @@ class CourseSectionAttendanceButton(ReportButton):
 
         return report_view.list_to_xlsx_response(data, document_name)
 
-def strip_trailing_zeros(x):
-    x = str(x).strip()
-    # http://stackoverflow.com/a/2440786
-    return x.rstrip('0').rstrip('.')
-
-
 class struct(object):
     def __unicode__(self):
         return ""
@@ -956,6 +971,13 @@ class SisReport(ScaffoldReport):
         GradeDistributionByTeacherButton(),
     )
 
+    @property
+    def lookups(self):
+        """ ReportLookups for this report run """
+        if not hasattr(self, '_lookups'):
+            self._lookups = ReportLookups()
+        return self._lookups
+
     def is_passing(self, grade):
         """ Is a grade considered passing """
         try:
@@ -968,22 +990,12 @@ class SisReport(ScaffoldReport):
         return False
 
     def get_student_report_card_data(self, student):
-        course_sections = student.coursesection_set.filter(
-            course__graded=True,
-            marking_period__in=self.marking_periods,
-        ).distinct().order_by('course__department')
-        marking_periods = self.marking_periods.order_by('start_date')
-        mp_grade = {}
-        for marking_period in marking_periods:
-            smpg = student.studentmarkingperiodgrade_set.filter(marking_period=marking_period).first()
-            marking_period.smpg = smpg
-            # also save to a dict for alternative lookup
-            mp_grade[marking_period.name] = smpg
-        student.mps = list(marking_periods)
-        student.year_grade = student.studentyeargrade_set.filter(year=self.school_year).first()
-
-        # for example: student.mp_grade['1st'] or ...['S1X']
-        student.mp_grade = mp_grade
+        """ Set report card attributes on student, using the data loaded
+        for the whole report when there is some """
+        data = getattr(self, 'report_card_data', None)
+        if data is None or student.id not in data.student_ids:
+            data = ReportCardData([student], self.marking_periods, self.school_year)
+        data.attach(student, self.blank_grade)
 
         # the tuples of semester 1 marking periods and semester 2 marking
         # periods are useful for certain calculations
@@ -999,221 +1011,18 @@ class SisReport(ScaffoldReport):
         # actually need this function...
         student.semester_average = Grade.get_scaled_multiple_mp_average
 
-        for course_section in course_sections:
-            course_enrollment = course_section.courseenrollment_set.get(user=student)
-            grades = course_section.grade_set.filter(student=student).filter(
-                marking_period__isnull=False,
-                marking_period__show_reports=True).order_by('marking_period__start_date')
-
-            section_mp_grades = {}
-            for i, marking_period in enumerate(self.marking_periods.order_by('start_date')):
-                for grade in grades:
-                    if grade.marking_period_id == marking_period.id:
-                        # course_section.grade1, course_section.grade2, etc
-                        setattr(course_section, "grade" + str(i + 1), grade)
-
-                        # also save grade in a dict; fetched by MP name
-                        # useful if mp.id is in unexpected order
-                        # i.e. course_section.mp_grade['S1X']
-                        section_mp_grades[marking_period.name] = grade
-                        break
-                attr_name = "grade" + str(i + 1)
-                if not hasattr(course_section, attr_name):
-                    setattr(course_section, attr_name, self.blank_grade)
-
-                if marking_period.name not in section_mp_grades:
-                    # populate the dict with blank grade
-                    section_mp_grades[marking_period.name] = self.blank_grade
-
-                # set the mp_grades dict to the course_section object
-                setattr(course_section, 'mp_grade', section_mp_grades)
-            course_section.final = course_enrollment.grade
-            course_section.ce = course_enrollment
-        student.course_sections = course_sections
-        student.courses = student.course_sections  # Backwards compatibility
-
-        #Attendance for marking period
-        i = 1
-        student.absent_total = 0
-        student.absent_unexcused_total = 0
-        student.tardy_total = 0
-        student.tardy_unexcused_total = 0
-        student.dismissed_total = 0
-        for mp in self.marking_periods.order_by('start_date'):
-            absent = student.student_attn.filter(status__absent=True, date__range=(mp.start_date, mp.end_date))
-            tardy = student.student_attn.filter(status__tardy=True, date__range=(mp.start_date, mp.end_date))
-            dismissed = student.student_attn.filter(status__code="D", date__range=(mp.start_date, mp.end_date)).count()
-            absent_unexcused = absent.exclude(status__excused=True).count()
-            tardy_unexcused = tardy.exclude(status__excused=True).count()
-            absent = absent.count()
-            tardy = tardy.count()
-
-            student.absent_total += absent
-            student.tardy_total += tardy
-            student.absent_unexcused_total += absent_unexcused
-            student.tardy_unexcused_total += tardy_unexcused
-            student.dismissed_total += dismissed
-            setattr(student, "absent" + str(i), absent)
-            setattr(student, "tardy" + str(i), tardy)
-            setattr(student, "tardy_unexcused" + str(i), tardy_unexcused)
-            setattr(student, "absent_unexcused" + str(i), absent_unexcused)
-            setattr(student, "dismissed" + str(i), dismissed)
-            i += 1
-        while i <= 6:
-            setattr(student, "absent" + str(i), "")
-            setattr(student, "tardy" + str(i), "")
-            setattr(student, "tardy_unexcused" + str(i), "")
-            setattr(student, "absent_unexcused" + str(i), "")
-            setattr(student, "dismissed" + str(i), "")
-            i += 1
-
     def get_student_transcript_data(self, student):
-        show_incomplete_without_grade = config.TRANSCRIPT_SHOW_INCOMPLETE_COURSES_WITHOUT_GRADE
-        def fake_method(*args, **kargs): return ''
-        student.years = SchoolYear.objects.filter(
-            markingperiod__show_reports=True,
-            markingperiod__coursesection__courseenrollment__user=student,
-            ).exclude(omityeargpa__student=student).distinct().order_by('start_date')
-        if show_incomplete_without_grade is False:
-            # The school doesn't want to show all grades (default)
-            student.years = student.years.filter(start_date__lt=self.date_end)
-        for year in student.years:
-            if show_incomplete_without_grade is True and year.start_date > self.date_end:
-                year.hide_grades = True
-            else:
-                year.hide_grades = False
-            year.credits = 0
-            year.possible_credits = 0
-            year.mps = MarkingPeriod.objects.filter(coursesection__courseenrollment__user=student, school_year=year, show_reports=True).distinct().order_by("start_date")
-            i = 1
-            for mp in year.mps:
-                setattr(year, "mp" + str(i), mp.shortname)
-                i += 1
-            while i <= 6:
-                setattr(year, "mp" + str(i), "")
-                i += 1
-            year.course_sections = student.coursesection_set.filter(
-                course__graded=True,
-                marking_period__school_year=year,
-                marking_period__show_reports=True
-            ).distinct()
-            if self.report_context.get('sort_courses') == 'marking_period, department':
-                year.course_sections = year.course_sections.annotate(Count('marking_period'), Max('marking_period__end_date')).order_by('-marking_period__count', 'marking_period__end_date__max', 'course__department')
-            if self.report_context.get('sort_courses') == 'marking_period, fullname':
-                year.course_sections = year.course_sections.annotate(Count('marking_period'), Max('marking_period__end_date')).order_by('-marking_period__count', 'marking_period__end_date__max', 'course__fullname')
-            else:
-                year.course_sections = year.course_sections.order_by('course__department')
-            year_grades = student.grade_set.filter(marking_period__show_reports=True, marking_period__end_date__lte=self.report_context['date_end'])
-            year.year_grade = student.studentyeargrade_set.filter(year=year).first()
-            if year.hide_grades is True:
-                year.year_grade.get_grade = fake_method
-            # course section grades
-            for course_section in year.course_sections:
-                course_enrollment = course_section.courseenrollment_set.get(user=student)
-                if year.hide_grades is True:
-                    # Hide the grades for the transcript.
-                    course_enrollment.get_grade = fake_method
-                course_section.ce = course_enrollment
-                # Grades
-                course_section_grades = year_grades.filter(course_section=course_section).distinct()
-                i = 1
-                if year.hide_grades is False:
-                    for mp in year.mps:
-                        if mp not in course_section.marking_period.all():
-                            # Obey the registrar! Don't include grades from marking periods when the course section didn't meet.
-                            setattr(course_section, "grade" + str(i), "")
-                            i += 1
-                            continue
-                        # We can't overwrite cells, so we have to get seperate variables for each mp grade.
-                        try:
-                            grade = course_section_grades.get(marking_period=mp).get_grade(
-                                number=self.report_context.get('omit_substitutions'))
-                            grade = " " + str(grade) + " "
-                        except:
-                            grade = ""
-                        setattr(course_section, "grade" + str(i), grade)
-                        i += 1
-                while i <= 6:
-                    setattr(course_section, "grade" + str(i), "")
-                    i += 1
-                course_section.final = course_enrollment.get_grade(self.date_end)
-
-                if course_section.course.course_type.award_credits:
-                    if self.is_passing(course_section.final):
-                        year.credits += course_section.credits
-                    if course_section.credits:
-                        year.possible_credits += course_section.credits
-
-            year.courses = year.course_sections  # Backwards template compatibility
-
-            # Averages per marking period
-            i = 1
-            for mp in year.mps:
-                if mp.end_date <= self.report_context['date_end']:
-                    mp_grade = student.studentmarkingperiodgrade_set.get(marking_period=mp)
-                    setattr(year, 'mp' + str(i) + 'ave', mp_grade.grade)
-                    i += 1
-            while i <= 6:
-                setattr(year, 'mp' + str(i) + 'ave', "")
-                i += 1
-
-            if self.date_end >= year.end_date:
-                year.ave = student.studentyeargrade_set.get(year=year).grade
-            else:
-                year.ave = student.studentyeargrade_set.get(year=year).get_grade(date_report=self.date_end)
-
-            # Attendance for year
-            if not hasattr(self, 'year_days'):
-                self.year_days = {}
-            if not year.id in self.year_days:
-                self.year_days[year.id] = year.get_number_days()
-            year.total_days = self.year_days[year.id]
-            year.nonmemb = student.student_attn.filter(status__code="nonmemb", date__range=(year.start_date, year.end_date)).count()
-            year.absent = student.student_attn.filter(status__absent=True, date__range=(year.start_date, year.end_date)).count()
-            year.tardy = student.student_attn.filter(status__tardy=True, date__range=(year.start_date, year.end_date)).count()
-            year.dismissed = student.student_attn.filter(status__code="D", date__range=(year.start_date, year.end_date)).count()
-            # credits per dept
-            student.departments = Department.objects.filter(
-                course__sections__courseenrollment__user=student,
-                course__course_type__award_credits=True,
-            ).distinct()
-            student.departments_text = ""
-            for dept in student.departments:
-                c = 0
-                for course_section in student.coursesection_set.filter(
-                    course__department=dept,
-                    marking_period__school_year__end_date__lte=self.date_end,
-                    course__graded=True).distinct():
-                    if course_section.course.course_type.award_credits and course_section.course.credits and self.is_passing(
-                        course_section.courseenrollment_set.get(user=student).grade
-                    ):
-                        c += course_section.credits
-                dept.credits = c
-                student.departments_text += "| %s: %s " % (dept, dept.credits)
-            student.departments_text += "|"
-
-            # Standardized tests
-            if 'ecwsp.standard_test' in settings.INSTALLED_APPS:
-                from ecwsp.standard_test.models import StandardTest
-                student.tests = []
-                student.highest_tests = []
-                for test_result in student.standardtestresult_set.filter(
-                    test__show_on_reports=True,
-                    show_on_reports=True
-                    ).order_by('test'):
-                    test_result.categories = ""
-                    for cat in test_result.standardcategorygrade_set.filter(category__is_total=False):
-                        test_result.categories += '%s: %s | ' % (cat.category.name, strip_trailing_zeros(cat.grade))
-                    test_result.categories = test_result.categories [:-3]
-                    student.tests.append(test_result)
-
-                for test in StandardTest.objects.filter(standardtestresult__student=student, show_on_reports=True, standardtestresult__show_on_reports=True).distinct():
-                    test.total = strip_trailing_zeros(test.get_cherry_pick_total(student))
-                    student.highest_tests.append(test)
+        """ Set transcript attributes on student, using the data loaded
+        for the whole report when there is some """
+        data = getattr(self, 'transcript_data', None)
+        if data is None or student.id not in data.student_ids:
+            data = TranscriptData([student], self)
+        data.attach(student)
 
     def get_appy_template(self):
         return self.report_context.get('template').file
 
+    @measure('code', 'ecwsp.sis.scaffold_reports.SisReport.get_appy_context')
     def get_appy_context(self):
         context = super(SisReport, self).get_appy_context()
         context['date'] = datetime.date.today()
@@ -1238,14 +1047,15 @@ class SisReport(ScaffoldReport):
             context['school_name'] = config.SCHOOL_NAME
 
             if template.transcript:
-                self.pass_score = float(Configuration.get_or_default("Passing Grade", '70').value)
-                self.pass_letters = Configuration.get_or_default("Letter Passing Grade", 'A,B,C,P').value
+                self.pass_score = self.lookups.passing_grade()
+                self.pass_letters = self.lookups.config("Letter Passing Grade")
+                self.transcript_data = TranscriptData(students, self)
                 for student in students:
                     self.get_student_transcript_data(student)
             if template.benchmark_report_card and \
                 'ecwsp.benchmark_grade' in settings.INSTALLED_APPS:
                 from ecwsp.benchmark_grade.report import get_benchmark_report_card_data
-                get_benchmark_report_card_data(self.report_context, context, students)
+                get_benchmark_report_card_data(self.report_context, context, students, self.lookups)
             elif template.report_card:
                 self.blank_grade = Grade()
                 school_year = SchoolYear.objects.filter(start_date__lte=self.report_context['date_end']
@@ -1254,7 +1064,8 @@ class SisReport(ScaffoldReport):
                 context['year'] = school_year
                 self.marking_periods = MarkingPeriod.objects.filter(
                     school_year=school_year, show_reports=True)
-                context['marking_periods'] = self.marking_periods.order_by('start_date')
+                context['marking_periods'] = ReportList(self.lookups.report_marking_periods(school_year))
+                self.report_card_data = ReportCardData(students, self.marking_periods, school_year)
                 for student in students:
                     self.get_student_report_card_data(student)
             if template.general_student:
@@ -0,0 +1,38 @@
+from .models import PerformanceRecord, ReportJob
+from .report_jobs import run_report_job, delete_expired_report_jobs, fail_report_jobs
+from ecwsp.sis.helper_functions import all_tenants
+from django_sis.celery import app
+from django.conf import settings
+import datetime
+
+
+@app.task
+@all_tenants
+def prune_performance_records_task():
+    """ Keep only the last PERFORMANCE_LOG_DAYS days of performance records """
+    since = datetime.datetime.now() - datetime.timedelta(days=settings.PERFORMANCE_LOG_DAYS)
+    PerformanceRecord.objects.filter(date__lt=since).delete()
+
+
+# Retried every 10 seconds, six times a minute
+@app.task(bind=True, max_retries=settings.REPORT_JOB_TIMEOUT * 6)
+def run_report_job_task(self, job_id):
+    """ Generate a queued report, waiting up to REPORT_JOB_TIMEOUT minutes
+    while REPORT_JOB_CONCURRENCY heavier reports are already running """
+    try:
+        job = ReportJob.objects.get(id=job_id, status='pending')
+    except ReportJob.DoesNotExist:
+        return
+    if run_report_job(job) is None and ReportJob.objects.filter(id=job_id, status='pending').exists():
+        # Every slot is taken
+        if self.request.retries >= self.max_retries:
+            fail_report_jobs(ReportJob.objects.filter(id=job_id, status='pending'),
+                             'Too many reports are running, please try again later')
+            return
+        raise self.retry(countdown=10)
+
+
+@app.task
+@all_tenants
+def delete_expired_report_jobs_task():
+    delete_expired_report_jobs()
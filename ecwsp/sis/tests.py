@@ -2,6 +2,7 @@ from django.test import TestCase
 from django.test import TransactionTestCase
 from django.test.client import Client
 from django.contrib.auth.models import User, Group
+from django.conf import settings
 
 from ecwsp.sis.models import *
 from ecwsp.sis.sample_data import *
@@ -10,12 +11,19 @@ from ecwsp.attendance.models import *
 from ecwsp.grades.models import *
 
 import datetime
+import json
 from django.db import connection
+from django.db.models import Q
 
 class SisTestMixin(object):
     """ Making a test, use me please """
     def setUp(self):
         """ Prepares simple school data. """
+        # Process wide caches would otherwise leak between tests
+        from ecwsp.sis.models import clear_grade_scale_indexes
+        from ecwsp.schedule.models import clear_marking_period_caches
+        clear_grade_scale_indexes(sender=None)
+        clear_marking_period_caches(sender=None)
         self.populate_database()
 
     def populate_database(self):
@@ -52,6 +60,112 @@ class ReportTest(SisTestMixin, TestCase):
         self.assertTrue(student.years[0].hide_grades)
 
 
+class ReportCardDataTest(SisTestMixin, TestCase):
+    def populate_database(self):
+        self.data = SisData()
+        self.data.create_balt_like_sample_data()
+
+    def get_report(self):
+        import autocomplete_light
+        autocomplete_light.autodiscover()
+        from .scaffold_reports import SisReport
+        sis_report = SisReport()
+        sis_report.blank_grade = Grade()
+        sis_report.school_year = self.data.year
+        sis_report.marking_periods = MarkingPeriod.objects.filter(school_year=self.data.year, show_reports=True)
+        return sis_report
+
+    def test_report_card_data(self):
+        from .report_data import ReportCardData
+        student = self.data.student
+        StudentAttendance.objects.create(
+            student=student, date=datetime.date(2014, 7, 5),
+            status=AttendanceStatus.objects.create(name="Absent", code="A", absent=True))
+        sis_report = self.get_report()
+        students = list(Student.objects.all())
+        with self.assertNumQueries(6):
+            sis_report.report_card_data = ReportCardData(
+                students, sis_report.marking_periods, sis_report.school_year)
+        for student in students:
+            sis_report.get_student_report_card_data(student)
+        student = [s for s in students if s.id == self.data.student.id][0]
+        self.assertEqual(student.absent1, 1)
+        self.assertEqual(student.absent_unexcused1, 1)
+        # The sample marking periods overlap
+        self.assertEqual(student.absent6, 1)
+        self.assertEqual(student.absent_total, 6)
+        self.assertEqual(student.tardy1, 0)
+        self.assertEqual(len(student.course_sections), 8)
+        for course_section in student.course_sections:
+            self.assertEqual(course_section.ce.user_id, student.id)
+            for i, marking_period in enumerate(student.mps):
+                grade = getattr(course_section, "grade" + str(i + 1))
+                expected = Grade.objects.filter(
+                    student=student, course_section=course_section, marking_period=marking_period).first()
+                self.assertEqual(grade.id, expected.id if expected else None)
+                self.assertEqual(course_section.mp_grade[marking_period.name].id, grade.id)
+        self.assertEqual(student.year_grade, StudentYearGrade.objects.filter(student=student, year=self.data.year).first())
+
+
+    def test_transcript_data(self):
+        from django.test.utils import CaptureQueriesContext
+        from .report_data import TranscriptData
+        self.build_grade_cache()
+        sis_report = self.get_report()
+        sis_report.date_end = datetime.date(2014, 9, 3)
+        sis_report.report_context['date_end'] = sis_report.date_end
+        sis_report.pass_score = 70
+        sis_report.pass_letters = 'A,B,C,P'
+        students = list(Student.objects.all())
+        TranscriptData(students, sis_report)  # Fill the grade snapshots
+        with CaptureQueriesContext(connection) as one_student:
+            TranscriptData(students[:1], sis_report)
+        with CaptureQueriesContext(connection) as all_students:
+            sis_report.transcript_data = TranscriptData(students, sis_report)
+        self.assertEqual(len(all_students), len(one_student))
+
+        for student in students:
+            sis_report.get_student_transcript_data(student)
+        student = [s for s in students if s.id == self.data.student.id][0]
+        self.assertEqual(student.years.count(), 1)
+        year = student.years[0]
+        self.assertEqual([mp.id for mp in year.mps], [
+            mp.id for mp in MarkingPeriod.objects.filter(school_year=year).order_by('start_date')])
+        self.assertEqual(len(year.course_sections), 8)
+        for course_section in year.course_sections:
+            enrollment = CourseEnrollment.objects.get(user=student, course_section=course_section)
+            self.assertEqual(course_section.final, enrollment.get_grade(sis_report.date_end))
+            for i, mp in enumerate(year.mps):
+                grade = Grade.objects.filter(student=student, course_section=course_section, marking_period=mp).first()
+                if grade is None or mp.end_date > sis_report.date_end:
+                    expected = ""
+                else:
+                    expected = " " + str(grade.get_grade(number=None)) + " "
+                self.assertEqual(getattr(course_section, "grade" + str(i + 1)), expected)
+        year_grade = StudentYearGrade.objects.get(student=student, year=year)
+        self.assertEqual(year.ave, year_grade.get_grade(date_report=sis_report.date_end))
+
+    def test_report_lookups(self):
+        from ecwsp.administration.models import Configuration
+        sis_report = self.get_report()
+        lookups = sis_report.lookups
+        course_section = CourseSection.objects.filter(marking_period__school_year=self.data.year).first()
+        marking_periods = lookups.report_marking_periods(self.data.year)
+        section_marking_periods = lookups.section_marking_periods(course_section)
+        passing_grade = lookups.passing_grade()
+        year_days = lookups.year_days(self.data.year)
+        with self.assertNumQueries(0):
+            self.assertIs(sis_report.lookups, lookups)
+            self.assertIs(lookups.report_marking_periods(self.data.year), marking_periods)
+            self.assertIs(lookups.section_marking_periods(course_section), section_marking_periods)
+            self.assertEqual(lookups.passing_grade(), passing_grade)
+            self.assertEqual(lookups.year_days(self.data.year), year_days)
+        self.assertEqual([mp.id for mp in marking_periods], list(MarkingPeriod.objects.filter(
+            school_year=self.data.year, show_reports=True).order_by('start_date').values_list('id', flat=True)))
+        self.assertEqual(year_days, self.data.year.get_number_days())
+        self.assertEqual(passing_grade, float(Configuration.get_or_default('Passing Grade').value))
+
+
 class AttendanceTest(SisTestMixin, TestCase):
     def test_attendance(self):
         """
@@ -100,3 +214,306 @@ class AttendanceTest(SisTestMixin, TestCase):
         self.assertEqual(response.status_code, 200)
 
         #should test if attendance can be submitted
+
+
+class PerformanceTest(SisTestMixin, TestCase):
+    def test_measure(self):
+        from django.test.utils import override_settings
+        from ecwsp.sis.performance import measure, top_offenders
+        use_debug_cursor = connection.use_debug_cursor
+        with override_settings(PERFORMANCE_LOGGING=True):
+            with measure('code', 'count students'):
+                Student.objects.count()
+                with measure('code', 'count years'):
+                    SchoolYear.objects.count()
+        self.assertEqual(connection.use_debug_cursor, use_debug_cursor)
+        self.assertEqual(PerformanceRecord.objects.get(name='count years').queries, 1)
+        # Saving the inner record doesn't count as a query of the outer one
+        self.assertEqual(PerformanceRecord.objects.get(name='count students').queries, 2)
+        # Only the growth during the measurement, not the process lifetime peak
+        self.assertTrue(PerformanceRecord.objects.get(name='count years').peak_memory < 1024)
+        self.assertEqual(
+            set(offender['name'] for offender in top_offenders()),
+            set(['count students', 'count years']))
+
+    def test_measure_disabled(self):
+        from ecwsp.sis.performance import measure
+        with measure('code', 'count students'):
+            Student.objects.count()
+        self.assertFalse(PerformanceRecord.objects.exists())
+
+
+class ProcessCacheTest(TestCase):
+    def test_shared_cache_check(self):
+        from django.test.utils import override_settings
+        from ecwsp.sis.helper_functions import check_shared_cache
+        locmem = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+        with override_settings(CACHES=locmem, DEBUG=False):
+            self.assertEqual([error.id for error in check_shared_cache(None)], ['sis.E001'])
+        with override_settings(CACHES=locmem, DEBUG=True):
+            self.assertEqual(check_shared_cache(None), [])
+
+
+class ReportRenderTest(TestCase):
+    def make_odt(self, file_name, style, body, picture):
+        import zipfile
+        odt = zipfile.ZipFile(file_name, 'w')
+        odt.writestr('mimetype', 'application/vnd.oasis.opendocument.text')
+        odt.writestr('META-INF/manifest.xml',
+            '<manifest:manifest><manifest:file-entry manifest:full-path="Pictures/1.png"'
+            ' manifest:media-type="image/png"/></manifest:manifest>')
+        odt.writestr('content.xml',
+            '<office:document-content><office:automatic-styles>{0}</office:automatic-styles>'
+            '<office:body><office:text><text:sequence-decls><text:sequence-decl/></text:sequence-decls>'
+            '{1}<draw:image xlink:href="Pictures/1.png"/></office:text></office:body>'
+            '</office:document-content>'.format(style, body))
+        odt.writestr('Pictures/1.png', picture)
+        odt.close()
+
+    def test_concatenate_odt(self):
+        import os, tempfile, zipfile
+        from ecwsp.sis.report_render import concatenate_odt
+        directory = tempfile.mkdtemp()
+        names = [os.path.join(directory, name) for name in ('1.odt', '2.odt', 'out.odt')]
+        self.make_odt(names[0], '<style:style style:name="P1" style:family="paragraph"/>',
+                      '<text:p text:style-name="P1">Alice</text:p>', 'a')
+        self.make_odt(names[1], '<style:style style:name="P1" style:family="text"/>',
+                      '<text:p text:style-name="P1">Bob</text:p>', 'b')
+        concatenate_odt(names[:2], names[2])
+
+        out = zipfile.ZipFile(names[2])
+        self.assertEqual(out.namelist()[0], 'mimetype')
+        content = out.read('content.xml')
+        self.assertEqual(content.count('<office:text>'), 1)
+        self.assertEqual(content.count('<text:sequence-decls>'), 1)
+        self.assertIn('<text:p text:style-name="P1">Alice</text:p>', content)
+        self.assertIn('<text:p text:style-name="P1_part1">Bob</text:p>', content)
+        self.assertIn('<style:style style:name="P1_part1" style:family="text"/>', content)
+        self.assertIn('xlink:href="Pictures/part1_1.png"', content)
+        self.assertEqual(out.read('Pictures/part1_1.png'), 'b')
+        self.assertIn('Pictures/part1_1.png', out.read('META-INF/manifest.xml'))
+
+    def test_report_progress(self):
+        import autocomplete_light
+        autocomplete_light.autodiscover()
+        from ecwsp.sis.report_render import set_progress
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        User.objects.create_user('user', 'user@example.com', 'user')
+        set_progress('abc', 2, 5, 'student_report')
+        client = Client()
+        client.login(username='admin', password='admin')
+        response = client.get('/sis/reports/progress/abc/')
+        self.assertEqual(json.loads(response.content), {'done': 2, 'total': 5})
+        # Only users who may see the report see its progress
+        client.login(username='user', password='user')
+        response = client.get('/sis/reports/progress/abc/')
+        self.assertEqual(response.status_code, 403)
+
+    def test_xl_report_write_only(self):
+        import openpyxl
+        from cStringIO import StringIO
+        from ecwsp.sis.xl_report import XlReport
+        report = XlReport(file_name="Big Report", write_only=True)
+        rows = ([i, 'Student {0}'.format(i)] for i in range(3))
+        report.add_sheet(rows, header_row=['Id', 'Name'], title="Students", auto_width=True)
+        response = report.as_download()
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename=Big_Report.xlsx')
+        content = b''.join(response.streaming_content)
+        self.assertEqual(int(response['Content-Length']), len(content))
+
+        sheet = openpyxl.load_workbook(StringIO(content)).get_sheet_by_name('Students')
+        self.assertEqual(sheet.cell(row=1, column=1).value, 'Id')
+        self.assertTrue(sheet.cell(row=1, column=1).style.font.bold)
+        self.assertEqual(sheet.cell(row=4, column=2).value, 'Student 2')
+        self.assertAlmostEqual(float(sheet.column_dimensions['B'].width), len('Student 0') * 0.9, places=1)
+
+
+class ReportJobTest(SisTestMixin, TestCase):
+    def test_run_report_job(self):
+        import autocomplete_light
+        autocomplete_light.autodiscover()
+        from .report_jobs import job_key, find_report_job, run_report_job, delete_expired_report_jobs
+        user = User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        data = json.dumps([])
+        key = job_key('student_report', 'gpa_report', data, user)
+        job = ReportJob.objects.create(
+            key=key, report='student_report', download_type='gpa_report', post_data=data, user=user)
+        # Identical requests by the same user share the job
+        self.assertEqual(find_report_job(job_key('student_report', 'gpa_report', data, user)), job)
+        self.assertNotEqual(key, job_key('student_report', 'fail_report', data, user))
+        other_user = User.objects.create_user('other', 'other@example.com', 'other')
+        self.assertNotEqual(key, job_key('student_report', 'gpa_report', data, other_user))
+
+        run_report_job(job)
+        job = ReportJob.objects.get(id=job.id)
+        self.assertEqual(job.status, 'done')
+        self.assertTrue(job.file_name.startswith('gpas_by_year'))
+        self.assertEqual(find_report_job(key), job)
+
+        job.expires = datetime.datetime.now() - datetime.timedelta(hours=1)
+        job.save()
+        self.assertEqual(find_report_job(key), None)
+        delete_expired_report_jobs()
+        self.assertFalse(ReportJob.objects.exists())
+
+    def test_report_job_timeout(self):
+        from .report_jobs import find_report_job, running_report_jobs, run_report_job, delete_expired_report_jobs
+        started = datetime.datetime.now() - datetime.timedelta(minutes=settings.REPORT_JOB_TIMEOUT + 1)
+        job = ReportJob.objects.create(
+            key='stuck', report='student_report', download_type='gpa_report',
+            status='running', started=started)
+        # A job that ran too long no longer blocks or serves new requests
+        self.assertEqual(find_report_job('stuck'), None)
+        self.assertEqual(running_report_jobs(), 0)
+        # Only pending jobs are claimed
+        run_report_job(job)
+        self.assertFalse(ReportJob.objects.get(id=job.id).file_name)
+        delete_expired_report_jobs()
+        job = ReportJob.objects.get(id=job.id)
+        self.assertEqual(job.status, 'failed')
+        self.assertTrue(job.expires)
+
+    def test_report_job_concurrency(self):
+        from .report_jobs import run_report_job
+        started = datetime.datetime.now()
+        for slot in range(settings.REPORT_JOB_CONCURRENCY):
+            ReportJob.objects.create(
+                key='running', report='student_report', download_type='gpa_report',
+                status='running', started=started, slot=slot)
+        job = ReportJob.objects.create(key='waiting', report='student_report', download_type='gpa_report')
+        # Every slot is taken, so the job keeps waiting
+        self.assertEqual(run_report_job(job), None)
+        self.assertEqual(ReportJob.objects.get(id=job.id).status, 'pending')
+
+
+class ReportButtonTest(SisTestMixin, TestCase):
+    def populate_database(self):
+        self.data = SisData()
+        self.data.create_balt_like_sample_data()
+
+    def get_report_data(self, button, report_context):
+        """ Run button.get_report and return what it would write to xlsx """
+        import autocomplete_light
+        autocomplete_light.autodiscover()
+        from .scaffold_reports import SisReport
+
+        class ReportView(object):
+            def list_to_xlsx_response(self, data, file_name, header=None):
+                return data
+        report_view = ReportView()
+        report_view.report = SisReport()
+        report_view.report.report_context = report_context
+        return button.get_report(report_view, {})
+
+    def test_aggregate_grade_report(self):
+        from .scaffold_reports import AggregateGradeButton
+        mps = MarkingPeriod.objects.filter(school_year=self.data.year)
+        data = self.get_report_data(AggregateGradeButton(), {'marking_periods': mps})
+        levels = list(GradeLevel.objects.all())
+        rows = iter(data['teacher_aggregate'][1:])
+        for teacher in Faculty.objects.filter(coursesection__marking_period__in=mps, is_active=True).distinct():
+            self.assertEqual(next(rows), [str(teacher)])
+            grades = Grade.objects.filter(
+                marking_period__in=mps, course_section__teachers=teacher,
+                student__is_active=True, override_final=False,
+            ).filter(Q(grade__isnull=False) | Q(letter_grade__isnull=False))
+            if not grades.exists():
+                continue
+            for high, low in AggregateGradeButton.ranges:
+                row = next(rows)
+                self.assertEqual(row[1], low + " to " + high)
+                in_range = grades.filter(grade__range=(low, high))
+                self.assertEqual(row[2], in_range.distinct().count())
+                self.assertEqual(row[4::2], [in_range.filter(student__year=level).distinct().count()
+                                             for level in levels])
+            for letter in AggregateGradeButton.letter_ranges:
+                row = next(rows)
+                self.assertEqual(row[2], grades.filter(letter_grade=letter).distinct().count())
+        self.assertEqual(list(rows), [])
+
+        for level, row in zip(levels, data['class_dept'][1:]):
+            for dept, fails in zip(Department.objects.all(), row[1::2]):
+                self.assertEqual(fails, Grade.objects.filter(
+                    marking_period__in=mps, course_section__course__department=dept,
+                    student__is_active=True, student__year=level, grade__lt=70,
+                    override_final=False).count())
+
+    def test_aggregate_grade_report_without_level(self):
+        """ Students without a grade level are counted once """
+        import autocomplete_light
+        autocomplete_light.autodiscover()
+        from .scaffold_reports import AggregateGradeButton
+        mps = MarkingPeriod.objects.filter(school_year=self.data.year)
+        grade = Grade.objects.filter(
+            marking_period__in=mps, grade__isnull=False, override_final=False,
+            student__is_active=True).exclude(course_section__teachers=None).first()
+        Student.objects.filter(id=grade.student_id).update(year=None)
+        teacher = grade.course_section.teachers.first()
+        counts = AggregateGradeButton().count_teacher_grades(mps, [teacher.id])
+        grades = Grade.objects.filter(
+            marking_period__in=mps, course_section__teachers=teacher,
+            student__is_active=True, override_final=False,
+        ).filter(Q(grade__isnull=False) | Q(letter_grade__isnull=False))
+        self.assertEqual(counts[(teacher.id, None, None)], grades.count())
+        for high, low in AggregateGradeButton.ranges:
+            self.assertEqual(counts.get((teacher.id, high, None), 0),
+                             grades.filter(grade__range=(low, high)).count())
+
+    def test_fail_report(self):
+        from .scaffold_reports import FailReportButton
+        mps = MarkingPeriod.objects.filter(school_year=self.data.year)
+        grade = Grade.objects.filter(marking_period__in=mps, grade__isnull=False).first()
+        grade.grade = 50
+        grade.save()
+        data = self.get_report_data(FailReportButton(), {'marking_periods': mps})
+        students = Student.objects.filter(
+            courseenrollment__course_section__marking_period__in=mps).distinct()
+        self.assertEqual([row[0] for row in data], [str(student) for student in students])
+        for student, row in zip(students, data):
+            failed = student.grade_set.filter(
+                override_final=False, grade__lt=70, marking_period__in=mps).distinct()
+            self.assertEqual(len(row[row.index(student.username) + 4:]), failed.count() * 3)
+            self.assertEqual(row[row.index(student.username) + 2], student.gpa)
+        self.assertIn(str(grade.course_section), sum(data, []))
+
+    def test_gpa_report(self):
+        from .scaffold_reports import GPAReportButton
+        data = self.get_report_data(GPAReportButton(), {})
+        for student, row in zip(Student.objects.all(), data):
+            self.assertEqual(row[0], str(student))
+            self.assertEqual(row[-1], student.gpa)
+            self.assertEqual(len(row), 2 + max(4, student.studentyeargrade_set.count()))
+
+    def test_grade_distribution_report(self):
+        from .scaffold_reports import GradeDistributionByTeacherButton
+
+        def average(enrollments):
+            grades = [enrollment.numeric_grade for enrollment in enrollments
+                      if enrollment.numeric_grade is not None]
+            if grades:
+                return round(sum(grades, Decimal('0.00')) / len(grades), 1)
+
+        cohort = Cohort.objects.create(name="Cohort 1")
+        section = CourseSection.objects.filter(courseenrollment__isnull=False).first()
+        section.cohorts.add(cohort)
+        StudentCohort.objects.create(student=section.courseenrollment_set.first().user, cohort=cohort)
+        data = self.get_report_data(GradeDistributionByTeacherButton(), {})['sheet_1']
+        rows = [row for row in data if len(row) > 1]
+        self.assertTrue(rows)
+        for row in rows:
+            teacher = Faculty.objects.get(last_name=row[0].split(', ')[0], first_name=row[0].split(', ')[1])
+            self.assertEqual(row[6], average(CourseEnrollment.objects.filter(
+                course_section__teachers=teacher).distinct()))
+        cohort_row = [row for row in rows if row[2] == "Cohort 1"][0]
+        self.assertEqual(cohort_row[3], average(CourseEnrollment.objects.filter(
+            course_section=section, user__in=cohort.students.all())))
+        self.assertEqual(cohort_row[4], average(section.courseenrollment_set.all()))
+        self.assertEqual(cohort_row[5], average(CourseEnrollment.objects.filter(
+            course_section__course=section.course)))
+
+    def test_grade_distribution_report_without_sections(self):
+        from .scaffold_reports import GradeDistributionByTeacherButton
+        CourseSection.objects.all().delete()
+        data = self.get_report_data(GradeDistributionByTeacherButton(), {})['sheet_1']
+        self.assertFalse([row for row in data if len(row) > 1])
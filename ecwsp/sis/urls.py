@@ -1,11 +1,15 @@
 from django.conf.urls import patterns, url
-from .views import transcript_nonofficial, photo_flash_card, thumbnail, paper_attendance
+from .views import transcript_nonofficial, photo_flash_card, thumbnail, paper_attendance, report_progress
+from .views import report_job_status, report_job_download
 from .views import user_preferences, view_student, ajax_include_deleted, import_naviance, increment_year, increment_year_confirm, StudentViewDashletView
 from responsive_dashboard.views import generate_dashboard
 
 urlpatterns = patterns('',
     (r'^$', generate_dashboard, {'app_name': 'sis'}),
     (r'^reports/transcript_nonofficial/(?P<student_id>\d+)/$', transcript_nonofficial),
+    url(r'^reports/progress/(?P<progress_id>[\w-]+)/$', report_progress, name="report-progress"),
+    url(r'^reports/jobs/(?P<job_id>\d+)/$', report_job_status, name="report-job-status"),
+    url(r'^reports/jobs/(?P<job_id>\d+)/download/$', report_job_download, name="report-job-download"),
     (r'^flashcard/$', photo_flash_card),
     (r'^flashcard/(?P<year>\d+)/$', photo_flash_card),
     (r'^preferences/$', user_preferences),
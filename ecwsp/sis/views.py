@@ -10,14 +10,14 @@ from django.core.exceptions import ObjectDoesNotExist
 from django.db.models import Q
 from django.db import transaction
 from django.template import RequestContext
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, HttpResponseForbidden
 from django.utils.safestring import mark_safe
 from django.utils.decorators import method_decorator
 from django.views import generic
 from django.views.generic.base import TemplateView
 from datetime import date
 
-from .models import Student, UserPreference, GradeLevel, SchoolYear
+from .models import Student, UserPreference, GradeLevel, SchoolYear, ReportJob
 from .forms import UserPreferenceForm, StudentLookupForm
 from .forms import YearSelectForm
 from .pdf_reports import student_thumbnail
@@ -27,6 +27,7 @@ from ecwsp.schedule.calendar import Calendar
 from ecwsp.schedule.models import (
     MarkingPeriod, CourseSection, CourseEnrollment)
 
+import json
 import sys
 
 
@@ -159,6 +160,8 @@ def paper_attendance(request, day):
 
 from scaffold_report.views import DownloadReportView, ScaffoldReportView
 from .scaffold_reports import SisReport, AttendanceReport
+from .report_render import get_progress
+from .report_jobs import report_job_data
 
 
 class AttendanceReportView(ScaffoldReportView):
@@ -197,6 +200,56 @@ def transcript_nonofficial(request, student_id):
     return view.post(request)
 
 
+def may_see_report(request, report_name):
+    """ Whether the user passes the report's permission check """
+    from scaffold_report.report import scaffold_reports
+    report_class = scaffold_reports.get_report(report_name)
+    return report_class is not None and report_class().check_permissions(request) != False
+
+
+@login_required
+def report_progress(request, progress_id):
+    """ How many chunks of a report are rendered, for the browser to poll
+    """
+    progress = get_progress(progress_id)
+    if progress is None:
+        progress = {'done': 0, 'total': None}
+    elif not may_see_report(request, progress.get('report')):
+        return HttpResponseForbidden()
+    data = {'done': progress['done'], 'total': progress['total']}
+    return HttpResponse(json.dumps(data), content_type="application/json")
+
+
+def get_report_job(request, job_id, **kwargs):
+    """ The ReportJob or None when the user may not see its report """
+    job = get_object_or_404(ReportJob, id=job_id, **kwargs)
+    if not may_see_report(request, job.report):
+        return None
+    return job
+
+
+@login_required
+def report_job_status(request, job_id):
+    """ Status of a background report, for the browser to poll
+    """
+    job = get_report_job(request, job_id)
+    if job is None:
+        return HttpResponseForbidden()
+    return HttpResponse(json.dumps(report_job_data(job)), content_type="application/json")
+
+
+@login_required
+def report_job_download(request, job_id):
+    """ The file of a finished background report
+    """
+    job = get_report_job(request, job_id, status='done')
+    if job is None:
+        return HttpResponseForbidden()
+    response = HttpResponse(job.file, content_type=job.content_type)
+    response['Content-Disposition'] = 'attachment; filename=' + job.file_name
+    return response
+
+
 def logout_view(request):
     """ Logout, by sending a message to the base.html template
     """
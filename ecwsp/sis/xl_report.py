@@ -1,27 +1,36 @@
 from django.conf import settings
-from django.http import HttpResponse
-import cStringIO as StringIO
+from django.core.servers.basehttp import FileWrapper
+from django.http import HttpResponse, StreamingHttpResponse
 import openpyxl
 from openpyxl.workbook import Workbook
 from openpyxl.writer.excel import save_virtual_workbook
 from openpyxl.cell import get_column_letter
 import re
+import tempfile
 from ecwsp.sis.helper_functions import strip_unicode_to_ascii
 
 class XlReport:
     """ Wrapper for openpyxl
     Using xlsx because xls has limitations and ods has no good python
     library
+
+    write_only keeps only one row in memory at a time, for big exports.
+    Sheets can't be changed after add_sheet and as_download streams the file.
     """
-    def __init__(self, file_name="Report"):
+    def __init__(self, file_name="Report", write_only=False):
         """ file_name does not need an extention """
         if file_name.endswith('.xls'):
             file_name = file_name[:-4]
         elif file_name.endswith('xlsx'):
             file_name = file_name[:-5]
         file_name = file_name.replace(' ', '_') # Some browsers don't deal well with spaces in downloads
-        self.workbook = Workbook()
-        self.workbook.remove_sheet(self.workbook.get_active_sheet())
+        self.write_only = write_only
+        if write_only:
+            # Write only workbooks start without a sheet
+            self.workbook = Workbook(optimized_write=True)
+        else:
+            self.workbook = Workbook()
+            self.workbook.remove_sheet(self.workbook.get_active_sheet())
         self.file_name = file_name
         # Sniff the openpyxl version
         try:
@@ -52,61 +61,82 @@ class XlReport:
             sheet.append([unicode(heading)])
         if header_row:
             header_row = map(unicode, header_row)
-            sheet.append(header_row)
-            row = sheet.get_highest_row()
-            for i, header_cell in enumerate(header_row):
-                if self.old_openpyxl:
-                    cell = sheet.cell(row=row-1, column=i)
-                    cell.style.font.bold = True
-                    cell.style.borders.bottom.border_style = openpyxl.style.Border.BORDER_THIN
-                else:
-                    cell = sheet.cell(row=row, column=i+1)
-                    cell.style = cell.style.copy(
-                        font=cell.style.font.copy(bold=True),
-                        border=openpyxl.styles.Border(
-                            bottom=openpyxl.styles.Side(
-                                border_style=openpyxl.styles.borders.BORDER_THIN
-                            )
-                        )
-                    )
+            if self.write_only:
+                sheet.append([self.header_cell(sheet, value) for value in header_row])
+            else:
+                sheet.append(header_row)
+                row = sheet.get_highest_row()
+                for i, header_cell in enumerate(header_row):
+                    if self.old_openpyxl:
+                        cell = sheet.cell(row=row-1, column=i)
+                        cell.style.font.bold = True
+                        cell.style.borders.bottom.border_style = openpyxl.style.Border.BORDER_THIN
+                    else:
+                        self.style_header_cell(sheet.cell(row=row, column=i+1))
+        # data may be a generator, so it's only read once
+        column_widths = []
         for row in data:
             row = map(unicode, row)
             sheet.append(row)
-        if auto_width:
-            column_widths = []
-            for row in data:
-                row = map(unicode, row)
+            if auto_width:
                 for i, cell in enumerate(row):
                     if len(column_widths) > i:
                         if len(cell) > column_widths[i]:
                             column_widths[i] = len(cell)
                     else:
                         column_widths += [len(cell)]
-            
-            for i, column_width in enumerate(column_widths):
-                if column_width > 3:
-                    if column_width < max_auto_width:
-                        # * 0.9 estimates a typical variable width font
-                        sheet.column_dimensions[get_column_letter(i+1)].width = column_width * 0.9
-                    else:
-                        sheet.column_dimensions[get_column_letter(i+1)].width = max_auto_width
-    
+
+        for i, column_width in enumerate(column_widths):
+            if column_width > 3:
+                if column_width < max_auto_width:
+                    # * 0.9 estimates a typical variable width font
+                    sheet.column_dimensions[get_column_letter(i+1)].width = column_width * 0.9
+                else:
+                    sheet.column_dimensions[get_column_letter(i+1)].width = max_auto_width
+
+    @staticmethod
+    def style_header_cell(cell):
+        """ Bold with a bottom border """
+        cell.style = cell.style.copy(
+            font=cell.style.font.copy(bold=True),
+            border=openpyxl.styles.Border(
+                bottom=openpyxl.styles.Side(
+                    border_style=openpyxl.styles.borders.BORDER_THIN
+                )
+            )
+        )
+
+    def header_cell(self, sheet, value):
+        """ Styled header cell for a write only sheet """
+        from openpyxl.writer.dump_worksheet import WriteOnlyCell
+        cell = WriteOnlyCell(sheet, value)
+        self.style_header_cell(cell)
+        return cell
+
     def save(self, filename):
         self.workbook.save(settings.MEDIA_ROOT + filename)
     
-    def as_download(self):
-        """ Returns a django HttpResponse with the xlsx file """
-        myfile = StringIO.StringIO()
-        myfile.write(save_virtual_workbook(self.workbook))
-        response = HttpResponse(
-            myfile.getvalue(),
-            content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-
-        safe_filename = re.sub(
+    def get_safe_filename(self):
+        return re.sub(
             '[^A-Za-z0-9]+',
             '_',
             strip_unicode_to_ascii(self.file_name)
         )
-        response['Content-Disposition'] = 'attachment; filename=%s.xlsx' % safe_filename
-        response['Content-Length'] = myfile.tell()
+
+    def as_download(self):
+        """ Returns a django HttpResponse with the xlsx file
+        Write only reports are saved to a temporary file and streamed """
+        content_type = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+        if self.write_only:
+            xlsx_file = tempfile.TemporaryFile()
+            self.workbook.save(xlsx_file)
+            length = xlsx_file.tell()
+            xlsx_file.seek(0)
+            response = StreamingHttpResponse(FileWrapper(xlsx_file), content_type=content_type)
+        else:
+            content = save_virtual_workbook(self.workbook)
+            length = len(content)
+            response = HttpResponse(content, content_type=content_type)
+        response['Content-Disposition'] = 'attachment; filename=%s.xlsx' % self.get_safe_filename()
+        response['Content-Length'] = length
         return response